@@ -93,6 +93,13 @@ return [txt2img_prompt, parseInt(txt2img_width), parseInt(txt2img_height), parse
 """
 
 
+# Inputs must be [gallery_handles, gallery]; passes the handle of the selected image
+# (or, without handles, its data URL) on to the python function
+def js_select_gallery_item(from_id, to_id=None):
+    params = json.dumps({"fromId": from_id, "toId": to_id})
+    return f"async (handles, gallery) => {{ return await SD.selectGalleryItem({{ handles, gallery, ...{params} }}) ?? [null, null]; }}"
+
+
 # @altryne this came up as conflict, still needed or no?
 # Wrap the typical SD method call into async closure for ease of use
 # Supplies the js function with a params object
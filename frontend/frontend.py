@@ -1,7 +1,8 @@
 import gradio as gr
-from frontend.css_and_js import css, js, call_JS, js_parse_prompt, js_copy_txt2img_output
+from frontend.css_and_js import css, js, call_JS, js_parse_prompt, js_copy_txt2img_output, js_select_gallery_item
 from frontend.job_manager import JobManager
 import frontend.ui_functions as uifn
+from functools import partial
 import uuid
 
 
@@ -11,7 +12,10 @@ def draw_gradio_ui(opt, img2img=lambda x: x, txt2img=lambda x: x, imgproc=lambda
                    img2img_toggles={}, img2img_toggle_defaults={}, sample_img2img=None, img2img_mask_modes=None,
                    img2img_resize_modes=None, imgproc_defaults={}, imgproc_mode_toggles={}, user_defaults={},
                    run_GFPGAN=lambda x: x, run_RealESRGAN=lambda x: x,
+                   sampler_names=("DDIM", "PLMS", 'k_dpm_2_a', 'k_dpm_2', 'k_euler_a', 'k_euler', 'k_heun', 'k_lms'),
                    job_manager: JobManager = None) -> gr.Blocks:
+    # PLMS cannot start from a partially noised image
+    img2img_sampler_names = [name for name in sampler_names if name != 'PLMS']
     with gr.Blocks(css=css(opt), analytics_enabled=False, title="Stable Diffusion WebUI") as demo:
         with gr.Tabs(elem_id='tabss') as tabs:
             with gr.TabItem("Text-to-Image", id='txt2img_tab'):
@@ -48,16 +52,17 @@ def draw_gradio_ui(opt, img2img=lambda x: x, txt2img=lambda x: x, imgproc=lambda
                         with gr.Box():
                             output_txt2img_gallery = gr.Gallery(label="Images", elem_id="txt2img_gallery_output").style(
                                 grid=[4, 4])
+                            # server side handles of the full size images; the gallery only gets thumbnails
+                            output_txt2img_handles = gr.JSON(value=[], visible=False)
                             gr.Markdown(
                                 "Select an image from the gallery, then click one of the buttons below to perform an action.")
                             with gr.Row(elem_id='txt2img_actions_row'):
-                                gr.Button("Copy to clipboard").click(fn=None,
-                                                                     inputs=output_txt2img_gallery,
-                                                                     outputs=[],
-                                                                     # _js=js_copy_to_clipboard( 'txt2img_gallery_output')
-                                                                     )
+                                output_txt2img_copy_to_clipboard_btn = gr.Button("Copy to clipboard")
                                 output_txt2img_copy_to_input_btn = gr.Button("Push to img2img")
                                 output_txt2img_to_imglab = gr.Button("Send to Lab", visible=True)
+                                output_txt2img_full_size_btn = gr.Button("Full size", visible=job_manager is not None)
+                            output_txt2img_full_size_link = gr.HTML(visible=False)
+                            output_txt2img_clipboard_url = gr.Textbox(visible=False)
 
                         output_txt2img_params = gr.Highlightedtext(label="Generation parameters", interactive=False,
                                                                    elem_id='highlight')
@@ -76,8 +81,7 @@ def draw_gradio_ui(opt, img2img=lambda x: x, txt2img=lambda x: x, imgproc=lambda
                         txt2img_steps = gr.Slider(minimum=1, maximum=250, step=1, label="Sampling Steps",
                                                   value=txt2img_defaults['ddim_steps'])
                         txt2img_sampling = gr.Dropdown(label='Sampling method (k_lms is default k-diffusion sampler)',
-                                                       choices=["DDIM", "PLMS", 'k_dpm_2_a', 'k_dpm_2', 'k_euler_a',
-                                                                'k_euler', 'k_heun', 'k_lms'],
+                                                       choices=list(sampler_names),
                                                        value=txt2img_defaults['sampler_name'])
                         with gr.Tabs():
                             with gr.TabItem('Simple'):
@@ -105,6 +109,14 @@ def draw_gradio_ui(opt, img2img=lambda x: x, txt2img=lambda x: x, imgproc=lambda
                                                                    value=txt2img_defaults['variant_amount'])
                                 txt2img_variant_seed = gr.Textbox(label="Variant Seed (blank to randomize)", lines=1,
                                                                   max_lines=1, value=txt2img_defaults["variant_seed"])
+                                txt2img_guidance_end = gr.Slider(minimum=0.0, maximum=1.0, step=0.05,
+                                                                 label='Guidance end (fraction of steps that use classifier free guidance; later steps are about twice as fast)',
+                                                                 value=txt2img_defaults['guidance_end'])
+                                txt2img_guidance_curve = gr.Dropdown(label='Guidance curve (how the guidance scale falls off towards the end)',
+                                                                     choices=['constant', 'linear', 'cosine'],
+                                                                     value=txt2img_defaults['guidance_curve'])
+                                txt2img_use_cache = gr.Checkbox(label='Reuse the results of identical earlier requests',
+                                                                value=txt2img_defaults['use_cache'])
                         txt2img_embeddings = gr.File(label="Embeddings file for textual inversion",
                                                      visible=show_embeddings)
 
@@ -112,7 +124,8 @@ def draw_gradio_ui(opt, img2img=lambda x: x, txt2img=lambda x: x, imgproc=lambda
                 txt2img_inputs = [txt2img_prompt, txt2img_steps, txt2img_sampling, txt2img_toggles,
                                   txt2img_realesrgan_model_name, txt2img_ddim_eta, txt2img_batch_count,
                                   txt2img_batch_size, txt2img_cfg, txt2img_seed, txt2img_height, txt2img_width,
-                                  txt2img_embeddings, txt2img_variant_amount, txt2img_variant_seed]
+                                  txt2img_embeddings, txt2img_variant_amount, txt2img_variant_seed,
+                                  txt2img_guidance_end, txt2img_guidance_curve, txt2img_use_cache]
                 txt2img_outputs = [output_txt2img_gallery, output_txt2img_seed,
                                    output_txt2img_params, output_txt2img_stats]
 
@@ -121,9 +134,25 @@ def draw_gradio_ui(opt, img2img=lambda x: x, txt2img=lambda x: x, imgproc=lambda
                     txt2img_func, txt2img_inputs, txt2img_outputs = txt2img_job_ui.wrap_func(
                         func=txt2img_func,
                         inputs=txt2img_inputs,
-                        outputs=txt2img_outputs
+                        outputs=txt2img_outputs,
+                        gallery_handles=output_txt2img_handles
                     )
 
+                output_txt2img_full_size_btn.click(
+                    partial(uifn.full_size_link, job_manager=job_manager),
+                    [output_txt2img_handles, output_txt2img_gallery],
+                    [output_txt2img_full_size_link],
+                    _js=js_select_gallery_item("txt2img_gallery_output")
+                )
+                output_txt2img_copy_to_clipboard_btn.click(
+                    partial(uifn.full_size_url, job_manager=job_manager),
+                    [output_txt2img_handles, output_txt2img_gallery],
+                    [output_txt2img_clipboard_url],
+                    _js=js_select_gallery_item("txt2img_gallery_output")
+                )
+                output_txt2img_clipboard_url.change(fn=None, inputs=output_txt2img_clipboard_url, outputs=[],
+                                                    _js=call_JS("copyImageUrlToClipboard"))
+
                 txt2img_btn.click(
                     txt2img_func,
                     txt2img_inputs,
@@ -215,6 +244,7 @@ def draw_gradio_ui(opt, img2img=lambda x: x, txt2img=lambda x: x, imgproc=lambda
                         gr.Markdown('#### Img2Img Results')
                         output_img2img_gallery = gr.Gallery(label="Images", elem_id="img2img_gallery_output").style(
                             grid=[4, 4, 4])
+                        output_img2img_handles = gr.JSON(value=[], visible=False)
                         img2img_job_ui = job_manager.draw_gradio_ui() if job_manager else None
                         with gr.Tabs():
                             with gr.TabItem("Generated image actions", id="img2img_actions_tab"):
@@ -223,6 +253,9 @@ def draw_gradio_ui(opt, img2img=lambda x: x, txt2img=lambda x: x, imgproc=lambda
                                     output_img2img_copy_to_clipboard_btn = gr.Button("Copy to clipboard")
                                     output_img2img_copy_to_input_btn = gr.Button("Push to img2img input")
                                     output_img2img_copy_to_mask_btn = gr.Button("Push to img2img input mask")
+                                    output_img2img_full_size_btn = gr.Button("Full size", visible=job_manager is not None)
+                                output_img2img_full_size_link = gr.HTML(visible=False)
+                                output_img2img_clipboard_url = gr.Textbox(visible=False)
 
                                 gr.Markdown("Warning: This will clear your current image and mask settings!")
                             with gr.TabItem("Output info", id="img2img_output_info_tab"):
@@ -254,6 +287,9 @@ def draw_gradio_ui(opt, img2img=lambda x: x, txt2img=lambda x: x, imgproc=lambda
                         img2img_batch_count = gr.Slider(minimum=1, maximum=50, step=1,
                                                         label='Batch count (how many batches of images to generate)',
                                                         value=img2img_defaults['n_iter'])
+                        img2img_batch_size = gr.Slider(minimum=1, maximum=8, step=1,
+                                                       label='Batch size (how many images are in a batch; memory-hungry)',
+                                                       value=img2img_defaults['batch_size'])
                         img2img_dimensions_info_text_box = gr.Textbox(
                             label="Aspect ratio (4:3 = 1.333 | 16:9 = 1.777 | 21:9 = 2.333)")
                     with gr.Column():
@@ -261,12 +297,19 @@ def draw_gradio_ui(opt, img2img=lambda x: x, txt2img=lambda x: x, imgproc=lambda
                                                   value=img2img_defaults['ddim_steps'])
 
                         img2img_sampling = gr.Dropdown(label='Sampling method (k_lms is default k-diffusion sampler)',
-                                                       choices=["DDIM", 'k_dpm_2_a', 'k_dpm_2', 'k_euler_a', 'k_euler',
-                                                                'k_heun', 'k_lms'],
+                                                       choices=img2img_sampler_names,
                                                        value=img2img_defaults['sampler_name'])
 
                         img2img_denoising = gr.Slider(minimum=0.0, maximum=1.0, step=0.01, label='Denoising Strength',
                                                       value=img2img_defaults['denoising_strength'])
+                        img2img_guidance_end = gr.Slider(minimum=0.0, maximum=1.0, step=0.05,
+                                                         label='Guidance end (fraction of steps that use classifier free guidance; later steps are about twice as fast)',
+                                                         value=img2img_defaults['guidance_end'])
+                        img2img_guidance_curve = gr.Dropdown(label='Guidance curve (how the guidance scale falls off towards the end)',
+                                                             choices=['constant', 'linear', 'cosine'],
+                                                             value=img2img_defaults['guidance_curve'])
+                        img2img_use_cache = gr.Checkbox(label='Reuse the results of identical earlier requests',
+                                                        value=img2img_defaults['use_cache'])
 
                         img2img_toggles = gr.CheckboxGroup(label='', choices=img2img_toggles,
                                                            value=img2img_toggle_defaults, type="index")
@@ -300,42 +343,48 @@ def draw_gradio_ui(opt, img2img=lambda x: x, txt2img=lambda x: x, imgproc=lambda
                 # )
 
                 output_txt2img_copy_to_input_btn.click(
-                    uifn.copy_img_to_input,
-                    [output_txt2img_gallery],
+                    partial(uifn.copy_img_to_input, job_manager=job_manager),
+                    [output_txt2img_handles, output_txt2img_gallery],
                     [img2img_image_editor, img2img_image_mask, tabs],
-                    _js=call_JS("moveImageFromGallery",
-                                fromId="txt2img_gallery_output",
-                                toId="img2img_editor")
+                    _js=js_select_gallery_item("txt2img_gallery_output", "img2img_editor")
                 )
 
                 output_img2img_copy_to_input_btn.click(
-                    uifn.copy_img_to_edit,
-                    [output_img2img_gallery],
+                    partial(uifn.copy_img_to_edit, job_manager=job_manager),
+                    [output_img2img_handles, output_img2img_gallery],
                     [img2img_image_editor, tabs, img2img_image_editor_mode],
-                    _js=call_JS("moveImageFromGallery",
-                                fromId="img2img_gallery_output",
-                                toId="img2img_editor")
+                    _js=js_select_gallery_item("img2img_gallery_output", "img2img_editor")
                 )
                 output_img2img_copy_to_mask_btn.click(
-                    uifn.copy_img_to_mask,
-                    [output_img2img_gallery],
+                    partial(uifn.copy_img_to_mask, job_manager=job_manager),
+                    [output_img2img_handles, output_img2img_gallery],
                     [img2img_image_mask, tabs, img2img_image_editor_mode],
-                    _js=call_JS("moveImageFromGallery",
-                                fromId="img2img_gallery_output",
-                                toId="img2img_editor")
+                    _js=js_select_gallery_item("img2img_gallery_output", "img2img_editor")
+                )
+                output_img2img_full_size_btn.click(
+                    partial(uifn.full_size_link, job_manager=job_manager),
+                    [output_img2img_handles, output_img2img_gallery],
+                    [output_img2img_full_size_link],
+                    _js=js_select_gallery_item("img2img_gallery_output")
                 )
 
-                output_img2img_copy_to_clipboard_btn.click(fn=None, inputs=output_img2img_gallery, outputs=[],
-                                                           _js=call_JS("copyImageFromGalleryToClipboard",
-                                                                       fromId="img2img_gallery_output")
-                                                           )
+                # the full size image is looked up on the server, then fetched and copied by the browser
+                output_img2img_copy_to_clipboard_btn.click(
+                    partial(uifn.full_size_url, job_manager=job_manager),
+                    [output_img2img_handles, output_img2img_gallery],
+                    [output_img2img_clipboard_url],
+                    _js=js_select_gallery_item("img2img_gallery_output")
+                )
+                output_img2img_clipboard_url.change(fn=None, inputs=output_img2img_clipboard_url, outputs=[],
+                                                    _js=call_JS("copyImageUrlToClipboard"))
 
                 img2img_func = img2img
                 img2img_inputs = [img2img_prompt, img2img_image_editor_mode, img2img_mask,
                                   img2img_mask_blur_strength, img2img_steps, img2img_sampling, img2img_toggles,
-                                  img2img_realesrgan_model_name, img2img_batch_count, img2img_cfg,
-                                  img2img_denoising, img2img_seed, img2img_height, img2img_width, img2img_resize,
-                                  img2img_image_editor, img2img_image_mask, img2img_embeddings]
+                                  img2img_realesrgan_model_name, img2img_batch_count, img2img_batch_size,
+                                  img2img_cfg, img2img_denoising, img2img_seed, img2img_height, img2img_width, img2img_resize,
+                                  img2img_image_editor, img2img_image_mask, img2img_embeddings,
+                                  img2img_guidance_end, img2img_guidance_curve, img2img_use_cache]
                 img2img_outputs = [output_img2img_gallery, output_img2img_seed, output_img2img_params,
                                    output_img2img_stats]
 
@@ -345,6 +394,7 @@ def draw_gradio_ui(opt, img2img=lambda x: x, txt2img=lambda x: x, imgproc=lambda
                         func=img2img_func,
                         inputs=img2img_inputs,
                         outputs=img2img_outputs,
+                        gallery_handles=output_img2img_handles
                     )
 
                 img2img_btn_mask.click(
@@ -400,6 +450,7 @@ def draw_gradio_ui(opt, img2img=lambda x: x, txt2img=lambda x: x, imgproc=lambda
                                                     max_lines=5)
                         with gr.Row():
                             imgproc_btn = gr.Button("Process", variant="primary")
+                        imgproc_job_ui = job_manager.draw_gradio_ui() if job_manager else None
                         gr.HTML("""
         <div id="90" style="max-width: 100%; font-size: 14px; text-align: center;" class="output-markdown gr-prose border-solid border border-gray-200 rounded gr-panel">
             <p><b>Upscale Modes Guide</b></p>
@@ -504,8 +555,7 @@ def draw_gradio_ui(opt, img2img=lambda x: x, txt2img=lambda x: x, imgproc=lambda
                                                                     visible=RealESRGAN is not None)
                                         imgproc_sampling = gr.Dropdown(
                                             label='Sampling method (k_lms is default k-diffusion sampler)',
-                                            choices=["DDIM", 'k_dpm_2_a', 'k_dpm_2', 'k_euler_a', 'k_euler',
-                                                     'k_heun', 'k_lms'],
+                                            choices=img2img_sampler_names,
                                             value=imgproc_defaults['sampler_name'], visible=RealESRGAN is not None)
                                         imgproc_steps = gr.Slider(minimum=1, maximum=250, step=1,
                                                                   label="Sampling Steps",
@@ -529,15 +579,27 @@ def draw_gradio_ui(opt, img2img=lambda x: x, txt2img=lambda x: x, imgproc=lambda
                                                                   max_lines=1,
                                                                   value=imgproc_defaults["seed"],
                                                                   visible=RealESRGAN is not None)
+                                        imgproc_func = imgproc
+                                        imgproc_inputs = [imgproc_source, imgproc_folder, imgproc_prompt, imgproc_toggles,
+                                                          imgproc_upscale_toggles, imgproc_realesrgan_model_name, imgproc_sampling,
+                                                          imgproc_steps, imgproc_height,
+                                                          imgproc_width, imgproc_cfg, imgproc_denoising, imgproc_seed,
+                                                          imgproc_gfpgan_strength, imgproc_ldsr_steps, imgproc_ldsr_pre_downSample,
+                                                          imgproc_ldsr_post_downSample]
+                                        imgproc_outputs = [imgproc_output]
+
+                                        # With a JobManager, batch results show up in the gallery as they are done
+                                        if imgproc_job_ui:
+                                            imgproc_func, imgproc_inputs, imgproc_outputs = imgproc_job_ui.wrap_func(
+                                                func=imgproc_func,
+                                                inputs=imgproc_inputs,
+                                                outputs=imgproc_outputs
+                                            )
+
                                         imgproc_btn.click(
-                                            imgproc,
-                                            [imgproc_source, imgproc_folder, imgproc_prompt, imgproc_toggles,
-                                             imgproc_upscale_toggles, imgproc_realesrgan_model_name, imgproc_sampling,
-                                             imgproc_steps, imgproc_height,
-                                             imgproc_width, imgproc_cfg, imgproc_denoising, imgproc_seed,
-                                             imgproc_gfpgan_strength, imgproc_ldsr_steps, imgproc_ldsr_pre_downSample,
-                                             imgproc_ldsr_post_downSample],
-                                            [imgproc_output])
+                                            imgproc_func,
+                                            imgproc_inputs,
+                                            imgproc_outputs)
 
                                         imgproc_source.change(
                                             uifn.get_png_nfo,
@@ -552,12 +614,10 @@ def draw_gradio_ui(opt, img2img=lambda x: x, txt2img=lambda x: x, imgproc=lambda
                                 )
 
                                 output_txt2img_to_imglab.click(
-                                    fn=uifn.copy_img_to_lab,
-                                    inputs=[output_txt2img_gallery],
+                                    fn=partial(uifn.copy_img_to_lab, job_manager=job_manager),
+                                    inputs=[output_txt2img_handles, output_txt2img_gallery],
                                     outputs=[imgproc_source, tabs],
-                                    _js=call_JS("moveImageFromGallery",
-                                                fromId="txt2img_gallery_output",
-                                                toId="imglab_input")
+                                    _js=js_select_gallery_item("txt2img_gallery_output", "imglab_input")
                                 )
                                 if RealESRGAN is None:
                                     with gr.Row():
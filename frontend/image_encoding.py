@@ -0,0 +1,126 @@
+''' Encoding profiles for saved samples and grids, and a thread pool to encode them off the generation path.
+    Profiles are given as NAME[:QUALITY]:
+        png             lossless PNG, zlib level 6 (Pillow's default)
+        png-fast        lossless PNG, zlib level 1; larger files, several times faster to write
+        jpg:QUALITY     JPEG at QUALITY (1-100, default 100), without the slow optimize pass
+        webp:QUALITY    lossy WebP at QUALITY (default 100)
+        webp-lossless   lossless WebP; webp:-EFFORT also selects it, with EFFORT as the compression effort '''
+from __future__ import annotations
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+import json
+import os
+import time
+
+PROFILE_NAMES = ('png', 'png-fast', 'jpg', 'webp', 'webp-lossless')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.webp')
+EXIF_IMAGE_DESCRIPTION = 0x010E
+
+
+@dataclass(frozen=True)
+class EncodingProfile:
+    name: str
+    format: str
+    ext: str
+    options: Dict = field(default_factory=dict)
+
+    def filename(self, path: str) -> str:
+        return f"{path}.{self.ext}"
+
+    @property
+    def lossless(self) -> bool:
+        return self.format == 'png' or self.options.get('lossless', False)
+
+    def save(self, image: Image.Image, path: str, metadata: Optional[Dict[str, str]] = None) -> str:
+        ''' Writes image to path plus the profile's extension and returns the file name.
+            Metadata goes into PNG text chunks, or as a JSON object into the EXIF image description for JPEG and
+            WebP, under the same keys either way. '''
+        filename = self.filename(path)
+        options = dict(self.options)
+        if metadata:
+            if self.format == 'png':
+                info = PngInfo()
+                for key, value in metadata.items():
+                    info.add_text(key, str(value))
+                options['pnginfo'] = info
+            else:
+                exif = Image.Exif()
+                # json escapes non-ASCII characters, which EXIF strings can't hold
+                exif[EXIF_IMAGE_DESCRIPTION] = json.dumps({key: str(value) for key, value in metadata.items()})
+                options['exif'] = exif.tobytes()
+        if self.format == 'jpeg' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.save(filename, self.format, **options)
+        return filename
+
+
+def parse_profile(spec: str) -> EncodingProfile:
+    name, _, quality = spec.strip().lower().partition(':')
+    quality = int(quality) if quality else None
+    if name == 'png':
+        return EncodingProfile(spec, 'png', 'png', {'compress_level': 6})
+    if name == 'png-fast':
+        return EncodingProfile(spec, 'png', 'png', {'compress_level': 1})
+    if name in ('jpg', 'jpeg'):
+        return EncodingProfile(spec, 'jpeg', 'jpg', {'quality': 100 if quality is None else quality})
+    if name == 'webp' and (quality is None or quality >= 0):
+        return EncodingProfile(spec, 'webp', 'webp', {'quality': 100 if quality is None else quality})
+    if name in ('webp', 'webp-lossless'):
+        return EncodingProfile(spec, 'webp', 'webp', {'lossless': True, 'quality': 100 if quality is None else abs(quality)})
+    raise ValueError(f"Unknown image format '{spec}', expected one of {', '.join(PROFILE_NAMES)}")
+
+
+class ImageEncoder:
+    ''' Encodes images on a thread pool. Pillow releases the GIL while encoding, so the samples and the grid of a
+        batch are written in parallel, and generation can continue while they are. '''
+
+    def __init__(self, threads: int = 4):
+        self._pool = ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix='image-encoder')
+
+    def submit(self, profile: EncodingProfile, image: Image.Image, path: str,
+               metadata: Optional[Dict[str, str]] = None, exclusive: bool = False) -> Future:
+        ''' Queues image to be written to path plus the profile's extension. An empty file is created right away,
+            so sequence numbers derived from the directory listing already account for it. With exclusive, the file
+            must not exist yet: FileExistsError is raised instead of overwriting it. '''
+        filename = profile.filename(path)
+        open(filename, 'xb' if exclusive else 'wb').close()
+
+        def remove_placeholder() -> None:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        try:
+            future = self._pool.submit(profile.save, image, path, metadata)
+        except BaseException:
+            remove_placeholder()
+            raise
+        future.add_done_callback(lambda f: (f.cancelled() or f.exception() is not None) and remove_placeholder())
+        return future
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=True)
+
+
+def remove_stale_placeholders(directory: str, min_age: float = 600.0) -> int:
+    ''' Removes the empty image files under directory left behind by a process that died before encoding them.
+        Only files older than min_age seconds are removed, as another running process may still be writing the
+        newer ones. Returns the number of files removed. '''
+    removed = 0
+    cutoff = time.time() - min_age
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if not name.endswith(IMAGE_EXTENSIONS):
+                continue
+            filename = os.path.join(root, name)
+            try:
+                stat = os.stat(filename)
+                if stat.st_size == 0 and stat.st_mtime < cutoff:
+                    os.remove(filename)
+                    removed += 1
+            except OSError:
+                pass
+    return removed
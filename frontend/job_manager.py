@@ -2,11 +2,16 @@
 from __future__ import annotations
 import gradio as gr
 from gradio.components import Component, Gallery
-from threading import Event, Timer
-from typing import Callable, List, Dict, Tuple, Optional, Any
+from threading import Event, Condition, Thread
+from typing import Callable, List, Dict, Tuple, Optional, Any, Deque
 from dataclasses import dataclass, field
+from collections import deque
 from functools import partial
 from PIL.Image import Image
+from frontend.result_store import ResultStore, ResultImages
+import atexit
+import itertools
+import time
 import uuid
 import traceback
 
@@ -29,11 +34,21 @@ class JobInfo:
     func: Callable
     session_key: str
     job_token: Optional[int] = None
+    # Either a plain list or a ResultImages collection backed by the JobManager's ResultStore
     images: List[Image] = field(default_factory=list)
     should_stop: Event = field(default_factory=Event)
     job_status: str = field(default_factory=str)
     finished: bool = False
     removed_output_idxs: List[int] = field(default_factory=list)
+    priority: int = 0
+    # Progress in sampling steps (steps * images), reported by the job function and used for ETAs
+    total_steps: int = 0
+    completed_steps: int = 0
+    start_time: Optional[float] = None
+    finish_time: Optional[float] = None
+    # Last time the job's browser asked for its status (the page asks until the job starts); queued jobs whose
+    # browser went away are dropped
+    last_seen: float = field(default_factory=time.time)
 
 
 @dataclass
@@ -42,9 +57,115 @@ class SessionInfo:
     finished_jobs: Dict[FuncKey, JobInfo] = field(default_factory=dict)
 
 
-@dataclass
+@dataclass(eq=False)
 class QueueItem:
-    wait_event: Event
+    job_info: JobInfo
+    seq: int
+    cancelled: bool = False
+
+
+class JobScheduler:
+    ''' Hands out job tokens to waiting jobs. Waiters block on a condition variable instead of polling.
+        Higher priority jobs go first; jobs of equal priority are served round-robin across sessions,
+        and FIFO within a session. Waiters not seen by their browser for waiter_timeout seconds leave the queue '''
+
+    def __init__(self, max_jobs: int, waiter_timeout: Optional[float] = None):
+        self._cond = Condition()
+        self._waiter_timeout = waiter_timeout
+        self._avail_job_tokens: List[int] = list(range(max_jobs))
+        self._queues: Dict[str, Deque[QueueItem]] = {}
+        # Sessions in the order they should next be served, least recently served first
+        self._session_order: Deque[str] = deque()
+        self._seq = itertools.count()
+
+    @property
+    def lock(self) -> Condition:
+        ''' The scheduler's (reentrant) lock, also guarding the JobManager's sessions '''
+        return self._cond
+
+    def would_queue(self) -> bool:
+        ''' Whether a job submitted now would have to wait '''
+        with self._cond:
+            return not self._avail_job_tokens or any(self._queues.values())
+
+    def acquire(self, job_info: JobInfo) -> Optional[int]:
+        ''' Blocks until the job is first in line and a token is free.
+            Returns None if the job was cancelled while waiting '''
+        with self._cond:
+            item = QueueItem(job_info=job_info, seq=next(self._seq))
+            self._queues.setdefault(job_info.session_key, deque()).append(item)
+            if job_info.session_key not in self._session_order:
+                self._session_order.append(job_info.session_key)
+
+            while True:
+                if item.cancelled or job_info.should_stop.is_set() or self._abandoned(job_info):
+                    # Abandoned waiter, e.g. stopped while queued. Leave the line and let the next one check
+                    self._remove(item)
+                    self._cond.notify_all()
+                    return None
+                if self._avail_job_tokens and self._next_item() is item:
+                    self._remove(item)
+                    self._session_order.remove(job_info.session_key)
+                    self._session_order.append(job_info.session_key)
+                    token = self._avail_job_tokens.pop()
+                    job_info.job_status = ""
+                    self._cond.notify_all()
+                    return token
+                job_info.job_status = "Job is queued"
+                # Wake up now and then to notice waiters whose browser stopped polling
+                self._cond.wait(self._waiter_timeout / 4 if self._waiter_timeout else None)
+
+    def release(self, token: int) -> None:
+        ''' Returns a job token and wakes up the waiters '''
+        with self._cond:
+            self._avail_job_tokens.append(token)
+            self._cond.notify_all()
+
+    def wake(self) -> None:
+        ''' Wakes up waiters so they can notice that they were stopped '''
+        with self._cond:
+            self._cond.notify_all()
+
+    def queued_jobs(self) -> List[JobInfo]:
+        ''' Returns the queued jobs in the order they will be served '''
+        with self._cond:
+            queues = {key: deque(q) for key, q in self._queues.items()}
+            order = deque(self._session_order)
+            result = []
+            while True:
+                item = self._pick(queues, order)
+                if item is None:
+                    return result
+                result.append(item.job_info)
+                queues[item.job_info.session_key].popleft()
+                order.remove(item.job_info.session_key)
+                order.append(item.job_info.session_key)
+
+    def _abandoned(self, job_info: JobInfo) -> bool:
+        return self._waiter_timeout is not None and time.time() - job_info.last_seen > self._waiter_timeout
+
+    def _next_item(self) -> Optional[QueueItem]:
+        return self._pick(self._queues, self._session_order)
+
+    @staticmethod
+    def _pick(queues: Dict[str, Deque[QueueItem]], order: Deque[str]) -> Optional[QueueItem]:
+        best = None
+        for session_key in order:
+            queue = queues.get(session_key)
+            if not queue:
+                continue
+            if best is None or queue[0].job_info.priority > best.job_info.priority:
+                best = queue[0]
+        return best
+
+    def _remove(self, item: QueueItem) -> None:
+        queue = self._queues.get(item.job_info.session_key)
+        if queue is not None and item in queue:
+            queue.remove(item)
+        if not queue:
+            self._queues.pop(item.job_info.session_key, None)
+            if item.job_info.session_key in self._session_order:
+                self._session_order.remove(item.job_info.session_key)
 
 
 def triggerChangeEvent():
@@ -57,7 +178,9 @@ class JobManagerUi:
             self,
             func: Callable,
             inputs: List[Component],
-            outputs: List[Component]) -> Tuple[Callable, List[Component], List[Component]]:
+            outputs: List[Component],
+            priority: int = 0,
+            gallery_handles: Optional[gr.JSON] = None) -> Tuple[Callable, List[Component], List[Component]]:
         ''' Takes a gradio event listener function and its input/outputs and returns wrapped replacements which will
             be managed by JobManager
         Parameters:
@@ -66,6 +189,10 @@ class JobManagerUi:
                         be used by the function to check for stop events and to store intermediate image results
         inputs (List[Component]) the original inputs
         outputs (List[Component]) the original outputs. The first gallery, if any, will be used for refreshing images
+        priority (int, optional) jobs with a higher priority are started before queued jobs with a lower one
+        gallery_handles (gr.JSON, optional) receives the result store handles of the gallery images. The gallery
+                        itself only receives thumbnails; the handles can be passed to load_result_image to get
+                        the full size images
         refresh_btn: (gr.Button, optional) a button to use for updating the gallery with intermediate results
         stop_btn: (gr.Button, optional) a button to use for stopping the function
         status_text: (gr.Textbox) a textbox to display job status updates
@@ -75,7 +202,7 @@ class JobManagerUi:
         replacements for the passed in function, inputs and outputs
         '''
         return self._job_manager._wrap_func(
-            func=func, inputs=inputs, outputs=outputs,
+            func=func, inputs=inputs, outputs=outputs, priority=priority, gallery_handles=gallery_handles,
             refresh_btn=self._refresh_btn, stop_btn=self._stop_btn, status_text=self._status_text
         )
 
@@ -88,12 +215,26 @@ class JobManagerUi:
 
 
 class JobManager:
-    def __init__(self, max_jobs: int):
+    def __init__(self, max_jobs: int, result_memory_budget: int = 1 << 30, result_ttl: float = 3600.0,
+                 result_spill_dir: Optional[str] = None, waiter_timeout: Optional[float] = 300.0):
         self._max_jobs: int = max_jobs
-        self._avail_job_tokens: List[Any] = list(range(max_jobs))
-        self._job_queue: List[QueueItem] = []
+        self._result_store = ResultStore(result_memory_budget, spill_dir=result_spill_dir, stale_after=result_ttl)
+        atexit.register(self._result_store.close)
+        # Seconds after finishing that results of a job not fetched by its browser are kept
+        self._result_ttl: float = result_ttl
+        # Results also expire while no jobs are started or finished
+        Thread(target=self._expire_periodically, name='JobManager result expiry', daemon=True).start()
+        # Queued jobs are dropped when their browser doesn't poll the status for waiter_timeout seconds, so a
+        # closed tab doesn't keep its place. The page polls every few seconds until the job starts, but browsers
+        # throttle background tabs to about once a minute, so keep this well above that. (gradio runs the handlers
+        # without their request, so a closed connection can't be noticed directly)
+        self._scheduler = JobScheduler(max_jobs, waiter_timeout=waiter_timeout)
+        # Guarded by the scheduler's lock; the gradio event handlers run on several threads
         self._sessions: Dict[str, SessionInfo] = {}
         self._session_key: gr.JSON = None
+        # Moving averages of measured seconds per sampling step and of steps per job, for ETAs
+        self._sec_per_step: Optional[float] = None
+        self._steps_per_job: Optional[float] = None
 
     def draw_gradio_ui(self) -> JobManagerUi:
         ''' draws the job manager ui in gradio
@@ -106,7 +247,8 @@ class JobManager:
                 with gr.Row():
                     stop_btn = gr.Button("Stop", elem_id="stop", variant="secondary")
                     refresh_btn = gr.Button("Refresh", elem_id="refresh", variant="secondary")
-                status_text = gr.Textbox(placeholder="Job Status", interactive=False, show_label=False)
+                status_text = gr.Textbox(placeholder="Job Status", interactive=False, show_label=False,
+                                 elem_id="job_status")
             with gr.TabItem("Maintenance"):
                 with gr.Row():
                     gr.Markdown(
@@ -126,46 +268,124 @@ class JobManager:
         ''' Removes all currently finished jobs, across all sessions.
             Useful to free memory if a job is started and the browser is closed
             before it finishes '''
-        for session in self._sessions.values():
-            session.finished_jobs.clear()
+        with self._scheduler.lock:
+            for session in self._sessions.values():
+                for job in session.finished_jobs.values():
+                    self._release_images(job)
+                session.finished_jobs.clear()
+
+    def _release_images(self, job_info: JobInfo) -> None:
+        ''' Frees the stored results of a job '''
+        if isinstance(job_info.images, ResultImages):
+            job_info.images.release()
+
+    def load_result_image(self, handle: str) -> Optional[Image]:
+        ''' Returns the full size result image for a gallery handle, or None if it is no longer stored '''
+        entry = self._result_store.get(handle) if handle else None
+        return self._result_store.load(entry) if entry is not None else None
+
+    def result_image_path(self, handle: str) -> Optional[str]:
+        ''' Returns the path of the full size result image for a gallery handle, writing it to disk if needed '''
+        entry = self._result_store.get(handle) if handle else None
+        return self._result_store.file_path(entry) if entry is not None else None
+
+    def _expire_finished_jobs(self) -> None:
+        ''' Drops finished jobs whose results were not accessed within the TTL '''
+        now = time.time()
+        with self._scheduler.lock:
+            for session_key, session in list(self._sessions.items()):
+                for func_key, job in list(session.finished_jobs.items()):
+                    last_used = job.finish_time
+                    if isinstance(job.images, ResultImages):
+                        last_used = max(last_used or 0.0, job.images.last_access())
+                    if last_used is not None and now - last_used > self._result_ttl:
+                        self._release_images(job)
+                        session.finished_jobs.pop(func_key, None)
+                if not session.jobs and not session.finished_jobs:
+                    self._sessions.pop(session_key, None)
+
+    def _expire_periodically(self) -> None:
+        while True:
+            time.sleep(min(max(self._result_ttl / 4, 1.0), 60.0))
+            self._expire_finished_jobs()
 
     def stop_all_jobs(self):
         ''' Stops all active jobs, across all sessions'''
-        for session in self._sessions.values():
-            for job in session.jobs.values():
-                job.should_stop.set()
-
-    def _get_job_token(self, block: bool = False) -> Optional[int]:
-        ''' Attempts to acquire a job token, optionally blocking until available '''
-        token = None
-        while token is None:
-            try:
-                token = self._avail_job_tokens.pop()
-                break
-            except IndexError:
-                pass
-
-            if not block:
-                break
+        for job in self._active_jobs():
+            job.should_stop.set()
+        self._scheduler.wake()
 
-            # No token and requested to block, so queue up
-            wait_event = Event()
-            self._job_queue.append(QueueItem(wait_event))
-            wait_event.wait()
+    def _active_jobs(self) -> List[JobInfo]:
+        ''' Snapshot of the queued and running jobs of all sessions '''
+        with self._scheduler.lock:
+            return [job for session in self._sessions.values() for job in session.jobs.values()]
 
-        return token
+    def _get_job_token(self, job_info: JobInfo) -> Optional[int]:
+        ''' Blocks until a job token is available. Returns None if the job was stopped while queued '''
+        return self._scheduler.acquire(job_info)
 
     def _release_job_token(self, token: int) -> None:
         ''' Returns a job token to allow another job to start '''
-        self._avail_job_tokens.append(token)
-        self._run_queued_jobs()
+        self._scheduler.release(token)
+
+    def _record_job_stats(self, job_info: JobInfo) -> None:
+        ''' Updates the throughput averages from a finished job '''
+        if job_info.start_time is None or job_info.completed_steps <= 0:
+            return
+        alpha = 0.3
+        sec_per_step = (time.time() - job_info.start_time) / job_info.completed_steps
+        self._sec_per_step = sec_per_step if self._sec_per_step is None else \
+            alpha * sec_per_step + (1 - alpha) * self._sec_per_step
+        steps = job_info.total_steps or job_info.completed_steps
+        self._steps_per_job = steps if self._steps_per_job is None else \
+            alpha * steps + (1 - alpha) * self._steps_per_job
+
+    def _remaining_seconds(self, job_info: JobInfo) -> Optional[float]:
+        ''' Estimated time left for a running job '''
+        sec_per_step = self._sec_per_step
+        if job_info.completed_steps > 0 and job_info.start_time is not None:
+            # Prefer the job's own measured speed, it reflects its resolution and batch size
+            sec_per_step = (time.time() - job_info.start_time) / job_info.completed_steps
+        if sec_per_step is None or not job_info.total_steps:
+            return None
+        return max(job_info.total_steps - job_info.completed_steps, 0) * sec_per_step
+
+    def _queue_status(self, job_info: JobInfo) -> str:
+        ''' Returns the queue position and ETA of a queued job '''
+        queued = self._scheduler.queued_jobs()
+        position = next((idx for idx, job in enumerate(queued) if job is job_info), None)
+        if position is None:
+            return "Job is queued"
+        status = f"Job is queued: position {position + 1} of {len(queued)}"
+
+        if self._sec_per_step is None or self._steps_per_job is None:
+            return status
+        running = [job for job in self._active_jobs() if job.job_token is not None and not job.finished]
+        remaining = [self._remaining_seconds(job) for job in running]
+        remaining = [r if r is not None else self._steps_per_job * self._sec_per_step for r in remaining]
+        ahead = sum(remaining) + position * self._steps_per_job * self._sec_per_step
+        # Jobs run concurrently on all job slots
+        eta = ahead / max(self._max_jobs, 1)
+        return f"{status}, starting in about {round(eta)}s"
+
+    def _job_status(self, job_info: JobInfo) -> str:
+        ''' Status text for a job, with queue position or ETA '''
+        if job_info.job_token is None and not job_info.finished:
+            return self._queue_status(job_info)
+        status = job_info.job_status
+        if not job_info.finished:
+            remaining = self._remaining_seconds(job_info)
+            if remaining is not None:
+                status = f"ETA: about {round(remaining)}s\n{status}"
+        return status
 
     def _refresh_func(self, func_key: FuncKey, session_key: str) -> List[Component]:
         ''' Updates information from the active job '''
         session_info, job_info = self._get_call_info(func_key, session_key)
         if job_info is None:
             return [None, f"Session {session_key} was not running function {func_key}"]
-        return [triggerChangeEvent(), job_info.job_status]
+        job_info.last_seen = time.time()
+        return [triggerChangeEvent(), self._job_status(job_info)]
 
     def _stop_wrapped_func(self, func_key: FuncKey, session_key: str) -> List[Component]:
         ''' Marks that the job should be stopped'''
@@ -173,38 +393,28 @@ class JobManager:
         if job_info is None:
             return f"Session {session_key} was not running function {func_key}"
         job_info.should_stop.set()
+        if job_info.job_token is None:
+            self._scheduler.wake()
+            return "Removing job from the queue"
         return "Stopping after current batch finishes"
 
     def _get_call_info(self, func_key: FuncKey, session_key: str) -> Tuple[SessionInfo, JobInfo]:
         ''' Helper to get the SessionInfo and JobInfo. '''
-        session_info = self._sessions.get(session_key, None)
-        if not session_info:
-            print(f"Couldn't find session {session_key} for call to {func_key}")
-            return None, None
-
-        job_info = session_info.jobs.get(func_key, None)
-        if not job_info:
-            job_info = session_info.finished_jobs.get(func_key, None)
+        with self._scheduler.lock:
+            session_info = self._sessions.get(session_key, None)
+            if not session_info:
+                print(f"Couldn't find session {session_key} for call to {func_key}")
+                return None, None
+
+            job_info = session_info.jobs.get(func_key, None)
+            if not job_info:
+                job_info = session_info.finished_jobs.get(func_key, None)
         if not job_info:
             print(f"Couldn't find job {func_key} in session {session_key}")
             return session_info, None
 
         return session_info, job_info
 
-    def _run_queued_jobs(self) -> None:
-        ''' Runs queued jobs for any available slots '''
-        if self._avail_job_tokens:
-            try:
-                # Notify next queued job it may begin
-                queue_item = self._job_queue.pop(0)
-                queue_item.wait_event.set()
-
-                # Check again in a few seconds, just in case the queued
-                # waiter closed the browser while still queued
-                Timer(3.0, self._run_queued_jobs).start()
-            except IndexError:
-                pass  # No queued jobs
-
     def _pre_call_func(
             self, func_key: FuncKey, output_dummy_obj: Component, refresh_btn: gr.Button, stop_btn: gr.Button,
             status_text: gr.Textbox, session_key: str) -> List[Component]:
@@ -213,7 +423,7 @@ class JobManager:
 
         # If we didn't already get a token then queue up for one
         if job_info.job_token is None:
-            job_info.token = self._get_job_token(block=True)
+            job_info.job_token = self._get_job_token(job_info)
 
         # Buttons don't seem to update unless value is set on them as well...
         return {output_dummy_obj: triggerChangeEvent(),
@@ -228,12 +438,18 @@ class JobManager:
         if session_info is None or job_info is None:
             return []
 
-        try:
-            outputs = job_info.func(*job_info.inputs, job_info=job_info)
-        except Exception as e:
-            job_info.job_status = f"Error: {e}"
-            print(f"Exception processing job {job_info}: {e}\n{traceback.format_exc()}")
+        if job_info.job_token is None:
+            # Stopped while still queued
+            job_info.job_status = "Job was removed from the queue"
             outputs = []
+        else:
+            job_info.start_time = time.time()
+            try:
+                outputs = job_info.func(*job_info.inputs, job_info=job_info)
+            except Exception as e:
+                job_info.job_status = f"Error: {e}"
+                print(f"Exception processing job {job_info}: {e}\n{traceback.format_exc()}")
+                outputs = []
 
         # Filter the function output for any removed outputs
         filtered_output = []
@@ -242,9 +458,18 @@ class JobManager:
                 filtered_output.append(output)
 
         job_info.finished = True
-        session_info.finished_jobs[func_key] = session_info.jobs.pop(func_key)
-
-        self._release_job_token(job_info.job_token)
+        job_info.finish_time = time.time()
+        with self._scheduler.lock:
+            # The gallery is about to show this job's results, so the previous run's results are no longer reachable
+            previous_job = session_info.finished_jobs.get(func_key)
+            if previous_job is not None:
+                self._release_images(previous_job)
+            session_info.finished_jobs[func_key] = session_info.jobs.pop(func_key)
+
+        if job_info.job_token is not None:
+            self._record_job_stats(job_info)
+            self._release_job_token(job_info.job_token)
+        self._expire_finished_jobs()
 
         # The wrapper added a dummy JSON output. Append a random text string
         # to fire the dummy objects 'change' event to notify that the job is done
@@ -262,22 +487,25 @@ class JobManager:
                 status_text: gr.Textbox.update(value="Generation has finished!")
                 }
 
-    def _update_gallery_event(self, func_key: FuncKey, session_key: str) -> List[Component]:
+    def _update_gallery_event(self, func_key: FuncKey, with_handles: bool, session_key: str) -> List[Component]:
         ''' Updates the gallery with results from the given job.
-            Frees the images after return if the job is finished.
+            The gallery gets thumbnails, and the handles object (if any) the keys of the full size images.
+            Finished jobs are kept until their results expire so the handles stay valid.
             Triggered by changing the update_gallery_obj dummy object '''
         session_info, job_info = self._get_call_info(func_key, session_key)
         if session_info is None or job_info is None:
-            return []
+            return ([], []) if with_handles else []
 
-        if job_info.finished:
-            session_info.finished_jobs.pop(func_key)
+        if isinstance(job_info.images, ResultImages):
+            images, handles = job_info.images.thumbnails(), job_info.images.handles()
+        else:
+            images, handles = list(job_info.images), []
 
-        return job_info.images
+        return (images, handles) if with_handles else images
 
     def _wrap_func(
-            self, func: Callable, inputs: List[Component], outputs: List[Component],
-            refresh_btn: gr.Button = None, stop_btn: gr.Button = None,
+            self, func: Callable, inputs: List[Component], outputs: List[Component], priority: int = 0,
+            gallery_handles: Optional[gr.JSON] = None, refresh_btn: gr.Button = None, stop_btn: gr.Button = None,
             status_text: Optional[gr.Textbox] = None) -> Tuple[Callable, List[Component]]:
         ''' handles JobManageUI's wrap_func'''
 
@@ -308,9 +536,9 @@ class JobManager:
         # Create dummy objects
         update_gallery_obj = gr.JSON(visible=False, elem_id="JobManagerDummyObject")
         update_gallery_obj.change(
-            partial(self._update_gallery_event, func_key),
+            partial(self._update_gallery_event, func_key, gallery_handles is not None),
             [self._session_key],
-            [gallery_comp]
+            [gallery_comp] + ([gallery_handles] if gallery_handles is not None else [])
         )
 
         if refresh_btn:
@@ -375,21 +603,29 @@ class JobManager:
             session_key = inputs[-1]
             inputs = inputs[:-1]
 
-            # Get or create a session for this key
-            session_info = self._sessions.setdefault(session_key, SessionInfo())
+            self._expire_finished_jobs()
+
+            with self._scheduler.lock:
+                # Get or create a session for this key
+                session_info = self._sessions.setdefault(session_key, SessionInfo())
 
-            # Is this session already running this job?
-            if func_key in session_info.jobs:
-                return {status_text: "This session is already running that function!"}
+                # Is this session already running this job?
+                if func_key in session_info.jobs:
+                    return {status_text: "This session is already running that function!"}
 
-            job_token = self._get_job_token(block=False)
-            job = JobInfo(inputs=inputs, func=func, removed_output_idxs=removed_idxs, session_key=session_key,
-                          job_token=job_token)
-            session_info.jobs[func_key] = job
+                # Tokens are only handed out when the job actually starts (in the 'pre' call), so a browser
+                # that is closed before then cannot hold on to one
+                job = JobInfo(inputs=inputs, func=func, removed_output_idxs=removed_idxs, session_key=session_key,
+                              priority=priority, images=ResultImages(self._result_store))
+                session_info.jobs[func_key] = job
 
+            # The page polls the status while it starts with "Job is queued" or "Job is starting", which keeps the
+            # job in the queue even if it only has to wait after losing the race for a free token
             ret = {pre_call_dummyobj: triggerChangeEvent()}
-            if job_token is None:
-                ret[status_text] = "Job is queued"
+            if self._scheduler.would_queue():
+                ret[status_text] = "Job is queued. Click 'Refresh' for its position"
+            else:
+                ret[status_text] = "Job is starting"
             return ret
 
         return wrapped_func, inputs, [pre_call_dummyobj, status_text]
@@ -102,6 +102,9 @@ window.SD = (() => {
     get (selector) {
       return this.root.querySelector(selector);
     }
+    getAll (selector) {
+      return this.root.querySelectorAll(selector);
+    }
   }
 
   /*
@@ -111,6 +114,10 @@ window.SD = (() => {
   class SDClass {
     el = new ElementCache();
     Painterro = PainterroClass;
+    constructor () {
+      // The server drops queued jobs whose page stopped asking for their status (e.g. the tab was closed)
+      setInterval(() => this.#pollQueuedJobs(), 5000);
+    }
     moveImageFromGallery ({ x, fromId, toId }) {
       if (!Array.isArray(x) || x.length === 0) return;
 
@@ -120,6 +127,19 @@ window.SD = (() => {
 
       return [x[i].replace('data:;','data:image/png;')];
     }
+    selectGalleryItem ({ handles, gallery, fromId, toId }) {
+      if (!Array.isArray(gallery) || gallery.length === 0) return [null, null];
+
+      if (toId) this.clearImageInput(this.el.get(`#${toId}`));
+
+      const i = this.#getGallerySelectedIndex(this.el.get(`#${fromId}`));
+
+      // The gallery only holds thumbnails when the server keeps the full size images;
+      // send the handle instead of uploading pixels back to the server
+      if (Array.isArray(handles) && handles.length === gallery.length) return [handles[i], null];
+
+      return [null, gallery[i].replace('data:;','data:image/png;')];
+    }
     async copyImageFromGalleryToClipboard ({ x, fromId }) {
       if (!Array.isArray(x) || x.length === 0) return;
 
@@ -131,6 +151,20 @@ window.SD = (() => {
 
       await this.copyToClipboard([item]);
     }
+    async copyImageUrlToClipboard ({ x }) {
+      if (!x) return;
+
+      const blob = await (await fetch(x.replace('data:;','data:image/png;'))).blob();
+      // the full size file may be WebP, the clipboard takes PNG
+      const bitmap = await createImageBitmap(blob);
+      const canvas = document.createElement('canvas');
+      canvas.width = bitmap.width;
+      canvas.height = bitmap.height;
+      canvas.getContext('2d').drawImage(bitmap, 0, 0);
+      const png = await new Promise((resolve) => canvas.toBlob(resolve, 'image/png'));
+
+      await this.copyToClipboard([new ClipboardItem({'image/png': png})]);
+    }
     clickFirstVisibleButton({ rowId }) {
       const generateButtons = this.el.get(`#${rowId}`).querySelectorAll('.gr-button-primary');
 
@@ -173,6 +207,17 @@ window.SD = (() => {
     clearImageInput (imageEditor) {
       imageEditor?.querySelector('.modify-upload button:last-child')?.click();
     }
+    #pollQueuedJobs () {
+      for (const status of this.el.getAll('#job_status textarea')) {
+        // Until the job starts: a job can also end up queued after being submitted as starting
+        if (!/^Job is (queued|starting)/.test(status.value)) continue;
+
+        // The Refresh button of the same job manager ui
+        let parent = status.parentElement;
+        while (parent && !parent.querySelector('#refresh')) parent = parent.parentElement;
+        parent?.querySelector('#refresh').click();
+      }
+    }
     #getGallerySelectedIndex (gallery) {
       const selected = gallery.querySelector(`.\\!ring-2`);
       return selected ? [...selected.parentNode.children].indexOf(selected) : 0;
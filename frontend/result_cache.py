@@ -0,0 +1,185 @@
+''' Content-addressed cache of finished generations.
+    Results are stored on disk under a hash of everything that determines them, within a size budget with least
+    recently used eviction. Identical requests which arrive while the first one is still running wait for it
+    instead of running the pipeline again. '''
+from __future__ import annotations
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from threading import Event, Lock
+from typing import Any, Dict, List, Optional
+from PIL import Image
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+
+@dataclass
+class CachedResult:
+    # One dict per generated sample: its images by file name suffix, '' for the sample itself and e.g. '-gfpgan'
+    # for an upscaled or restored variant. A cache hit writes them again under the new request's file settings
+    samples: List[Dict[str, Image.Image]]
+    seed: Any
+    info: Any
+    stats: str
+
+
+@dataclass(eq=False)
+class _InFlight:
+    done: Event = field(default_factory=Event)
+
+
+def _update(h, value) -> None:
+    if isinstance(value, Image.Image):
+        h.update(f"image:{value.mode}:{value.size}:".encode())
+        h.update(value.tobytes())
+    elif isinstance(value, (bytes, bytearray)):
+        h.update(b"bytes:")
+        h.update(value)
+    elif isinstance(value, dict):
+        h.update(b"dict:")
+        for k in sorted(value, key=str):
+            _update(h, str(k))
+            _update(h, value[k])
+    elif isinstance(value, (list, tuple)):
+        h.update(f"list:{len(value)}:".encode())
+        for item in value:
+            _update(h, item)
+    else:
+        h.update(f"{type(value).__name__}:{value!r};".encode())
+
+
+class ResultCache:
+    ''' On-disk store of CachedResults keyed by ResultCache.key(...). Each entry is a directory holding its images
+        as PNG files named by sample index and suffix, and a meta.json; the modification time of meta.json is the
+        entry's last access. '''
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = Lock()
+        # key -> size in bytes, least recently used first
+        self._entries: Dict[str, int] = OrderedDict()
+        self._bytes = 0
+        self._inflight: Dict[str, _InFlight] = {}
+        self._scan()
+
+    @staticmethod
+    def key(*parts) -> str:
+        ''' Hash of parts; images are hashed by their pixels, dicts independently of their order '''
+        h = hashlib.sha256()
+        for part in parts:
+            _update(h, part)
+        return h.hexdigest()
+
+    def claim(self, key: str) -> Optional[CachedResult]:
+        ''' Returns the stored result for key. If there is none, returns None and the caller has to compute the
+            result and hand it to finish(); while it does, other claims of the same key wait for it. '''
+        while True:
+            with self._lock:
+                inflight = self._inflight.get(key)
+                if inflight is None:
+                    if key in self._entries:
+                        self._entries.move_to_end(key)
+                        cached = key
+                    else:
+                        self._inflight[key] = _InFlight()
+                        return None
+            if inflight is not None:
+                # the result may turn out to be uncacheable (e.g. a cancelled job), then claim again
+                inflight.done.wait()
+                continue
+            result = self._load(cached)
+            if result is not None:
+                return result
+
+    def finish(self, key: str, result: Optional[CachedResult]) -> None:
+        ''' Stores the result of a claim that returned None; None if it must not be cached '''
+        try:
+            if result is not None:
+                self._store(key, result)
+        finally:
+            with self._lock:
+                inflight = self._inflight.pop(key)
+            inflight.done.set()
+
+    def size(self) -> int:
+        return self._bytes
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def _scan(self) -> None:
+        found = []
+        for key in os.listdir(self.directory):
+            path = self._path(key)
+            meta = os.path.join(path, 'meta.json')
+            if key.endswith('.tmp') or not os.path.isfile(meta):
+                # left over from an interrupted write
+                shutil.rmtree(path, ignore_errors=True)
+                continue
+            nbytes = sum(entry.stat().st_size for entry in os.scandir(path))
+            found.append((os.path.getmtime(meta), key, nbytes))
+        for _, key, nbytes in sorted(found):
+            self._entries[key] = nbytes
+            self._bytes += nbytes
+        with self._lock:
+            self._evict()
+
+    def _load(self, key: str) -> Optional[CachedResult]:
+        path = self._path(key)
+        try:
+            meta_path = os.path.join(path, 'meta.json')
+            with open(meta_path, encoding='utf8') as f:
+                meta = json.load(f)
+            samples = []
+            for i, suffixes in enumerate(meta['samples']):
+                sample = {}
+                for suffix in suffixes:
+                    with Image.open(os.path.join(path, f"{i}{suffix}.png")) as image:
+                        image.load()
+                        sample[suffix] = image.copy()
+                samples.append(sample)
+            os.utime(meta_path)
+        except (OSError, ValueError, KeyError, TypeError):
+            # removed by eviction in the meantime, damaged, or written by an older version
+            with self._lock:
+                nbytes = self._entries.pop(key, None)
+                if nbytes is not None:
+                    self._bytes -= nbytes
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+        return CachedResult(samples, meta['seed'], meta['info'], meta['stats'])
+
+    def _store(self, key: str, result: CachedResult) -> None:
+        # written to a temporary directory first, so an entry is either complete or absent
+        tmp = self._path(f"{key}.{uuid.uuid4().hex}.tmp")
+        os.makedirs(tmp)
+        try:
+            for i, sample in enumerate(result.samples):
+                for suffix, image in sample.items():
+                    image.save(os.path.join(tmp, f"{i}{suffix}.png"), compress_level=1)
+            with open(os.path.join(tmp, 'meta.json'), 'w', encoding='utf8') as f:
+                json.dump({'samples': [list(sample) for sample in result.samples], 'seed': result.seed,
+                           'info': result.info, 'stats': result.stats}, f)
+            nbytes = sum(entry.stat().st_size for entry in os.scandir(tmp))
+            with self._lock:
+                if key in self._entries:
+                    shutil.rmtree(tmp, ignore_errors=True)
+                    return
+                os.replace(tmp, self._path(key))
+                self._entries[key] = nbytes
+                self._bytes += nbytes
+                self._evict()
+        except (OSError, TypeError, ValueError) as e:
+            print(f"Could not store result in the cache: {e}")
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def _evict(self) -> None:
+        # Called with the lock held
+        while self._bytes > self.max_bytes and self._entries:
+            key, nbytes = self._entries.popitem(last=False)
+            self._bytes -= nbytes
+            shutil.rmtree(self._path(key), ignore_errors=True)
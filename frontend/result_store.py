@@ -0,0 +1,256 @@
+''' Keeps the images produced by jobs within a memory budget, spilling full size images to disk.
+    Small WebP thumbnails are written for every image so galleries do not need to ship full size images. '''
+from __future__ import annotations
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from threading import Lock
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+from PIL import Image
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+
+@dataclass(eq=False)
+class StoredImage:
+    key: str
+    thumbnail_path: str
+    size: Tuple[int, int]
+    nbytes: int
+    created: float = field(default_factory=time.time)
+    last_access: float = field(default_factory=time.time)
+    # The full image while it is held in RAM, and/or the PNG file it was written to
+    image: Optional[Image.Image] = None
+    path: Optional[str] = None
+    # Whether path was written by the store (and is deleted with the entry), rather than a saved sample
+    owns_path: bool = True
+    # Set while the image is written to disk to be dropped from RAM; its bytes no longer count against the budget
+    spilling: bool = False
+
+
+class ResultStore:
+    ''' Holds job results. Thumbnails are written to the spill directory as small WebP files; full size images
+        stay in RAM until the memory budget is exceeded, after which the oldest ones are written to the spill
+        directory as PNG files and dropped from RAM. Images whose lossless sample file was already saved are
+        dropped without writing them again. Entries are freed when released by their owner.
+        Images are encoded outside of the lock, so other jobs' results aren't held up while one is written.
+        Each store writes to its own directory inside spill_dir, as a standby server shares it with the active one.
+        Directories left by processes which ended without close() are removed once unused for stale_after
+        seconds. '''
+
+    def __init__(self, memory_budget: int, spill_dir: Optional[str] = None, thumbnail_size: int = 256,
+                 stale_after: Optional[float] = None):
+        self.memory_budget = memory_budget
+        self.thumbnail_size = thumbnail_size
+        if spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix='sd-webui-results-')
+        else:
+            os.makedirs(spill_dir, exist_ok=True)
+            if stale_after is not None:
+                remove_stale_spill_dirs(spill_dir, stale_after)
+            self.spill_dir = tempfile.mkdtemp(prefix='results-', dir=spill_dir)
+        self._entries: Dict[str, StoredImage] = OrderedDict()
+        self._ram_bytes = 0
+        self._lock = Lock()
+
+    def put(self, image: Image.Image, file: Optional[Future] = None) -> StoredImage:
+        ''' Stores an image and returns its handle.
+            file is the Future of a lossless file of the image being saved elsewhere, returning its path. Once
+            written, the store uses that file instead of spilling a copy of its own. '''
+        key = uuid.uuid4().hex
+        thumbnail = image.copy()
+        thumbnail.thumbnail((self.thumbnail_size, self.thumbnail_size))
+        thumbnail_path = os.path.join(self.spill_dir, f"{key}-thumb.webp")
+        thumbnail.save(thumbnail_path, 'webp', quality=80, method=0)
+        nbytes = image.width * image.height * len(image.getbands())
+        entry = StoredImage(key=key, thumbnail_path=thumbnail_path, size=image.size, nbytes=nbytes, image=image)
+        with self._lock:
+            self._entries[entry.key] = entry
+            self._ram_bytes += nbytes
+        if file is not None:
+            file.add_done_callback(partial(self._use_file, entry))
+        self._spill_over_budget()
+        return entry
+
+    def load(self, entry: StoredImage) -> Image.Image:
+        ''' Returns the full size image, reading it back from disk if it was spilled '''
+        entry.last_access = time.time()
+        self._touch()
+        image = entry.image
+        if image is not None:
+            return image
+        with Image.open(entry.path) as f:
+            f.load()
+            return f.copy()
+
+    def get(self, key: str) -> Optional[StoredImage]:
+        with self._lock:
+            return self._entries.get(key)
+
+    def file_path(self, entry: StoredImage) -> str:
+        ''' Returns the path of the full size image on disk, encoding it first if it is only held in RAM '''
+        entry.last_access = time.time()
+        self._touch()
+        image = entry.image
+        if entry.path is None and image is not None:
+            self._write(entry, image)
+        return entry.path
+
+    def release(self, entries: List[StoredImage]) -> None:
+        ''' Frees the given entries, deleting any spilled files '''
+        with self._lock:
+            for entry in entries:
+                if self._entries.pop(entry.key, None) is None:
+                    continue
+                if entry.image is not None and not entry.spilling:
+                    self._ram_bytes -= entry.nbytes
+                entry.image = None
+                for path in (entry.path if entry.owns_path else None, entry.thumbnail_path):
+                    if path is None:
+                        continue
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+    def ram_usage(self) -> int:
+        return self._ram_bytes
+
+    def close(self) -> None:
+        ''' Releases everything and removes the store's spill directory '''
+        self.release(list(self._entries.values()))
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def _touch(self) -> None:
+        # Reading results doesn't change the directory, mark it as in use for remove_stale_spill_dirs
+        try:
+            os.utime(self.spill_dir)
+        except OSError:
+            pass
+
+    def _spill_over_budget(self) -> None:
+        # Oldest first. The entries are picked under the lock and written outside of it; their bytes stop counting
+        # right away, so concurrent calls don't pick them again
+        with self._lock:
+            spill = []
+            for entry in self._entries.values():
+                if self._ram_bytes <= self.memory_budget:
+                    break
+                if entry.image is None or entry.spilling:
+                    continue
+                entry.spilling = True
+                self._ram_bytes -= entry.nbytes
+                spill.append(entry)
+        for entry in spill:
+            image = entry.image
+            if entry.path is None and image is not None:
+                self._write(entry, image)
+            with self._lock:
+                entry.image = None
+                entry.spilling = False
+
+    def _write(self, entry: StoredImage, image: Image.Image) -> None:
+        # Written under a temporary name and renamed, so concurrent writes of the same entry can't interleave
+        path = os.path.join(self.spill_dir, f"{entry.key}.png")
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        image.save(tmp_path, 'png', compress_level=1)
+        os.replace(tmp_path, path)
+        with self._lock:
+            released = entry.key not in self._entries
+            if not released and entry.path is None:
+                entry.path = path
+                return
+        # Released meanwhile, or already on disk
+        if released or entry.path != path:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _use_file(self, entry: StoredImage, file: Future) -> None:
+        if file.cancelled() or file.exception() is not None:
+            return
+        path = file.result()
+        own_path = None
+        with self._lock:
+            if entry.key not in self._entries:
+                return
+            if entry.path is not None and entry.owns_path:
+                own_path = entry.path
+            entry.path, entry.owns_path = path, False
+        if own_path is not None:
+            try:
+                os.remove(own_path)
+            except OSError:
+                pass
+
+
+def remove_stale_spill_dirs(spill_dir: str, stale_after: float) -> None:
+    ''' Removes the results of stores in spill_dir which were not used for stale_after seconds, left behind by
+        processes which ended without closing their store '''
+    cutoff = time.time() - stale_after
+    for name in os.listdir(spill_dir):
+        path = os.path.join(spill_dir, name)
+        try:
+            if os.path.getmtime(path) >= cutoff:
+                continue
+            if os.path.isdir(path) and name.startswith('results-'):
+                shutil.rmtree(path, ignore_errors=True)
+            elif name.endswith(('-thumb.webp', '.png', '.tmp')) and len(name.split('-')[0].split('.')[0]) == 32:
+                # Files of stores which wrote directly into spill_dir
+                os.remove(path)
+        except OSError:
+            pass
+
+
+class ResultImages:
+    ''' List-like collection of a job's images, backed by a ResultStore.
+        Appending stores the image; indexing and iterating return full size images. '''
+
+    def __init__(self, store: ResultStore):
+        self._store = store
+        self._entries: List[StoredImage] = []
+
+    def append(self, image: Image.Image, file: Optional[Future] = None) -> None:
+        ''' Stores image; file is the Future of a lossless file it is being saved to, see ResultStore.put '''
+        self._entries.append(self._store.put(image, file))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self._store.load(entry) for entry in self._entries[idx]]
+        return self._store.load(self._entries[idx])
+
+    def __iter__(self):
+        return (self._store.load(entry) for entry in list(self._entries))
+
+    @property
+    def entries(self) -> List[StoredImage]:
+        return list(self._entries)
+
+    def thumbnails(self) -> List[str]:
+        ''' Paths of the WebP thumbnails, in order '''
+        return [entry.thumbnail_path for entry in self._entries]
+
+    def handles(self) -> List[str]:
+        ''' Keys which can be used to look the full size images up in the store, in order '''
+        return [entry.key for entry in self._entries]
+
+    def last_access(self) -> float:
+        return max((entry.last_access for entry in self._entries), default=0.0)
+
+    def release(self) -> None:
+        ''' Frees the stored images '''
+        self._store.release(self._entries)
+        self._entries = []
+
+    def truncate(self, length: int) -> None:
+        ''' Frees the images after the first length '''
+        self._store.release(self._entries[length:])
+        self._entries = self._entries[:length]
@@ -4,6 +4,7 @@ from PIL import Image, ImageFont, ImageDraw, ImageFilter, ImageOps
 from io import BytesIO
 import base64
 import re
+import uuid
 
 
 def change_image_editor_mode(choice, cropped_image, masked_image, resize_mode, width, height):
@@ -57,10 +58,35 @@ def increment_down(value):
 def increment_up(value):
     return value + 1
 
-def copy_img_to_lab(img):
+def gallery_image(handle, img, job_manager=None):
+    """returns the selected gallery image: the full size result looked up by its server side handle when
+    available, otherwise the image decoded from the gallery data URL"""
+    if handle and job_manager is not None:
+        image = job_manager.load_result_image(handle)
+        if image is not None:
+            return image
+    if not img:
+        return None
+    image_data = re.sub('^data:image/.+;base64,', '', img)
+    return Image.open(BytesIO(base64.b64decode(image_data)))
+
+def full_size_link(handle, img, job_manager=None):
+    path = job_manager.result_image_path(handle) if handle and job_manager is not None else None
+    if path is None:
+        return gr.update(value="Full size image is no longer available", visible=True)
+    return gr.update(value=f'<a href="file={path}" target="_blank">Open full size image</a>', visible=True)
+
+def full_size_url(handle, img, job_manager=None):
+    """URL of the selected gallery image for the browser to fetch: its full size file while the job manager still
+    has it, otherwise the gallery's data URL"""
+    path = job_manager.result_image_path(handle) if handle and job_manager is not None else None
+    url = f"file={path}" if path is not None else img
+    # a new value every time, so copying the same image again still fires the change event
+    return f"{url}#{uuid.uuid4().hex}" if url else ""
+
+def copy_img_to_lab(handle, img, job_manager=None):
     try:
-        image_data = re.sub('^data:image/.+;base64,', '', img)
-        processed_image = Image.open(BytesIO(base64.b64decode(image_data)))
+        processed_image = gallery_image(handle, img, job_manager)
         tab_update = gr.update(selected='imgproc_tab')
         img_update = gr.update(value=processed_image)
         return processed_image, tab_update,
@@ -76,20 +102,18 @@ def copy_img_params_to_lab(params):
         return prompt,seed,steps,cfg_scale,sampler
     except IndexError:
         return [None, None]
-def copy_img_to_input(img):
+def copy_img_to_input(handle, img, job_manager=None):
     try:
-        image_data = re.sub('^data:image/.+;base64,', '', img)
-        processed_image = Image.open(BytesIO(base64.b64decode(image_data)))
+        processed_image = gallery_image(handle, img, job_manager)
         tab_update = gr.update(selected='img2img_tab')
         img_update = gr.update(value=processed_image)
         return processed_image, processed_image , tab_update
     except IndexError:
         return [None, None]
 
-def copy_img_to_edit(img):
+def copy_img_to_edit(handle, img, job_manager=None):
     try:
-        image_data = re.sub('^data:image/.+;base64,', '', img)
-        processed_image = Image.open(BytesIO(base64.b64decode(image_data)))
+        processed_image = gallery_image(handle, img, job_manager)
         tab_update = gr.update(selected='img2img_tab')
         img_update = gr.update(value=processed_image)
         mode_update = gr.update(value='Crop')
@@ -97,10 +121,9 @@ def copy_img_to_edit(img):
     except IndexError:
         return [None, None]
 
-def copy_img_to_mask(img):
+def copy_img_to_mask(handle, img, job_manager=None):
     try:
-        image_data = re.sub('^data:image/.+;base64,', '', img)
-        processed_image = Image.open(BytesIO(base64.b64decode(image_data)))
+        processed_image = gallery_image(handle, img, job_manager)
         tab_update = gr.update(selected='img2img_tab')
         img_update = gr.update(value=processed_image)
         mode_update = gr.update(value='Mask')
@@ -14,6 +14,7 @@ import taming.data.utils as tdu
 from taming.data.imagenet import str_to_indices, give_synsets_from_indices, download, retrieve
 from taming.data.imagenet import ImagePaths
 
+from ldm.data.shards import ShardedImages
 from ldm.modules.image_degradation import degradation_fn_bsr, degradation_fn_bsr_light
 
 
@@ -272,7 +273,7 @@ class ImageNetValidation(ImageNetBase):
 class ImageNetSR(Dataset):
     def __init__(self, size=None,
                  degradation=None, downscale_f=4, min_crop_f=0.5, max_crop_f=1.,
-                 random_crop=True):
+                 random_crop=True, shards=None):
         """
         Imagenet Superresolution Dataloader
         Performs following ops in order:
@@ -288,8 +289,12 @@ class ImageNetSR(Dataset):
         :param max_crop_f: ""
         :param data_root:
         :param random_crop:
+        :param shards: directory written by scripts/preprocess_dataset.py --imagenet-sr, to crop from preprocessed
+          center squares instead of decoding the images. The crops are then taken from the center square of each
+          image; preprocess at a size of at least size / min_crop_f to keep the detail of small crops.
         """
-        self.base = self.get_base()
+        self.shards = ShardedImages(shards) if shards is not None else None
+        self.base = self.shards if self.shards is not None else self.get_base()
         assert size
         assert (size / downscale_f).is_integer()
         self.size = size
@@ -337,13 +342,17 @@ class ImageNetSR(Dataset):
         return len(self.base)
 
     def __getitem__(self, i):
-        example = self.base[i]
-        image = Image.open(example["file_path_"])
+        if self.shards is not None:
+            example = {"relative_file_path_": self.shards.relpath(i)}
+            image = self.shards[i]
+        else:
+            example = self.base[i]
+            image = Image.open(example["file_path_"])
 
-        if not image.mode == "RGB":
-            image = image.convert("RGB")
+            if not image.mode == "RGB":
+                image = image.convert("RGB")
 
-        image = np.array(image).astype(np.uint8)
+            image = np.array(image).astype(np.uint8)
 
         min_side_len = min(image.shape[:2])
         crop_side_len = min_side_len * np.random.uniform(self.min_crop_f, self.max_crop_f, size=None)
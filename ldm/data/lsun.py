@@ -1,9 +1,11 @@
 import os
 import numpy as np
 import PIL
+import torch
 from PIL import Image
 from torch.utils.data import Dataset
-from torchvision import transforms
+
+from ldm.data.shards import ShardedImages
 
 
 class LSUNBase(Dataset):
@@ -12,33 +14,53 @@ class LSUNBase(Dataset):
                  data_root,
                  size=None,
                  interpolation="bicubic",
-                 flip_p=0.5
+                 flip_p=0.5,
+                 shards=None
                  ):
+        """
+        :param shards: directory written by scripts/preprocess_dataset.py from txt_file and data_root, to read
+                       preprocessed crops from instead of decoding the images.
+        """
         self.data_paths = txt_file
         self.data_root = data_root
-        with open(self.data_paths, "r") as f:
-            self.image_paths = f.read().splitlines()
+        self.size = size
+        if shards is not None:
+            self.shards = ShardedImages(shards)
+            assert size is None or self.shards.size == size, \
+                f"{shards} holds {self.shards.size}px crops, not {size}px"
+            self.image_paths = self.shards.relpaths
+        else:
+            self.shards = None
+            with open(self.data_paths, "rb") as f:
+                self.image_paths = np.array(f.read().splitlines())
         self._length = len(self.image_paths)
-        self.labels = {
-            "relative_file_path_": [l for l in self.image_paths],
-            "file_path_": [os.path.join(self.data_root, l)
-                           for l in self.image_paths],
-        }
 
-        self.size = size
         self.interpolation = {"linear": PIL.Image.LINEAR,
                               "bilinear": PIL.Image.BILINEAR,
                               "bicubic": PIL.Image.BICUBIC,
                               "lanczos": PIL.Image.LANCZOS,
                               }[interpolation]
-        self.flip = transforms.RandomHorizontalFlip(p=flip_p)
+        self.flip_p = flip_p
 
     def __len__(self):
         return self._length
 
     def __getitem__(self, i):
-        example = dict((k, self.labels[k][i]) for k in self.labels)
-        image = Image.open(example["file_path_"])
+        relpath = self.image_paths[i].decode()
+        example = {"relative_file_path_": relpath,
+                   "file_path_": os.path.join(self.data_root, relpath)}
+        if self.shards is not None:
+            img = self.shards[i]
+        else:
+            img = self.load(example["file_path_"])
+
+        if self.flip_p > 0 and torch.rand(1) < self.flip_p:
+            img = img[:, ::-1]
+        example["image"] = img.astype(np.float32) / 127.5 - 1.0
+        return example
+
+    def load(self, path):
+        image = Image.open(path)
         if not image.mode == "RGB":
             image = image.convert("RGB")
 
@@ -49,14 +71,11 @@ class LSUNBase(Dataset):
         img = img[(h - crop) // 2:(h + crop) // 2,
               (w - crop) // 2:(w + crop) // 2]
 
-        image = Image.fromarray(img)
         if self.size is not None:
+            image = Image.fromarray(img)
             image = image.resize((self.size, self.size), resample=self.interpolation)
-
-        image = self.flip(image)
-        image = np.array(image).astype(np.uint8)
-        example["image"] = (image / 127.5 - 1.0).astype(np.float32)
-        return example
+            img = np.array(image).astype(np.uint8)
+        return img
 
 
 class LSUNChurchesTrain(LSUNBase):
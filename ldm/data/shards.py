@@ -0,0 +1,121 @@
+"""Datasets preprocessed into memory-mapped shards.
+
+Decoding, cropping and resizing a JPEG on every access costs far more than training needs to wait for. The images of
+a dataset are instead preprocessed once (see scripts/preprocess_dataset.py) into fixed-size uint8 crops, stored in
+.npy shards of shape [n, size, size, 3] which are memory-mapped when read: an item is a view into the page cache.
+
+Layout of a shard directory: shard-00000.npy, shard-00001.npy, ..., relpaths.txt with the path of each image relative
+to the dataset root, one per line in shard order, and index.json with the crop size and the length of each shard.
+index.json is written last, so a directory without it is an unfinished preprocessing run.
+"""
+import json
+import os
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+import PIL
+from PIL import Image
+from tqdm import tqdm
+
+INDEX = "index.json"
+RELPATHS = "relpaths.txt"
+
+INTERPOLATIONS = {"linear": PIL.Image.LINEAR,
+                  "bilinear": PIL.Image.BILINEAR,
+                  "bicubic": PIL.Image.BICUBIC,
+                  "lanczos": PIL.Image.LANCZOS,
+                  "area": PIL.Image.BOX,
+                  }
+
+
+def shard_name(i):
+    return f"shard-{i:05d}.npy"
+
+
+def center_crop(path, size, interpolation="bicubic"):
+    """
+    The largest centered square of the image at path, resized to size x size.
+    :return: [size, size, 3] uint8 RGB array.
+    """
+    image = Image.open(path)
+    if not image.mode == "RGB":
+        image = image.convert("RGB")
+    w, h = image.size
+    crop = min(w, h)
+    image = image.crop(((w - crop) // 2, (h - crop) // 2, (w + crop) // 2, (h + crop) // 2))
+    if crop != size:
+        image = image.resize((size, size), resample=INTERPOLATIONS[interpolation])
+    return np.asarray(image, dtype=np.uint8)
+
+
+def write_shards(out_dir, data_root, relpaths, size, interpolation="bicubic", shard_size=4096, workers=8):
+    """
+    Preprocess the images data_root/relpaths with center_crop into shards in out_dir.
+    :param shard_size: images per shard.
+    :param workers: processes decoding images.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    if os.path.exists(os.path.join(out_dir, INDEX)):
+        os.remove(os.path.join(out_dir, INDEX))
+    lengths = [min(shard_size, len(relpaths) - start) for start in range(0, len(relpaths), shard_size)]
+    crop = partial(center_crop, size=size, interpolation=interpolation)
+    paths = (os.path.join(data_root, p) for p in relpaths)
+    with Pool(workers) as pool:
+        images = pool.imap(crop, paths, chunksize=16)
+        with tqdm(total=len(relpaths), desc=f"Preprocessing into {out_dir}") as progress:
+            for i, length in enumerate(lengths):
+                shard = np.lib.format.open_memmap(os.path.join(out_dir, shard_name(i)), mode="w+",
+                                                  dtype=np.uint8, shape=(length, size, size, 3))
+                for j in range(length):
+                    shard[j] = next(images)
+                    progress.update()
+                shard.flush()
+                del shard
+
+    with open(os.path.join(out_dir, RELPATHS), "w") as f:
+        f.write("\n".join(relpaths) + "\n")
+    with open(os.path.join(out_dir, INDEX), "w") as f:
+        json.dump({"size": size, "interpolation": interpolation, "shards": lengths}, f)
+
+
+class ShardedImages:
+    """
+    Read access to a shard directory written by write_shards. Items are read-only [size, size, 3] uint8 views of
+    the mapped shards, so copies (e.g. into float) are made by the caller.
+
+    Nothing here holds per-item Python objects: the relative paths are one bytes array, which keeps the pages of
+    DataLoader worker processes forked from the main process shared instead of copied by refcount updates.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        index_path = os.path.join(directory, INDEX)
+        if not os.path.exists(index_path):
+            raise FileNotFoundError(f"{index_path} not found, preprocess the dataset with "
+                                    f"scripts/preprocess_dataset.py first")
+        with open(index_path) as f:
+            index = json.load(f)
+        self.size = index["size"]
+        self.interpolation = index["interpolation"]
+        self.starts = np.cumsum([0] + index["shards"])
+        with open(os.path.join(directory, RELPATHS), "rb") as f:
+            self.relpaths = np.array(f.read().splitlines())
+        assert len(self.relpaths) == len(self), f"{directory}: {RELPATHS} doesn't match {INDEX}"
+        # mapped on first access, so worker processes map the shards themselves
+        self.shards = [None] * len(index["shards"])
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        s = int(np.searchsorted(self.starts, i, side="right")) - 1
+        if self.shards[s] is None:
+            self.shards[s] = np.load(os.path.join(self.directory, shard_name(s)), mmap_mode="r")
+        return self.shards[s][i - self.starts[s]]
+
+    def relpath(self, i):
+        return self.relpaths[i].decode()
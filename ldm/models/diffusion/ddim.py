@@ -6,7 +6,7 @@ from tqdm import tqdm
 from functools import partial
 
 from ldm.modules.diffusionmodules.util import make_ddim_sampling_parameters, make_ddim_timesteps, noise_like, \
-    extract_into_tensor
+    extract_into_tensor, guidance_scale_at, make_ddim_step_coefficients, CFGBuffers
 
 
 class DDIMSampler(object):
@@ -15,11 +15,13 @@ class DDIMSampler(object):
         self.model = model
         self.ddpm_num_timesteps = model.num_timesteps
         self.schedule = schedule
+        self.step_coefficients_cache = {}
 
     def register_buffer(self, name, attr):
         if type(attr) == torch.Tensor:
-            if attr.device != torch.device("cuda"):
-                attr = attr.to(torch.device("cuda"))
+            # keep the schedule on the model's device (which is not necessarily CUDA)
+            if attr.device != self.model.betas.device:
+                attr = attr.to(self.model.betas.device)
         setattr(self, name, attr)
 
     def make_schedule(self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
@@ -52,6 +54,22 @@ class DDIMSampler(object):
             (1 - self.alphas_cumprod_prev) / (1 - self.alphas_cumprod) * (
                         1 - self.alphas_cumprod / self.alphas_cumprod_prev))
         self.register_buffer('ddim_sigmas_for_original_num_steps', sigmas_for_original_sampling_steps)
+        self.step_coefficients_cache = {}
+
+    def step_coefficients(self, use_original_steps=False):
+        """the per-step update coefficients of the current schedule, computed on its first step"""
+        cache = self.step_coefficients_cache
+        if use_original_steps not in cache:
+            if use_original_steps:
+                cache[True] = make_ddim_step_coefficients(
+                    self.model.alphas_cumprod, self.model.alphas_cumprod_prev,
+                    self.model.sqrt_one_minus_alphas_cumprod, self.model.ddim_sigmas_for_original_num_steps,
+                    self.model.betas.device)
+            else:
+                cache[False] = make_ddim_step_coefficients(
+                    self.ddim_alphas, self.ddim_alphas_prev, self.ddim_sqrt_one_minus_alphas, self.ddim_sigmas,
+                    self.model.betas.device)
+        return cache[use_original_steps]
 
     @torch.no_grad()
     def sample(self,
@@ -131,15 +149,18 @@ class DDIMSampler(object):
             timesteps = self.ddim_timesteps[:subset_end]
 
         intermediates = {'x_inter': [img], 'pred_x0': [img]}
-        time_range = reversed(range(0,timesteps)) if ddim_use_original_steps else np.flip(timesteps)
+        time_range = list(reversed(range(0,timesteps))) if ddim_use_original_steps else np.flip(timesteps)
         total_steps = timesteps if ddim_use_original_steps else timesteps.shape[0]
         print(f"Running DDIM Sampling with {total_steps} timesteps")
 
         iterator = tqdm(time_range, desc='DDIM Sampler', total=total_steps)
+        # the timesteps of every step and the guidance inputs are set up once for the whole loop
+        ts_table = torch.tensor(list(time_range), device=device, dtype=torch.long)[:, None].repeat(1, b)
+        cfg_buffers = CFGBuffers()
 
         for i, step in enumerate(iterator):
             index = total_steps - i - 1
-            ts = torch.full((b,), step, device=device, dtype=torch.long)
+            ts = ts_table[i]
 
             if mask is not None:
                 assert x0 is not None
@@ -150,8 +171,8 @@ class DDIMSampler(object):
                                       quantize_denoised=quantize_denoised, temperature=temperature,
                                       noise_dropout=noise_dropout, score_corrector=score_corrector,
                                       corrector_kwargs=corrector_kwargs,
-                                      unconditional_guidance_scale=unconditional_guidance_scale,
-                                      unconditional_conditioning=unconditional_conditioning)
+                                      unconditional_guidance_scale=guidance_scale_at(unconditional_guidance_scale, i, total_steps, b),
+                                      unconditional_conditioning=unconditional_conditioning, cfg_buffers=cfg_buffers)
             img, pred_x0 = outs
             if callback: callback(i)
             if img_callback: img_callback(pred_x0, i)
@@ -165,15 +186,13 @@ class DDIMSampler(object):
     @torch.no_grad()
     def p_sample_ddim(self, x, c, t, index, repeat_noise=False, use_original_steps=False, quantize_denoised=False,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
-                      unconditional_guidance_scale=1., unconditional_conditioning=None):
+                      unconditional_guidance_scale=1., unconditional_conditioning=None, cfg_buffers=None):
         b, *_, device = *x.shape, x.device
 
         if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
             e_t = self.model.apply_model(x, t, c)
         else:
-            x_in = torch.cat([x] * 2)
-            t_in = torch.cat([t] * 2)
-            c_in = torch.cat([unconditional_conditioning, c])
+            x_in, t_in, c_in = (cfg_buffers or CFGBuffers()).inputs(x, t, unconditional_conditioning, c)
             e_t_uncond, e_t = self.model.apply_model(x_in, t_in, c_in).chunk(2)
             e_t = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
 
@@ -181,26 +200,20 @@ class DDIMSampler(object):
             assert self.model.parameterization == "eps"
             e_t = score_corrector.modify_score(self.model, e_t, x, t, c, **corrector_kwargs)
 
-        alphas = self.model.alphas_cumprod if use_original_steps else self.ddim_alphas
-        alphas_prev = self.model.alphas_cumprod_prev if use_original_steps else self.ddim_alphas_prev
-        sqrt_one_minus_alphas = self.model.sqrt_one_minus_alphas_cumprod if use_original_steps else self.ddim_sqrt_one_minus_alphas
-        sigmas = self.model.ddim_sigmas_for_original_num_steps if use_original_steps else self.ddim_sigmas
         # select parameters corresponding to the currently considered timestep
-        a_t = torch.full((b, 1, 1, 1), alphas[index], device=device)
-        a_prev = torch.full((b, 1, 1, 1), alphas_prev[index], device=device)
-        sigma_t = torch.full((b, 1, 1, 1), sigmas[index], device=device)
-        sqrt_one_minus_at = torch.full((b, 1, 1, 1), sqrt_one_minus_alphas[index],device=device)
+        coefficients = self.step_coefficients(use_original_steps)
 
         # current prediction for x_0
-        pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
+        pred_x0 = (x - coefficients['sqrt_one_minus_a_t'][index] * e_t) / coefficients['sqrt_a_t'][index]
         if quantize_denoised:
             pred_x0, _, *_ = self.model.first_stage_model.quantize(pred_x0)
         # direction pointing to x_t
-        dir_xt = (1. - a_prev - sigma_t**2).sqrt() * e_t
-        noise = sigma_t * noise_like(x.shape, device, repeat_noise) * temperature
-        if noise_dropout > 0.:
-            noise = torch.nn.functional.dropout(noise, p=noise_dropout)
-        x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise
+        x_prev = coefficients['sqrt_a_prev'][index] * pred_x0 + coefficients['dir_xt'][index] * e_t
+        if coefficients['noise'][index]:
+            noise = coefficients['sigma_t'][index] * noise_like(x.shape, device, repeat_noise) * temperature
+            if noise_dropout > 0.:
+                noise = torch.nn.functional.dropout(noise, p=noise_dropout)
+            x_prev = x_prev + noise
         return x_prev, pred_x0
 
     @torch.no_grad()
@@ -231,10 +244,12 @@ class DDIMSampler(object):
         print(f"Running DDIM Sampling with {total_steps} timesteps")
 
         iterator = tqdm(time_range, desc='Decoding image', total=total_steps)
+        ts_table = torch.tensor(list(time_range), device=x_latent.device, dtype=torch.long)[:, None].repeat(1, x_latent.shape[0])
+        cfg_buffers = CFGBuffers()
         x_dec = x_latent
         for i, step in enumerate(iterator):
             index = total_steps - i - 1
-            ts = torch.full((x_latent.shape[0],), step, device=x_latent.device, dtype=torch.long)
+            ts = ts_table[i]
 
             if z_mask is not None and i < total_steps - 2:
                 assert x0 is not None
@@ -243,6 +258,6 @@ class DDIMSampler(object):
                 x_dec = (img_orig * mask_inv) + (z_mask * x_dec)
 
             x_dec, _ = self.p_sample_ddim(x_dec, cond, ts, index=index, use_original_steps=use_original_steps,
-                                          unconditional_guidance_scale=unconditional_guidance_scale,
-                                          unconditional_conditioning=unconditional_conditioning)
+                                          unconditional_guidance_scale=guidance_scale_at(unconditional_guidance_scale, i, total_steps, x_latent.shape[0]),
+                                          unconditional_conditioning=unconditional_conditioning, cfg_buffers=cfg_buffers)
         return x_dec
\ No newline at end of file
@@ -1,3 +1,4 @@
+from functools import partial
 from inspect import isfunction
 import math
 import torch
@@ -6,6 +7,7 @@ from torch import nn, einsum
 from einops import rearrange, repeat
 
 from ldm.modules.diffusionmodules.util import checkpoint
+from ldm.modules.token_merging import bipartite_soft_matching_2d, do_nothing
 
 
 def exists(val):
@@ -166,6 +168,8 @@ class CrossAttention(nn.Module):
             nn.Linear(inner_dim, query_dim),
             nn.Dropout(dropout)
         )
+        # queries attended to at once, 0 for all; see set_query_chunk_size
+        self.query_chunk_size = 0
 
     def forward(self, x, context=None, mask=None):
         h = self.heads
@@ -177,6 +181,18 @@ class CrossAttention(nn.Module):
 
         q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h), (q, k, v))
 
+        chunk = self.query_chunk_size
+        if chunk and q.shape[1] > chunk:
+            # the similarity matrix is the largest tensor of the UNet; the softmax is per query, so it can be
+            # computed for a slice of the queries at a time
+            out = torch.cat([self.attend(q[:, i:i + chunk], k, v, mask) for i in range(0, q.shape[1], chunk)], dim=1)
+        else:
+            out = self.attend(q, k, v, mask)
+        out = rearrange(out, '(b h) n d -> b n (h d)', h=h)
+        return self.to_out(out)
+
+    def attend(self, q, k, v, mask=None):
+        h = self.heads
         sim = einsum('b i d, b j d -> b i j', q, k) * self.scale
 
         if exists(mask):
@@ -188,9 +204,18 @@ class CrossAttention(nn.Module):
         # attention, what we cannot get enough of
         attn = sim.softmax(dim=-1)
 
-        out = einsum('b i j, b j d -> b i d', attn, v)
-        out = rearrange(out, '(b h) n d -> b n (h d)', h=h)
-        return self.to_out(out)
+        return einsum('b i j, b j d -> b i d', attn, v)
+
+
+def set_query_chunk_size(model, chunk_size):
+    """
+    Compute attention for at most chunk_size queries at a time in all CrossAttention layers of model. This bounds
+    the memory of the similarity matrices at the cost of some speed; the results don't change.
+    :param chunk_size: queries per chunk, 0 to attend to all at once.
+    """
+    for module in model.modules():
+        if isinstance(module, CrossAttention):
+            module.query_chunk_size = chunk_size
 
 
 class BasicTransformerBlock(nn.Module):
@@ -204,14 +229,23 @@ class BasicTransformerBlock(nn.Module):
         self.norm2 = nn.LayerNorm(dim)
         self.norm3 = nn.LayerNorm(dim)
         self.checkpoint = checkpoint
-
-    def forward(self, x, context=None):
-        return checkpoint(self._forward, (x, context), self.parameters(), self.checkpoint)
-
-    def _forward(self, x, context=None):
-        x = self.attn1(self.norm1(x)) + x
+        # token merging, see ldm.modules.token_merging.apply_token_merging
+        self.merge_ratio = 0.
+        self.merge_ff = False
+
+    def forward(self, x, context=None, size=None):
+        return checkpoint(partial(self._forward, size=size), (x, context), self.parameters(), self.checkpoint)
+
+    def _forward(self, x, context=None, size=None):
+        merge, unmerge = do_nothing, do_nothing
+        if self.merge_ratio > 0. and size is not None:
+            merge, unmerge = bipartite_soft_matching_2d(x, *size, 2, 2, int(x.shape[1] * self.merge_ratio))
+        x = unmerge(self.attn1(merge(self.norm1(x)))) + x
         x = self.attn2(self.norm2(x), context=context) + x
-        x = self.ff(self.norm3(x)) + x
+        if self.merge_ff:
+            x = unmerge(self.ff(merge(self.norm3(x)))) + x
+        else:
+            x = self.ff(self.norm3(x)) + x
         return x
 
 
@@ -255,7 +289,7 @@ class SpatialTransformer(nn.Module):
         x = self.proj_in(x)
         x = rearrange(x, 'b c h w -> b (h w) c')
         for block in self.transformer_blocks:
-            x = block(x, context=context)
+            x = block(x, context=context, size=(h, w))
         x = rearrange(x, 'b (h w) c -> b c h w', h=h, w=w)
         x = self.proj_out(x)
         return x + x_in
\ No newline at end of file
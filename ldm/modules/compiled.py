@@ -0,0 +1,151 @@
+"""Traced execution of the UNet and the VAE decoder.
+
+torch.jit.trace records the module's forward once per input shape and replays the recorded graph afterwards, which
+skips the Python overhead of the module tree (TimestepEmbedSequential, ResBlock, SpatialTransformer, the einops
+calls in CrossAttention, ...). A traced graph only holds for the shapes, dtypes and autocast state it was recorded
+with, so graphs are cached per bucket and inputs outside the configured buckets run eagerly.
+"""
+import threading
+import time
+
+import torch
+import torch.nn as nn
+
+
+class BucketedTrace(nn.Module):
+    """
+    Wraps a module and runs it through traced graphs for the configured buckets.
+    :param module: the module to trace; it stays available as self.module and is used for eager calls.
+    :param buckets: (batch, height, width) of the inputs to trace. A graph is recorded on the first call in a bucket
+                    (or by warmup()) and cached per (batch, height, width, dtype, autocast) key.
+    """
+    def __init__(self, module, buckets):
+        super().__init__()
+        self.module = module
+        self.buckets = set(buckets)
+        self.graphs = {}
+        self.failed = set()
+        self.lock = threading.Lock()
+
+    def prepare(self, *args, **kwargs):
+        """returns the positional tensors to trace the call with, or None if the call has to run eagerly"""
+        raise NotImplementedError
+
+    def example_inputs(self, bucket):
+        raise NotImplementedError
+
+    @staticmethod
+    def key(x):
+        return (x.shape[0], x.shape[-2], x.shape[-1], x.dtype,
+                torch.is_autocast_enabled() and torch.get_autocast_gpu_dtype(),
+                torch.is_autocast_cpu_enabled() and torch.get_autocast_cpu_dtype())
+
+    def forward(self, *args, **kwargs):
+        inputs = self.prepare(*args, **kwargs)
+        if inputs is None or torch.is_grad_enabled():
+            return self.module(*args, **kwargs)
+        key = self.key(inputs[0])
+        graph = self.graphs.get(key)
+        if graph is None:
+            if key[:3] not in self.buckets or key in self.failed:
+                return self.module(*args, **kwargs)
+            graph = self.trace(key, inputs)
+            if graph is None:
+                return self.module(*args, **kwargs)
+        return graph(*inputs)
+
+    def trace(self, key, inputs):
+        with self.lock:
+            if key in self.graphs:
+                return self.graphs[key]
+            name = type(self.module).__name__
+            tic = time.time()
+            try:
+                graph = torch.jit.trace(self.module, inputs, check_trace=False)
+            except Exception as e:
+                print(f"Could not trace {name} for {key}, running it eagerly: {e}")
+                self.failed.add(key)
+                return None
+            print(f"Traced {name} for batch {key[0]}, {key[1]}x{key[2]} {key[3]} in {time.time() - tic:.1f}s")
+            self.graphs[key] = graph
+            return graph
+
+    @torch.no_grad()
+    def warmup(self, runs=2):
+        """
+        Trace every bucket ahead of time under the current dtype/autocast state. The first runs of a traced graph
+        are profiled and optimized by the JIT, so each graph is also run a few times.
+        """
+        for bucket in sorted(self.buckets):
+            inputs = self.example_inputs(bucket)
+            graph = self.trace(self.key(inputs[0]), inputs)
+            for _ in range(runs if graph is not None else 0):
+                graph(*inputs)
+
+    def clear(self):
+        with self.lock:
+            self.graphs.clear()
+            self.failed.clear()
+
+
+class CompiledUNet(BucketedTrace):
+    """UNetModel with traced (x, timesteps, context) calls; buckets are in latent pixels"""
+    def prepare(self, x, timesteps=None, context=None, y=None, **kwargs):
+        # the step cache changes the path through the UNet from call to call, which a trace can't follow
+        if context is None or y is not None or kwargs or self.module.step_cache is not None:
+            return None
+        # DDIM/PLMS pass integer timesteps, k-diffusion float ones; both embed the same
+        return x, timesteps.float(), context
+
+    def example_inputs(self, bucket):
+        b, h, w = bucket
+        weight = next(self.module.parameters())
+        context_dim = next(m for m in self.module.modules() if hasattr(m, 'to_k')).to_k.in_features
+        return (torch.randn(b, self.module.in_channels, h, w, device=weight.device),
+                torch.full((b,), 500., device=weight.device),
+                torch.randn(b, 77, context_dim, device=weight.device))
+
+
+class CompiledDecoder(BucketedTrace):
+    """first stage Decoder with traced calls; buckets are in latent pixels"""
+    def prepare(self, z):
+        return (z,)
+
+    def example_inputs(self, bucket):
+        b, h, w = bucket
+        weight = next(self.module.parameters())
+        return (torch.randn(b, self.module.conv_in.in_channels, h, w, device=weight.device),)
+
+
+def parse_buckets(spec):
+    """
+    Parse image sizes as given on the command line.
+    :param spec: comma separated BATCHxHEIGHTxWIDTH in image pixels, e.g. "1x512x512,2x512x512".
+    :return: list of (batch, height, width) tuples.
+    """
+    buckets = []
+    for item in spec.split(','):
+        b, h, w = (int(v) for v in item.strip().lower().split('x'))
+        buckets.append((b, h, w))
+    return buckets
+
+
+def compile_model(model, buckets, warmup=False):
+    """
+    Replace the UNet and the first stage decoder of a LatentDiffusion model with traced versions.
+    :param buckets: (batch, height, width) in image pixels. The UNet is traced for batch and 2 * batch latents,
+                    which covers classifier free guidance with and without the unconditional pass.
+    :param warmup: trace all buckets now rather than on their first use; call under the autocast used for sampling.
+    """
+    decoder = model.first_stage_model.decoder
+    f = 2 ** (len(getattr(decoder, 'module', decoder).up) - 1)
+    latents = [(b, h // f, w // f) for b, h, w in buckets]
+    unet = model.model.diffusion_model
+    if not isinstance(unet, CompiledUNet):
+        unet = model.model.diffusion_model = CompiledUNet(unet, [(n * b, h, w) for b, h, w in latents for n in (1, 2)])
+    if not isinstance(decoder, CompiledDecoder):
+        decoder = model.first_stage_model.decoder = CompiledDecoder(decoder, latents)
+    if warmup:
+        unet.warmup()
+        decoder.warmup()
+    return model
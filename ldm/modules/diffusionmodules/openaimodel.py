@@ -1,6 +1,7 @@
 from abc import abstractmethod
 from functools import partial
 import math
+import threading
 from typing import Iterable
 
 import numpy as np
@@ -410,6 +411,46 @@ class QKVAttention(nn.Module):
         return count_flops_attn(model, _x, y)
 
 
+class StepCache:
+    """
+    Cross-step feature cache for UNetModel.
+    On a full step the whole UNet runs and the input of output_blocks[-depth] is kept. On the following
+    interval - 1 calls only input_blocks[:depth] and output_blocks[-depth:] run, with the kept feature standing in
+    for the deeper blocks. A full step is forced whenever the input shape changes or the timestep does not decrease,
+    which marks the start of a new sampling run. The state is kept per thread so concurrent jobs do not share it.
+    :param depth: number of shallow input and output blocks recomputed on every call.
+    :param interval: number of calls between full steps.
+    """
+    def __init__(self, depth, interval):
+        self.depth = depth
+        self.interval = interval
+        self._local = threading.local()
+
+    @property
+    def state(self):
+        if not hasattr(self._local, 'feature'):
+            self.reset()
+        return self._local
+
+    def reset(self):
+        self._local.feature = None
+        self._local.key = None
+        self._local.last_t = None
+        self._local.calls = 0
+
+    def use_cached(self, x, timesteps):
+        state = self.state
+        key = (tuple(x.shape), x.dtype, x.device)
+        t = float(timesteps.max())
+        if state.feature is None or key != state.key or state.last_t is None or t >= state.last_t:
+            state.calls = 0
+        state.key = key
+        state.last_t = t
+        use = state.calls % self.interval != 0
+        state.calls += 1
+        return use
+
+
 class UNetModel(nn.Module):
     """
     The full UNet model with attention and timestep embedding.
@@ -502,6 +543,7 @@ class UNetModel(nn.Module):
         self.num_head_channels = num_head_channels
         self.num_heads_upsample = num_heads_upsample
         self.predict_codebook_ids = n_embed is not None
+        self.step_cache = None
 
         time_embed_dim = model_channels * 4
         self.time_embed = nn.Sequential(
@@ -728,11 +770,20 @@ class UNetModel(nn.Module):
             emb = emb + self.label_emb(y)
 
         h = x.type(self.dtype)
-        for module in self.input_blocks:
+        cache = self.step_cache
+        use_cached = cache is not None and cache.use_cached(x, timesteps)
+        for module in (self.input_blocks[:cache.depth] if use_cached else self.input_blocks):
             h = module(h, emb, context)
             hs.append(h)
-        h = self.middle_block(h, emb, context)
-        for module in self.output_blocks:
+        if use_cached:
+            h = cache.state.feature
+        else:
+            h = self.middle_block(h, emb, context)
+        for i, module in enumerate(self.output_blocks):
+            if cache is not None and i == len(self.output_blocks) - cache.depth and not use_cached:
+                cache.state.feature = h
+            if use_cached and i < len(self.output_blocks) - cache.depth:
+                continue
             h = th.cat([h, hs.pop()], dim=1)
             h = module(h, emb, context)
         h = h.type(x.dtype)
@@ -741,6 +792,17 @@ class UNetModel(nn.Module):
         else:
             return self.out(h)
 
+    def set_step_cache(self, depth, interval):
+        """
+        Reuse the deep features of the previous full step on intermediate sampling steps, see StepCache.
+        An interval of 1 or less disables the cache.
+        """
+        if interval <= 1:
+            self.step_cache = None
+            return
+        assert 0 < depth < len(self.input_blocks), f'step cache depth must be between 1 and {len(self.input_blocks) - 1}'
+        self.step_cache = StepCache(depth, interval)
+
 
 class EncoderUNetModel(nn.Module):
     """
@@ -74,6 +74,72 @@ def make_ddim_sampling_parameters(alphacums, ddim_timesteps, eta, verbose=True):
     return sigmas, alphas, alphas_prev
 
 
+def guidance_scale_at(guidance_scale, step, total_steps, batch_size):
+    """
+    Resolve the classifier-free guidance scale for a sampling step.
+    :param guidance_scale: a constant scale, or a callable taking (progress in [0, 1), batch_size)
+                           which returns the scale for that point of the schedule.
+    :param batch_size: the samples the step evaluates the model on, counted once per model evaluation (a step that
+                       evaluates the model twice passes twice the batch size).
+    """
+    if callable(guidance_scale):
+        return guidance_scale(step / total_steps, batch_size)
+    return guidance_scale
+
+
+def make_ddim_step_coefficients(alphas, alphas_prev, sqrt_one_minus_alphas, sigmas, device):
+    """
+    Precompute the coefficients of the DDIM update
+    x_prev = sqrt_a_prev * (x - sqrt_one_minus_a_t * e_t) / sqrt_a_t + dir_xt * e_t + sigma_t * noise.
+    :return: dict of [steps x 1 x 1 x 1] float32 Tensors on device, indexed by the step index, plus 'noise',
+             a list of whether sigma_t is non-zero for each step.
+    """
+    def column(values):
+        return torch.as_tensor(values, dtype=torch.float32).reshape(-1, 1, 1, 1).to(device)
+
+    a_t, a_prev, sigma_t = column(alphas), column(alphas_prev), column(sigmas)
+    return {
+        'sqrt_a_t': a_t.sqrt(),
+        'sqrt_one_minus_a_t': column(sqrt_one_minus_alphas),
+        'sqrt_a_prev': a_prev.sqrt(),
+        'dir_xt': (1. - a_prev - sigma_t ** 2).sqrt(),
+        'sigma_t': sigma_t,
+        'noise': (sigma_t.flatten() != 0).tolist(),
+    }
+
+
+class CFGBuffers:
+    """
+    Inputs of the batched unconditional + conditional model call of classifier-free guidance, reused across the
+    steps of a job: the [uncond, cond] conditioning is concatenated once per pair of conditionings, and x and t
+    are copied into preallocated doubled-batch buffers.
+    """
+    def __init__(self):
+        self.conds = None
+        self.c_in = None
+        self.x_in = None
+        self.t_in = None
+
+    @staticmethod
+    def _doubled(buffer, value):
+        n = value.shape[0]
+        if buffer is None or buffer.shape != (2 * n,) + value.shape[1:] or buffer.dtype != value.dtype \
+                or buffer.device != value.device:
+            buffer = torch.empty((2 * n,) + value.shape[1:], dtype=value.dtype, device=value.device)
+        buffer[:n].copy_(value)
+        buffer[n:].copy_(value)
+        return buffer
+
+    def inputs(self, x, t, uncond, cond):
+        """:return: (x_in, t_in, c_in) for a model call on the [uncond, cond] batch."""
+        if self.conds is None or self.conds[0] is not uncond or self.conds[1] is not cond:
+            self.conds = (uncond, cond)
+            self.c_in = torch.cat([uncond, cond])
+        self.x_in = self._doubled(self.x_in, x)
+        self.t_in = self._doubled(self.t_in, t)
+        return self.x_in, self.t_in, self.c_in
+
+
 def betas_for_alpha_bar(num_diffusion_timesteps, alpha_bar, max_beta=0.999):
     """
     Create a beta schedule that discretizes the given alpha_t_bar function,
@@ -148,6 +214,10 @@ class CheckpointFunction(torch.autograd.Function):
         return (None, None) + input_grads
 
 
+# sinusoid frequencies by (half dim, max period, device), constant for a model
+_timestep_freqs = {}
+
+
 def timestep_embedding(timesteps, dim, max_period=10000, repeat_only=False):
     """
     Create sinusoidal timestep embeddings.
@@ -159,9 +229,12 @@ def timestep_embedding(timesteps, dim, max_period=10000, repeat_only=False):
     """
     if not repeat_only:
         half = dim // 2
-        freqs = torch.exp(
-            -math.log(max_period) * torch.arange(start=0, end=half, dtype=torch.float32) / half
-        ).to(device=timesteps.device)
+        key = (half, max_period, timesteps.device)
+        freqs = _timestep_freqs.get(key)
+        if freqs is None:
+            freqs = _timestep_freqs[key] = torch.exp(
+                -math.log(max_period) * torch.arange(start=0, end=half, dtype=torch.float32) / half
+            ).to(device=timesteps.device)
         args = timesteps[:, None].float() * freqs[None]
         embedding = torch.cat([torch.cos(args), torch.sin(args)], dim=-1)
         if dim % 2:
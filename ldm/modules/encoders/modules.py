@@ -1,5 +1,7 @@
+import threading
 import torch
 import torch.nn as nn
+from collections import OrderedDict
 from functools import partial
 import clip
 from einops import rearrange, repeat
@@ -136,12 +138,16 @@ class SpatialRescaler(nn.Module):
 
 class FrozenCLIPEmbedder(AbstractEncoder):
     """Uses the CLIP transformer encoder for text (from Hugging Face)"""
-    def __init__(self, version="openai/clip-vit-large-patch14", device="cuda", max_length=77):
+    def __init__(self, version="openai/clip-vit-large-patch14", device="cuda", max_length=77, token_cache_size=1024):
         super().__init__()
         self.tokenizer = CLIPTokenizer.from_pretrained(version)
         self.transformer = CLIPTextModel.from_pretrained(version)
         self.device = device
         self.max_length = max_length
+        self.token_cache_size = token_cache_size
+        self._token_cache = OrderedDict()
+        self._token_cache_lock = threading.Lock()
+        self._inverse_vocab = None
         self.freeze()
 
     def freeze(self):
@@ -149,10 +155,44 @@ class FrozenCLIPEmbedder(AbstractEncoder):
         for param in self.parameters():
             param.requires_grad = False
 
+    def tokenize(self, text):
+        """Tokenizes each prompt once. Returns (tokens, overflowing) where tokens is a [len(text), max_length]
+        LongTensor padded like the tokenizer's padding="max_length" output, and overflowing holds the truncated
+        token ids of each prompt. Results are cached per prompt so the length check and the encoder share them."""
+        if isinstance(text, str):
+            text = [text]
+        with self._token_cache_lock:
+            found = {t: self._token_cache[t] for t in text if t in self._token_cache}
+            for t in found:
+                self._token_cache.move_to_end(t)
+
+        missing = [t for t in dict.fromkeys(text) if t not in found]
+        if missing:
+            body_length = self.max_length - 2
+            ids = self.tokenizer(missing, add_special_tokens=False, truncation=False)["input_ids"]
+            for t, t_ids in zip(missing, ids):
+                body = t_ids[:body_length]
+                padding = [self.tokenizer.pad_token_id] * (body_length - len(body))
+                tokens = torch.tensor([self.tokenizer.bos_token_id] + body + [self.tokenizer.eos_token_id] + padding)
+                found[t] = (tokens, t_ids[body_length:])
+            with self._token_cache_lock:
+                for t in missing:
+                    self._token_cache[t] = found[t]
+                while len(self._token_cache) > self.token_cache_size:
+                    self._token_cache.popitem(last=False)
+
+        return torch.stack([found[t][0] for t in text]), [found[t][1] for t in text]
+
+    def tokens_to_text(self, token_ids):
+        """Converts token ids back to text, using an inverse vocab that is only built once"""
+        if self._inverse_vocab is None:
+            self._inverse_vocab = {v: k for k, v in self.tokenizer.get_vocab().items()}
+        words = [self._inverse_vocab.get(int(x), "") for x in token_ids]
+        return self.tokenizer.convert_tokens_to_string(''.join(words))
+
     def forward(self, text):
-        batch_encoding = self.tokenizer(text, truncation=True, max_length=self.max_length, return_length=True,
-                                        return_overflowing_tokens=False, padding="max_length", return_tensors="pt")
-        tokens = batch_encoding["input_ids"].to(self.device)
+        tokens, _ = self.tokenize(text)
+        tokens = tokens.to(self.device)
         outputs = self.transformer(input_ids=tokens)
 
         z = outputs.last_hidden_state
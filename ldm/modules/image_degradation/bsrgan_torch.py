@@ -0,0 +1,460 @@
+# -*- coding: utf-8 -*-
+import math
+
+import torch
+import torch.nn.functional as F
+
+"""
+# --------------------------------------------
+# Batched torch version of degradation_bsrgan_variant (bsrgan.py, bsrgan_light.py)
+# --------------------------------------------
+#
+# Every sample of a batch draws its own degradation, like a separate call of the NumPy version would: its own order
+# of the degradation steps, its own downsampling factors, blur kernels, noise and JPEG quality. As the image sizes
+# diverge in between, the batch is kept on a shared canvas with the valid height and width of each sample tracked
+# separately:
+# - resizing (cv2's linear / cubic / area, MATLAB's antialiased bicubic, nearest subsampling) multiplies each sample
+#   by its own separable resampling matrices in one batched matmul,
+# - blurring is one grouped convolution with a kernel per sample, after mirroring each sample's border into the
+#   canvas like ndimage's 'mirror' mode,
+# - JPEG compression is simulated (YCbCr, 4:2:0 chroma subsampling, 8x8 DCT quantized with the libjpeg tables for
+#   each sample's quality), as there is no batched JPEG codec.
+# --------------------------------------------
+"""
+
+INTER_LINEAR, INTER_CUBIC, INTER_AREA = 1, 2, 3
+KERNEL_PAD = 12  # half the largest blur kernel (25x25)
+
+JPEG_LUMINANCE = [
+    16, 11, 10, 16, 24, 40, 51, 61,
+    12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56,
+    14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77,
+    24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101,
+    72, 92, 95, 98, 112, 100, 103, 99]
+JPEG_CHROMINANCE = [
+    17, 18, 24, 47, 99, 99, 99, 99,
+    18, 21, 26, 66, 99, 99, 99, 99,
+    24, 26, 56, 99, 99, 99, 99, 99,
+    47, 66, 99, 99, 99, 99, 99, 99,
+    99, 99, 99, 99, 99, 99, 99, 99,
+    99, 99, 99, 99, 99, 99, 99, 99,
+    99, 99, 99, 99, 99, 99, 99, 99,
+    99, 99, 99, 99, 99, 99, 99, 99]
+
+
+class Random:
+    """per-sample random draws from an optional torch.Generator, returned on device"""
+    def __init__(self, device, generator=None):
+        self.device = device
+        self.generator = generator
+        self.source = generator.device if generator is not None else device
+
+    def rand(self, *shape):
+        return torch.rand(shape, generator=self.generator, device=self.source).to(self.device)
+
+    def randn(self, *shape):
+        return torch.randn(shape, generator=self.generator, device=self.source).to(self.device)
+
+    def uniform(self, low, high):
+        """low, high: tensors of the same shape, or a tensor and a number"""
+        low = torch.as_tensor(low, dtype=torch.float32, device=self.device)
+        high = torch.as_tensor(high, dtype=torch.float32, device=self.device)
+        shape = torch.broadcast_shapes(low.shape, high.shape)
+        return low + (high - low) * self.rand(*shape)
+
+    def randint(self, low, high, n):
+        """n integers in [low, high], both inclusive like random.randint"""
+        return torch.randint(low, high + 1, (n,), generator=self.generator, device=self.source).to(self.device)
+
+    def choice(self, values, n):
+        return torch.tensor(values, device=self.device)[self.randint(0, len(values) - 1, n)]
+
+
+"""
+# --------------------------------------------
+# canvas helpers
+# --------------------------------------------
+"""
+
+
+def reflect_index(length, valid, pad=0):
+    """indices into [0, valid) for positions -pad .. length + pad, mirrored at the borders (d c b | a b c d | c b a)"""
+    j = torch.arange(-pad, length + pad, device=valid.device)[None]
+    period = (2 * (valid - 1)).clamp(min=1)[:, None]
+    m = j.remainder(period)
+    return torch.where(m >= valid[:, None], period - m, m)
+
+
+def replicate_index(length, valid):
+    """indices into [0, valid) for positions 0 .. length, repeating the last valid one"""
+    j = torch.arange(length, device=valid.device)[None]
+    return torch.minimum(j, (valid - 1)[:, None])
+
+
+def gather(x, rows, cols):
+    """x: [n, c, h, w]; rows: [n, h'], cols: [n, w'] -> [n, c, h', w'] with x[i, :, rows[i]][..., cols[i]]"""
+    n = torch.arange(x.shape[0], device=x.device)[:, None, None]
+    return x.permute(0, 2, 3, 1)[n, rows[:, :, None], cols[:, None, :]].permute(0, 3, 1, 2)
+
+
+def cubic(t, a):
+    t = t.abs()
+    return torch.where(t <= 1, ((a + 2) * t - (a + 3)) * t * t + 1,
+                       torch.where(t < 2, ((a * t - 5 * a) * t + 8 * a) * t - 4 * a, torch.zeros_like(t)))
+
+
+def taps_matrix(index, weight, n_in, canvas_in):
+    """resampling matrix [n, out, canvas_in] from taps index, weight: [n, out, taps], indices clamped to the input"""
+    index = torch.minimum(index.clamp(min=0), (n_in - 1)[:, None, None])
+    matrix = torch.zeros(*index.shape[:2], canvas_in, dtype=weight.dtype, device=weight.device)
+    return matrix.scatter_add_(2, index, weight)
+
+
+def cv2_resize_matrix(n_in, n_out, mode, canvas_in, canvas_out):
+    """
+    Matrices [n, canvas_out, canvas_in] which resize samples of length n_in to n_out like cv2.resize with the
+    interpolation mode of each sample (INTER_LINEAR, INTER_CUBIC or INTER_AREA).
+    """
+    d = torch.arange(canvas_out, device=n_in.device, dtype=torch.float64)[None]
+    scale = (n_in.double() / n_out.double())[:, None]
+    src = (d + 0.5) * scale - 0.5
+    x0 = src.floor()
+    f = (src - x0)[..., None]
+    x0 = x0.long()[..., None]
+    linear = taps_matrix(x0 + torch.arange(2, device=x0.device), torch.cat([1 - f, f], -1), n_in, canvas_in)
+    cubic_ = taps_matrix(x0 + torch.arange(-1, 3, device=x0.device),
+                         cubic(torch.cat([f + 1, f, 1 - f, 2 - f], -1), -0.75), n_in, canvas_in)
+
+    # INTER_AREA averages the covered input pixels when shrinking ...
+    p = torch.arange(canvas_in, device=n_in.device, dtype=torch.float64)[None, None]
+    low = (d * scale)[..., None]
+    high = torch.minimum(low + scale[..., None], n_in.double()[:, None, None])
+    area = (torch.minimum(p + 1, high) - torch.maximum(p, low)).clamp(min=0) / (high - low).clamp(min=1e-12)
+    # ... and interpolates linearly with its own coefficients when enlarging
+    sx = (d * scale).floor()
+    fx = (d + 1) - (sx + 1) / scale
+    fx = torch.where(fx <= 0, torch.zeros_like(fx), fx - fx.floor())[..., None]
+    area_up = taps_matrix(sx.long()[..., None] + torch.arange(2, device=x0.device), torch.cat([1 - fx, fx], -1),
+                          n_in, canvas_in)
+    area = torch.where(scale[..., None] >= 1, area, area_up)
+
+    mode = mode[:, None, None]
+    matrix = torch.where(mode == INTER_LINEAR, linear, torch.where(mode == INTER_CUBIC, cubic_, area))
+    return (matrix * (d < n_out[:, None].double())[..., None]).float()
+
+
+def matlab_resize_matrix(n_in, scale, canvas_in):
+    """matrices resizing by scale like util.imresize_np with antialiasing (MATLAB's imresize, bicubic)"""
+    n_out = torch.ceil(n_in.double() * scale).long()
+    canvas_out = int(n_out.max())
+    width = 4 / scale if scale < 1 else 4
+    taps = math.ceil(width) + 2
+    d = torch.arange(1, canvas_out + 1, device=n_in.device, dtype=torch.float64)[None, :, None]
+    u = d / scale + 0.5 * (1 - 1 / scale)
+    index = (u - width / 2).floor() + torch.arange(taps, device=n_in.device)
+    weight = scale * cubic((u - index) * scale, -0.5) if scale < 1 else cubic(u - index, -0.5)
+    weight = weight / weight.sum(-1, keepdim=True)
+    # 1-based to 0-based, with symmetric copies of the border (c b a | a b c)
+    index = index.long().expand(n_in.shape[0], -1, -1) - 1
+    last = (n_in - 1)[:, None, None]
+    index = torch.where(index < 0, -index - 1, torch.where(index > last, 2 * last + 1 - index, index))
+    matrix = taps_matrix(index, weight.expand(n_in.shape[0], -1, -1), n_in, canvas_in)
+    return (matrix * (d[..., 0] <= n_out[:, None].double())[..., None]).float(), n_out
+
+
+def subsample_matrix(n_in, step, canvas_in):
+    """matrices taking every step-th element of each sample, like x[0::step]"""
+    n_out = (n_in + step - 1) // step
+    d = torch.arange(int(n_out.max()), device=n_in.device)[None]
+    index = (d * step[:, None])[..., None]
+    weight = (d < n_out[:, None]).float()[..., None]
+    return taps_matrix(index, weight, n_in, canvas_in), n_out
+
+
+def resample(x, rows, cols):
+    """x: [n, c, h, w]; rows: [n, h', h]; cols: [n, w', w]"""
+    return rows[:, None] @ x @ cols[:, None].transpose(-1, -2)
+
+
+def blur(x, kernels, h, w):
+    """convolve each sample with its [25, 25] kernel like ndimage.convolve(mode='mirror')"""
+    n, c, height, width = x.shape
+    padded = gather(x, reflect_index(height, h, KERNEL_PAD), reflect_index(width, w, KERNEL_PAD))
+    weight = kernels.flip(-1, -2).repeat_interleave(c, 0)[:, None]
+    return F.conv2d(padded.reshape(1, n * c, *padded.shape[2:]), weight, groups=n * c).reshape(n, c, height, width)
+
+
+def gaussian_kernels(size, precision):
+    """
+    [n, 25, 25] kernels exp(-p^T precision p / 2) of size x size (odd or even) pixels, centered like
+    anisotropic_Gaussian and fspecial('gaussian'), zero padded so that their center pixel is at 12.
+    :param size: [n] kernel sizes.
+    :param precision: [n, 2, 2] inverse covariance matrices, x first.
+    """
+    j = torch.arange(2 * KERNEL_PAD + 1, device=size.device, dtype=torch.float32)[None]
+    # ndimage.convolve centers even sized kernels on the pixel after their middle
+    offset = KERNEL_PAD - size // 2
+    coord = j - offset[:, None] - (size[:, None] - 1) / 2
+    inside = (j >= offset[:, None]) & (j < (offset + size)[:, None])
+    cy, cx = coord[:, :, None], coord[:, None, :]
+    e = -0.5 * (precision[:, 0, 0, None, None] * cx * cx + 2 * precision[:, 0, 1, None, None] * cx * cy +
+                precision[:, 1, 1, None, None] * cy * cy)
+    mask = inside[:, :, None] & inside[:, None, :]
+    # normalized in log space, so narrow kernels don't underflow to zero
+    e = torch.where(mask, e, torch.full_like(e, -math.inf))
+    k = torch.exp(e - e.flatten(1).max(1).values[:, None, None])
+    return k / k.sum((1, 2), keepdim=True)
+
+
+def shifted_gaussian_kernels(sigma, sf):
+    """fspecial('gaussian', 25, sigma) shifted by shift_pixel(k, sf), for each sample"""
+    t = torch.arange(-KERNEL_PAD, KERNEL_PAD + 1, device=sigma.device, dtype=torch.float32)[None]
+    g = torch.exp(-t * t / (2 * sigma[:, None] ** 2))
+    # linear interpolation at the shifted positions, clamped to the kernel (interp2d is separable here)
+    pos = (t + KERNEL_PAD + (sf[:, None] - 1) * 0.5).clamp(0, 2 * KERNEL_PAD)
+    low = pos.floor().long()
+    high = (low + 1).clamp(max=2 * KERNEL_PAD)
+    f = pos - low
+    g = g.gather(1, low) * (1 - f) + g.gather(1, high) * f
+    k = g[:, :, None] * g[:, None, :]
+    return k / k.sum((1, 2), keepdim=True)
+
+
+def dct_matrix(device):
+    i = torch.arange(8, device=device, dtype=torch.float32)
+    m = torch.cos((2 * i[None] + 1) * i[:, None] * math.pi / 16) * math.sqrt(2 / 8)
+    m[0] /= math.sqrt(2)
+    return m
+
+
+def jpeg_tables(quality):
+    """libjpeg's quantization tables [n, 2, 8, 8] (luminance, chrominance) for each sample's quality"""
+    quality = quality.float()
+    scale = torch.where(quality < 50, 5000 / quality, 200 - 2 * quality)[:, None, None]
+    base = torch.tensor([JPEG_LUMINANCE, JPEG_CHROMINANCE], device=quality.device, dtype=torch.float32)[None]
+    return ((base * scale + 50) / 100).floor().clamp(1, 255).reshape(-1, 2, 8, 8)
+
+
+def jpeg(x, quality, h, w):
+    """simulated JPEG round trip of each sample with its quality, like add_JPEG_noise"""
+    n, _, height, width = x.shape
+    # libjpeg repeats the last row and column to fill its 16x16 blocks
+    padded = gather(x, replicate_index((height + 15) // 16 * 16, h), replicate_index((width + 15) // 16 * 16, w))
+    rgb = (padded.clamp(0, 1) * 255).round()
+    r, g, b = rgb.unbind(1)
+    y = (0.299 * r + 0.587 * g + 0.114 * b).round()
+    cb = (-0.168736 * r - 0.331264 * g + 0.5 * b + 128).round()
+    cr = (0.5 * r - 0.418688 * g - 0.081312 * b + 128).round()
+    chroma = F.avg_pool2d(torch.stack([cb, cr], 1), 2).round()
+
+    dct = dct_matrix(x.device)
+    tables = jpeg_tables(quality)
+
+    def quantize(plane, table):
+        # plane: [n, c, H, W] -> 8x8 blocks [n, c, H/8, W/8, 8, 8]
+        c, H, W = plane.shape[1:]
+        blocks = plane.reshape(n, c, H // 8, 8, W // 8, 8).transpose(3, 4) - 128
+        table = table[:, None, None, None]
+        coefficients = ((dct @ blocks @ dct.T) / table).round() * table
+        blocks = (dct.T @ coefficients @ dct + 128).round().clamp(0, 255)
+        return blocks.transpose(3, 4).reshape(n, c, H, W)
+
+    y = quantize(y[:, None], tables[:, 0])[:, 0]
+    # libjpeg's "fancy" upsampling is a triangle filter, which is bilinear interpolation at pixel centers
+    cb, cr = F.interpolate(quantize(chroma, tables[:, 1]), scale_factor=2, mode='bilinear',
+                           align_corners=False).round().unbind(1)
+    r = y + 1.402 * (cr - 128)
+    g = y - 0.344136 * (cb - 128) - 0.714136 * (cr - 128)
+    b = y + 1.772 * (cb - 128)
+    return (torch.stack([r, g, b], 1).round().clamp(0, 255) / 255.)[:, :, :height, :width]
+
+
+"""
+# --------------------------------------------
+# degradation steps, each on the samples of a batch that take it
+# --------------------------------------------
+"""
+
+
+def add_blur(x, h, w, sf, rng, light):
+    n = x.shape[0]
+    wd2 = 4.0 + sf.float()
+    wd = 2.0 + 0.2 * sf.float()
+    if light:
+        wd2, wd = wd2 / 4, wd / 4
+    anisotropic = rng.rand(n) < 0.5
+    l1 = (wd2 * rng.rand(n)).clamp(min=1e-4)
+    l2 = (wd2 * rng.rand(n)).clamp(min=1e-4)
+    theta = rng.rand(n) * math.pi
+    # inverse of V diag(l1, l2) V^-1 with V = [[cos, sin], [sin, -cos]], which is its own inverse
+    c, s = torch.cos(theta), torch.sin(theta)
+    v = torch.stack([torch.stack([c, s], -1), torch.stack([s, -c], -1)], -2)
+    precision = v @ torch.diag_embed(torch.stack([1 / l1, 1 / l2], -1)) @ v
+    sigma = (wd * rng.rand(n)).clamp(min=1e-4)
+    isotropic = torch.eye(2, device=x.device)[None] / sigma[:, None, None] ** 2
+    precision = torch.where(anisotropic[:, None, None], precision, isotropic)
+    if light:
+        size = torch.where(anisotropic, rng.randint(2, 11, n) + 3, rng.randint(2, 4, n) + 3)
+    else:
+        size = 2 * rng.randint(2, 11, n) + 3
+    return blur(x, gaussian_kernels(size, precision), h, w), h, w
+
+
+def add_Gaussian_noise(x, rng, noise_level1, noise_level2):
+    n = x.shape[0]
+    sigma = (rng.randint(noise_level1, noise_level2, n).float() / 255.0)[:, None, None, None]
+    rnum = rng.rand(n)[:, None, None, None]
+    z = rng.randn(*x.shape)
+    # correlated color noise: cov = |L^2 U^T D U|, sampled through its SVD like np.random.multivariate_normal
+    L = noise_level2 / 255.
+    D = torch.diag_embed(rng.rand(n, 3))
+    U = torch.linalg.svd(rng.rand(n, 3, 3)).U
+    cov = (L ** 2 * U.transpose(1, 2) @ D @ U).abs()
+    _, S, Vh = torch.linalg.svd(cov)
+    correlated = torch.einsum('nchw,ncd->ndhw', z, S.sqrt()[:, :, None] * Vh)
+    noise = torch.where(rnum > 0.6, z * sigma, torch.where(rnum < 0.4, z[:, :1] * sigma, correlated))
+    return (x + noise).clamp(0.0, 1.0)
+
+
+def add_JPEG_noise(x, h, w, rng, light):
+    quality = rng.randint(80, 95, x.shape[0]) if light else rng.randint(30, 95, x.shape[0])
+    return jpeg(x, quality, h, w)
+
+
+def downsample2(x, h, w, sf, rng, light):
+    n, _, height, width = x.shape
+    resize = rng.rand(n) < (0.8 if light else 0.75)
+    sf1 = rng.uniform(1, 2 * sf.float())
+    h1 = torch.where(resize, (1 / sf1.double() * h).long().clamp(min=1), (h + sf - 1) // sf)
+    w1 = torch.where(resize, (1 / sf1.double() * w).long().clamp(min=1), (w + sf - 1) // sf)
+    mode = rng.choice([INTER_LINEAR, INTER_CUBIC, INTER_AREA], n)
+    rows = cv2_resize_matrix(h, h1, mode, height, int(h1.max()))
+    cols = cv2_resize_matrix(w, w1, mode, width, int(w1.max()))
+
+    # otherwise blur with a shifted kernel and take every sf-th pixel
+    blurred = blur(x, shifted_gaussian_kernels(rng.uniform(0.1, 0.6 * sf.float()), sf), h, w)
+    rows_nearest, _ = subsample_matrix(h, sf, height)
+    cols_nearest, _ = subsample_matrix(w, sf, width)
+    rows_nearest = F.pad(rows_nearest, (0, 0, 0, rows.shape[1] - rows_nearest.shape[1]))
+    cols_nearest = F.pad(cols_nearest, (0, 0, 0, cols.shape[1] - cols_nearest.shape[1]))
+
+    r = resize[:, None, None, None]
+    x = torch.where(r, resample(x, rows, cols), resample(blurred, rows_nearest, cols_nearest))
+    return x.clamp(0.0, 1.0), h1, w1
+
+
+def downsample3(x, h, w, target_h, target_w, rng):
+    mode = rng.choice([INTER_LINEAR, INTER_CUBIC, INTER_AREA], x.shape[0])
+    rows = cv2_resize_matrix(h, target_h, mode, x.shape[2], int(target_h.max()))
+    cols = cv2_resize_matrix(w, target_w, mode, x.shape[3], int(target_w.max()))
+    return resample(x, rows, cols).clamp(0.0, 1.0), target_h, target_w
+
+
+def downsample1(x, h, w, rng):
+    n, _, height, width = x.shape
+    mode = rng.choice([INTER_LINEAR, INTER_CUBIC, INTER_AREA], n)
+    h1, w1 = h // 2, w // 2
+    cv2_resized = resample(x, cv2_resize_matrix(h, h1, mode, height, int(h1.max())),
+                           cv2_resize_matrix(w, w1, mode, width, int(w1.max())))
+    rows, mh = matlab_resize_matrix(h, 1 / 2, height)
+    cols, mw = matlab_resize_matrix(w, 1 / 2, width)
+    matlab_resized = resample(x, rows, cols)[:, :, :cv2_resized.shape[2], :cv2_resized.shape[3]]
+    use_cv2 = (rng.rand(n) < 0.5)[:, None, None, None]
+    return torch.where(use_cv2, cv2_resized, matlab_resized).clamp(0.0, 1.0), h1, w1
+
+
+"""
+# --------------------------------------------
+# batched degradation
+# --------------------------------------------
+"""
+
+
+@torch.no_grad()
+def degradation_bsrgan_batch(images, sf=4, light=False, generator=None):
+    """
+    Batched degradation_bsrgan_variant: each sample of images is degraded like a separate call of the NumPy version
+    with its own random parameters.
+    ----------
+    images: [n, 3, H, W] RGB, uint8 or float in [0, 1], on any device
+    sf: scale factor
+    light: degrade like bsrgan_light.py (lighter blur and noise, JPEG quality 80-95) instead of bsrgan.py
+    generator: torch.Generator for reproducible degradations
+    Returns
+    -------
+    [n, 3, H // sf, W // sf] low-quality images, uint8 if images are uint8, else float in [0, 1]
+    """
+    uint8 = images.dtype == torch.uint8
+    x = images.float() / 255. if uint8 else images.float()
+    n, _, height, width = x.shape
+    x = x[:, :, :height - height % sf, :width - width % sf]  # mod crop
+    device = x.device
+    rng = Random(device, generator)
+
+    h = torch.full((n,), x.shape[2], device=device, dtype=torch.long)
+    w = torch.full((n,), x.shape[3], device=device, dtype=torch.long)
+    sfs = torch.full((n,), sf, device=device, dtype=torch.long)
+    if sf == 4:
+        # downsample1
+        scale2 = rng.rand(n) < 0.25
+        if scale2.any():
+            idx = scale2.nonzero()[:, 0]
+            y, h1, w1 = downsample1(x[idx], h[idx], w[idx], rng)
+            x = x.clone()
+            x[idx] = F.pad(y, (0, x.shape[3] - y.shape[3], 0, x.shape[2] - y.shape[2]))
+            h[idx], w[idx] = h1, w1
+            sfs[idx] = 2
+
+    # shuffle_order with downsample3 after downsample2
+    order = torch.argsort(rng.rand(n, 7), dim=1)
+    pos2, pos3 = (order == 2).long().argmax(1), (order == 3).long().argmax(1)
+    swap = pos2 > pos3
+    order[swap, pos2[swap]], order[swap, pos3[swap]] = 3, 2
+    jpeg_prob = 0.9
+    steps = {0, 2, 3, 4, 5} if light else {0, 1, 2, 3, 4, 5}
+
+    # size before downsample2, the size downsample3 scales down from
+    a_h, a_w = h.clone(), w.clone()
+    for k in range(7):
+        step = order[:, k]
+        parts = []
+        for i in steps:
+            take = step == i
+            if i == 5:
+                take &= rng.rand(n) < jpeg_prob
+            if not take.any():
+                continue
+            idx = take.nonzero()[:, 0]
+            xs = x[idx, :, :int(h[idx].max()), :int(w[idx].max())]
+            hs, ws, sf_s = h[idx], w[idx], sfs[idx]
+            if i in (0, 1):
+                y, hs, ws = add_blur(xs, hs, ws, sf_s, rng, light)
+            elif i == 2:
+                a_h[idx], a_w[idx] = hs, ws
+                y, hs, ws = downsample2(xs, hs, ws, sf_s, rng, light)
+            elif i == 3:
+                y, hs, ws = downsample3(xs, hs, ws, a_h[idx] // sf_s, a_w[idx] // sf_s, rng)
+            elif i == 4:
+                y = add_Gaussian_noise(xs, rng, *((1, 2) if light else (2, 25)))
+            else:
+                y = add_JPEG_noise(xs, hs, ws, rng, light)
+            parts.append((idx, y, hs, ws))
+        if not parts:
+            continue
+        for idx, _, hs, ws in parts:
+            h[idx], w[idx] = hs, ws
+        canvas = torch.zeros(n, 3, int(h.max()), int(w.max()), device=device)
+        canvas[:, :, :min(canvas.shape[2], x.shape[2]), :min(canvas.shape[3], x.shape[3])] = \
+            x[:, :, :canvas.shape[2], :canvas.shape[3]]
+        for idx, y, _, _ in parts:
+            y = y[:, :, :canvas.shape[2], :canvas.shape[3]]
+            canvas[idx] = F.pad(y, (0, canvas.shape[3] - y.shape[3], 0, canvas.shape[2] - y.shape[2]))
+        x = canvas
+
+    # add final JPEG compression noise
+    x = add_JPEG_noise(x, h, w, rng, light)
+    x = x[:, :, :int(h.min()), :int(w.min())]
+    return (x * 255.).round().clamp(0, 255).to(torch.uint8) if uint8 else x
@@ -1,5 +1,6 @@
 import os
 import math
+import functools
 import random
 import numpy as np
 import torch
@@ -760,10 +761,64 @@ def calculate_weights_indices(in_length, out_length, scale, kernel, kernel_width
     return weights, indices, int(sym_len_s), int(sym_len_e)
 
 
+@functools.lru_cache(maxsize=64)
+def resize_matrix(in_length, out_length, scale, antialiasing):
+    # the [out_length, in_length] matrix of calculate_weights_indices: row i holds the weights of output i at the
+    # input elements of its window, with the symmetric copies of the border (c b a | a b c) folded back in
+    weights, indices, sym_len_s, sym_len_e = calculate_weights_indices(
+        in_length, out_length, scale, 'cubic', 4, antialiasing)
+    padded = torch.cat([torch.arange(sym_len_s - 1, -1, -1), torch.arange(in_length),
+                        torch.arange(in_length - 1, in_length - 1 - sym_len_e, -1)])
+    rows = torch.arange(out_length)[:, None].expand_as(indices)
+    matrix = torch.zeros(out_length, in_length)
+    return matrix.index_put_((rows, padded[indices.long()]), weights, accumulate=True)
+
+
+def resize(x, out_H, out_W, scale, antialiasing):
+    # resize the last two dimensions of x, H then W as in the loop version, each with one matmul over all the
+    # leading dimensions
+    rows = resize_matrix(x.size(-2), out_H, scale, antialiasing).to(x.device)
+    cols = resize_matrix(x.size(-1), out_W, scale, antialiasing).to(x.device)
+    return (rows @ x) @ cols.t()
+
+
 # --------------------------------------------
 # imresize for tensor image [0, 1]
 # --------------------------------------------
 def imresize(img, scale, antialiasing=True):
+    # Now the scale should be the same for H and W
+    # input: img: pytorch tensor, CHW, NCHW (or any batch dimensions) or HW [0,1]
+    # output: same layout [0,1] w/o round
+    img = img.float()
+    in_H, in_W = img.shape[-2:]
+    out_H, out_W = math.ceil(in_H * scale), math.ceil(in_W * scale)
+    return resize(img, out_H, out_W, scale, antialiasing)
+
+
+# --------------------------------------------
+# imresize for numpy image [0, 1]
+# --------------------------------------------
+def imresize_np(img, scale, antialiasing=True):
+    # Now the scale should be the same for H and W
+    # input: img: Numpy, HWC, NHWC or HW [0,1]
+    # output: same layout [0,1] w/o round
+    img = torch.from_numpy(img).float()
+    need_squeeze = True if img.dim() == 2 else False
+    if need_squeeze:
+        img = img.unsqueeze(2)
+    in_H, in_W = img.shape[-3:-1]
+    out_H, out_W = math.ceil(in_H * scale), math.ceil(in_W * scale)
+
+    out = resize(img.movedim(-1, -3), out_H, out_W, scale, antialiasing).movedim(-3, -1)
+    if need_squeeze:
+        out = out.squeeze(2)
+    return out.contiguous().numpy()
+
+
+# --------------------------------------------
+# reference loop implementation of imresize, tensor image [0, 1]
+# --------------------------------------------
+def imresize_loop(img, scale, antialiasing=True):
     # Now the scale should be the same for H and W
     # input: img: pytorch tensor, CHW or HW [0,1]
     # output: CHW or HW [0,1] w/o round
@@ -834,9 +889,9 @@ def imresize(img, scale, antialiasing=True):
 
 
 # --------------------------------------------
-# imresize for numpy image [0, 1]
+# reference loop implementation of imresize_np, numpy image [0, 1]
 # --------------------------------------------
-def imresize_np(img, scale, antialiasing=True):
+def imresize_np_loop(img, scale, antialiasing=True):
     # Now the scale should be the same for H and W
     # input: img: Numpy, HWC or HW [0,1]
     # output: HWC or HW [0,1] w/o round
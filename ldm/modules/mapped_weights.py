@@ -0,0 +1,119 @@
+"""Model weights in a memory-mapped file.
+
+torch.load reads a checkpoint into the private memory of every process that loads it. Weights cached here are mapped
+from a flat file instead, and the model's parameters point into the mapping: processes that load the same model
+share its pages through the page cache, and a process that starts while another one has the model loaded barely
+touches the disk. Floating point tensors are stored in the dtype the model runs in, so no conversion copies them.
+
+File layout: an 8 byte little-endian header length, a JSON header with the checkpoint's size and modification time
+and the dtype, shape and offset of each tensor, then the tensor data, each tensor aligned to ALIGNMENT bytes.
+"""
+import json
+import os
+
+import numpy as np
+import torch
+
+ALIGNMENT = 64
+HEADER_SIZE = 8
+
+
+def mapped_cache_path(ckpt, dtype):
+    return f"{os.path.splitext(ckpt)[0]}.{str(dtype).replace('torch.', '')}.mmap"
+
+
+def _source(ckpt):
+    stat = os.stat(ckpt)
+    return [stat.st_size, int(stat.st_mtime)]
+
+
+def _align(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_mapped_weights(model, ckpt, dtype):
+    """
+    Cache the state dict of model, loaded from ckpt, for load_mapped_weights.
+    :param dtype: dtype to store floating point tensors in.
+    """
+    path = mapped_cache_path(ckpt, dtype)
+    entries = {}
+    arrays = []
+    offset = 0
+    for name, tensor in model.state_dict().items():
+        tensor = tensor.detach().cpu()
+        if tensor.is_floating_point():
+            tensor = tensor.to(dtype)
+        array = tensor.contiguous().numpy()
+        entries[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        arrays.append(array)
+        offset += _align(array.nbytes)
+    header = json.dumps({'source': _source(ckpt), 'tensors': entries}).encode()
+    data_start = _align(HEADER_SIZE + len(header))
+
+    # written to a temporary file first, so processes mapping the old file are not affected
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(len(header).to_bytes(HEADER_SIZE, 'little'))
+            f.write(header)
+            for entry, array in zip(entries.values(), arrays):
+                f.seek(data_start + entry['offset'])
+                array.tofile(f)
+            f.truncate(data_start + offset)
+        os.replace(tmp, path)
+        print(f"Cached model weights at {path}")
+    except OSError as e:
+        print(f"Could not cache model weights at {path}: {e}")
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def load_mapped_weights(model, ckpt, dtype):
+    """
+    Point the parameters and buffers of model to the cached weights of ckpt.
+    :return: False if there is no cache for ckpt and dtype, or it is outdated, damaged or doesn't hold exactly the
+        model's tensors; model is unchanged then.
+    """
+    path = mapped_cache_path(ckpt, dtype)
+    if not os.path.exists(path):
+        return False
+    try:
+        # copy-on-write, so the pages stay shared as long as nobody writes to the weights
+        buffer = np.memmap(path, dtype=np.uint8, mode='c')
+        header_size = int.from_bytes(buffer[:HEADER_SIZE].tobytes(), 'little')
+        header = json.loads(buffer[HEADER_SIZE:HEADER_SIZE + header_size].tobytes())
+    except (OSError, ValueError) as e:
+        print(f"Could not read {path}: {e}")
+        return False
+    if header.get('source') != _source(ckpt):
+        print(f"{path} is outdated, loading {ckpt}")
+        return False
+
+    data_start = _align(HEADER_SIZE + header_size)
+    state = model.state_dict(keep_vars=True)
+    if set(header['tensors']) != set(state):
+        # a tensor missing from the cache would keep its initial values
+        missing = sorted(set(state) - set(header['tensors']))
+        unexpected = sorted(set(header['tensors']) - set(state))
+        print(f"{path} doesn't match the model ({len(missing)} missing, {len(unexpected)} unexpected tensors, "
+              f"e.g. {(missing + unexpected)[0]}), loading {ckpt}")
+        return False
+    mapped = {}
+    for name, entry in header['tensors'].items():
+        np_dtype = np.dtype(entry['dtype'])
+        start = data_start + entry['offset']
+        nbytes = np_dtype.itemsize * int(np.prod(entry['shape']))
+        if start + nbytes > len(buffer):
+            print(f"{path} is truncated, loading {ckpt}")
+            return False
+        tensor = torch.from_numpy(np.asarray(buffer[start:start + nbytes]).view(np_dtype).reshape(entry['shape']))
+        if tensor.shape != state[name].shape:
+            print(f"{path} doesn't match the model ({name}), loading {ckpt}")
+            return False
+        mapped[name] = tensor
+
+    print(f"Mapping model weights from {path}")
+    for name, tensor in mapped.items():
+        state[name].data = tensor
+    return True
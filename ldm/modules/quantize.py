@@ -0,0 +1,100 @@
+"""Dynamic int8 quantization for CPU inference.
+
+The nn.Linear layers of CrossAttention, FeedForward and the CLIP text transformer are replaced by dynamically
+quantized ones (int8 weights, activations quantized on the fly), which run on CPU only. Conv weights can also be
+stored as int8; they are dequantized on every call, so that saves memory but not compute.
+"""
+import os
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from ldm.modules.attention import CrossAttention, FeedForward
+from ldm.modules.encoders.modules import FrozenCLIPEmbedder
+from ldm.util import instantiate_from_config
+
+
+class Int8WeightConv2d(nn.Module):
+    """Conv2d with its weight stored as int8 with one scale per output channel"""
+    def __init__(self, conv):
+        super().__init__()
+        weight = conv.weight.detach().float()
+        scale = weight.abs().amax(dim=(1, 2, 3), keepdim=True).clamp(min=1e-8) / 127.
+        self.register_buffer('weight_int8', torch.round(weight / scale).to(torch.int8))
+        self.register_buffer('weight_scale', scale)
+        self.bias = conv.bias
+        self.stride = conv.stride
+        self.padding = conv.padding
+        self.dilation = conv.dilation
+        self.groups = conv.groups
+
+    def forward(self, x):
+        weight = self.weight_int8.to(x.dtype) * self.weight_scale.to(x.dtype)
+        return F.conv2d(x, weight, self.bias, self.stride, self.padding, self.dilation, self.groups)
+
+
+def _quantize_conv_weights(module):
+    for name, child in module.named_children():
+        if type(child) is nn.Conv2d and child.padding_mode == 'zeros':
+            setattr(module, name, Int8WeightConv2d(child))
+        else:
+            _quantize_conv_weights(child)
+
+
+def quantize_model(model, conv=False):
+    """
+    Quantize model in place.
+    :param conv: also store the weights of all Conv2d layers as int8.
+    """
+    targets = [m for m in model.modules() if isinstance(m, (CrossAttention, FeedForward))]
+    targets += [m.transformer for m in model.modules() if isinstance(m, FrozenCLIPEmbedder)]
+    for module in targets:
+        torch.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    if conv:
+        _quantize_conv_weights(model)
+    return model
+
+
+def quantized_cache_path(ckpt, conv=False):
+    return f"{os.path.splitext(ckpt)[0]}.int8{'-conv' if conv else ''}.pt"
+
+
+def load_quantized_model(config, ckpt, conv=False):
+    """
+    Instantiate the model from config with quantized layers. The quantized weights are cached next to the checkpoint
+    and reused as long as the checkpoint's size and modification time are unchanged.
+    """
+    path = quantized_cache_path(ckpt, conv)
+    stat = os.stat(ckpt)
+    source = (stat.st_size, int(stat.st_mtime))
+    model = instantiate_from_config(config.model)
+
+    if os.path.exists(path):
+        cached = torch.load(path, map_location="cpu")
+        if cached.get("source") == source:
+            print(f"Loading quantized model from {path}")
+            quantize_model(model, conv)
+            try:
+                # strict, a cache written by another version of the model or of torch's quantized modules would
+                # otherwise leave layers with their initial weights
+                model.load_state_dict(cached["state_dict"], strict=True)
+                return model.eval()
+            except RuntimeError as e:
+                print(f"{path} doesn't match the model, quantizing again: {str(e).splitlines()[0]}")
+                model = instantiate_from_config(config.model)
+        else:
+            print(f"{path} is outdated, quantizing again")
+        del cached
+
+    print(f"Loading model from {ckpt}")
+    sd = torch.load(ckpt, map_location="cpu")["state_dict"]
+    model.load_state_dict(sd, strict=False)
+    del sd
+    quantize_model(model.eval(), conv)
+    try:
+        torch.save({"source": source, "state_dict": model.state_dict()}, path)
+        print(f"Cached quantized model at {path}")
+    except OSError as e:
+        print(f"Could not cache quantized model at {path}: {e}")
+    return model
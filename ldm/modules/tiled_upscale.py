@@ -0,0 +1,168 @@
+"""Tiled inference for the image upscalers.
+
+The activations of a 4x upscaler like RealESRGAN's RRDBNet grow with the pixel count of its input, so a large image
+pushed through in one piece runs out of memory. TiledUpscaler cuts the input into equally sized overlapping tiles,
+runs as many of them per forward pass as fit into a memory budget, and blends the overlapping parts of the results
+with linear ramps, which hides the seams that butting cropped tiles together leaves.
+"""
+import math
+
+import cv2
+import numpy as np
+import torch
+
+MIN_TILE = 64
+
+
+def tile_starts(length, tile, overlap):
+    """offsets of tiles of size tile which cover length, neighbours overlapping by at least overlap"""
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, tile - overlap))
+    starts.append(length - tile)
+    return starts
+
+
+def blend_window(height, width, ramp, device=None):
+    """
+    Weights for blending overlapping tiles, rising linearly over ramp pixels from each edge of the tile. Tiles at
+    the image border are the only ones there, so their low weight at the border cancels out when normalizing by
+    the summed weights.
+    """
+    def axis(length):
+        i = torch.arange(length, device=device)
+        return torch.clamp(torch.minimum(i + 1, length - i).float() / ramp, max=1)
+    return axis(height)[:, None] * axis(width)[None, :]
+
+
+class TiledUpscaler:
+    """
+    Drop-in replacement for RealESRGANer (and GFPGANer's bg_upsampler) that runs the network tile by tile.
+    :param model: network mapping [n, 3, h, w] RGB in [0, 1] to [n, 3, h * scale, w * scale]; kept as self.model.
+    :param scale: upscaling factor of the network.
+    :param device: device the network is on.
+    :param half: whether the network runs in float16.
+    :param memory_mb: budget in MiB for the network's activations. On CUDA the budget is also capped by the memory
+                      free at each call; None uses the free memory alone.
+    :param overlap: overlap of neighbouring tiles in input pixels.
+    :param max_tile: largest tile side in input pixels, unless the whole image fits the budget. Memory isn't
+                     measured on CPU, where tiles of this size are run one at a time.
+    """
+    def __init__(self, model, scale, device, half=False, memory_mb=None, overlap=16, max_tile=512):
+        self.model = model
+        self.scale = scale
+        self.device = torch.device(device)
+        self.dtype = torch.float16 if half else torch.float32
+        self.memory_mb = memory_mb
+        self.overlap = overlap
+        self.max_tile = max(max_tile, MIN_TILE)
+        # peak activation memory per input pixel at batch size 1, measured on first use
+        self.bytes_per_pixel = None
+
+    def enhance(self, img, outscale=None):
+        """
+        Upscale img the way RealESRGANer.enhance does.
+        :param img: HxW, HxWx3 (BGR) or HxWx4 (BGRA) uint8 or uint16 array.
+        :param outscale: resize the result to this factor of the input instead of the network's.
+        :return: (upscaled array with the layout and dtype of img, 'L', 'RGB' or 'RGBA').
+        """
+        h, w = img.shape[:2]
+        max_range = 65535. if img.dtype == np.uint16 else 255.
+        img = img.astype(np.float32) / max_range
+        alpha = None
+        if img.ndim == 2:
+            img_mode = 'L'
+            rgb = np.repeat(img[:, :, None], 3, axis=2)
+        elif img.shape[2] == 4:
+            img_mode = 'RGBA'
+            alpha = img[:, :, 3]
+            rgb = img[:, :, 2::-1]
+        else:
+            img_mode = 'RGB'
+            rgb = img[:, :, ::-1]
+
+        output = self.upscale(np.ascontiguousarray(rgb))
+        if img_mode == 'L':
+            output = cv2.cvtColor(output, cv2.COLOR_RGB2GRAY)
+        else:
+            output = output[:, :, ::-1]
+            if alpha is not None:
+                alpha = cv2.resize(alpha, (output.shape[1], output.shape[0]), interpolation=cv2.INTER_LINEAR)
+                output = np.concatenate([output, alpha[:, :, None]], axis=2)
+        output = (np.clip(output, 0, 1) * max_range).round().astype(np.uint16 if max_range > 255 else np.uint8)
+
+        if outscale is not None and outscale != self.scale:
+            output = cv2.resize(output, (int(w * outscale), int(h * outscale)), interpolation=cv2.INTER_LANCZOS4)
+        return output, img_mode
+
+    @torch.no_grad()
+    def upscale(self, img):
+        """
+        :param img: HxWx3 float32 RGB array in [0, 1].
+        :return: (H * scale)x(W * scale)x3 float32 array.
+        """
+        h, w = img.shape[:2]
+        image = torch.from_numpy(img).permute(2, 0, 1)
+        while True:
+            tile, batch = self.plan(h, w)
+            try:
+                return self.run_tiles(image, tile, batch).permute(1, 2, 0).numpy()
+            except RuntimeError as e:
+                if 'out of memory' not in str(e) or self.bytes_per_pixel is None or (tile <= MIN_TILE and batch == 1):
+                    raise
+                torch.cuda.empty_cache()
+                # other allocations got in the way, or the measurement was too optimistic
+                self.bytes_per_pixel *= 2
+                print(f"Upscaler ran out of memory with {batch} tiles of {tile}px, retrying with smaller ones")
+
+    def plan(self, h, w):
+        """returns (tile side, tiles per forward pass) for an h x w input"""
+        if self.device.type != 'cuda':
+            return self.max_tile, 1
+        if self.bytes_per_pixel is None:
+            self.bytes_per_pixel = self.measure()
+        pixels = max(int(self.budget() / self.bytes_per_pixel), MIN_TILE ** 2)
+        if h * w <= pixels:
+            return max(h, w), 1
+        tile = min(self.max_tile, max(MIN_TILE, math.isqrt(pixels) // 8 * 8))
+        count = len(tile_starts(h, tile, self.overlap)) * len(tile_starts(w, tile, self.overlap))
+        return tile, max(1, min(count, pixels // (min(tile, h) * min(tile, w))))
+
+    def budget(self):
+        free, _ = torch.cuda.mem_get_info(self.device)
+        # memory held by the caching allocator but not in use is available as well
+        free += torch.cuda.memory_reserved(self.device) - torch.cuda.memory_allocated(self.device)
+        budget = free * 0.9
+        if self.memory_mb:
+            budget = min(budget, self.memory_mb * 2 ** 20)
+        return budget
+
+    def measure(self, size=128):
+        probe = torch.rand(1, 3, size, size, device=self.device, dtype=self.dtype)
+        torch.cuda.synchronize(self.device)
+        torch.cuda.reset_peak_memory_stats(self.device)
+        base = torch.cuda.memory_allocated(self.device)
+        self.model(probe)
+        peak = torch.cuda.max_memory_allocated(self.device) - base
+        # headroom for fragmentation and for kernels picking larger workspaces at larger sizes
+        return peak * 1.25 / (size * size)
+
+    def run_tiles(self, image, tile, batch):
+        _, h, w = image.shape
+        s = self.scale
+        th, tw = min(tile, h), min(tile, w)
+        boxes = [(y, x) for y in tile_starts(h, th, self.overlap) for x in tile_starts(w, tw, self.overlap)]
+        if len(boxes) == 1:
+            return self.model(image[None].to(self.device, self.dtype))[0].float().cpu()
+
+        output = torch.zeros(3, h * s, w * s)
+        weights = torch.zeros(1, h * s, w * s)
+        window = blend_window(th * s, tw * s, self.overlap * s)[None]
+        for i in range(0, len(boxes), batch):
+            chunk = boxes[i:i + batch]
+            tiles = torch.stack([image[:, y:y + th, x:x + tw] for y, x in chunk]).to(self.device, self.dtype)
+            results = self.model(tiles).float().cpu()
+            for (y, x), result in zip(chunk, results):
+                output[:, y * s:(y + th) * s, x * s:(x + tw) * s] += result * window
+                weights[:, y * s:(y + th) * s, x * s:(x + tw) * s] += window
+        return output / weights
@@ -0,0 +1,125 @@
+"""Token merging for the self-attention of SpatialTransformer blocks.
+
+Adapted from "Token Merging for Fast Stable Diffusion" (Bolya & Hoffman, 2023): before attn1 (and optionally the
+feed forward) the most redundant latent tokens are averaged into similar tokens, and the result is copied back to
+the merged positions afterwards, so attention runs over fewer tokens.
+"""
+import torch
+
+
+def do_nothing(x):
+    return x
+
+
+def bipartite_soft_matching_2d(metric, h, w, sx, sy, r):
+    """
+    Partition the h*w tokens into destinations (one per sx*sy cell) and sources, and merge the r sources which are
+    most similar to a destination into it.
+    :param metric: tokens used to measure similarity, [b, h*w, c].
+    :param r: number of tokens to remove.
+    :return: (merge, unmerge) functions for tensors shaped like metric.
+    """
+    B, N, _ = metric.shape
+    if r <= 0:
+        return do_nothing, do_nothing
+
+    with torch.no_grad():
+        hsy, wsx = h // sy, w // sx
+        num_dst = hsy * wsx
+
+        # the top left token of every cell is a destination (-1 sorts first), everything else is a source.
+        # fixed positions rather than random ones keep results reproducible for a seed
+        idx_buffer_view = torch.zeros(hsy, wsx, sy * sx, device=metric.device, dtype=torch.int64)
+        idx_buffer_view[:, :, 0] = -1
+        idx_buffer_view = idx_buffer_view.view(hsy, wsx, sy, sx).transpose(1, 2).reshape(hsy * sy, wsx * sx)
+        if hsy * sy < h or wsx * sx < w:
+            idx_buffer = torch.zeros(h, w, device=metric.device, dtype=torch.int64)
+            idx_buffer[:hsy * sy, :wsx * sx] = idx_buffer_view
+        else:
+            idx_buffer = idx_buffer_view
+        idx = idx_buffer.reshape(1, -1, 1).argsort(dim=1)
+        a_idx = idx[:, num_dst:, :]  # sources
+        b_idx = idx[:, :num_dst, :]  # destinations
+
+        def split(x):
+            C = x.shape[-1]
+            src = torch.gather(x, dim=1, index=a_idx.expand(B, N - num_dst, C))
+            dst = torch.gather(x, dim=1, index=b_idx.expand(B, num_dst, C))
+            return src, dst
+
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = split(metric)
+        scores = a @ b.transpose(-1, -2)
+
+        r = min(a.shape[1], r)
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        unm_idx = edge_idx[..., r:, :]  # sources which are kept
+        src_idx = edge_idx[..., :r, :]  # sources which are merged
+        dst_idx = torch.gather(node_idx[..., None], dim=-2, index=src_idx)
+
+    def merge(x):
+        src, dst = split(x)
+        n, t1, c = src.shape
+        unm = torch.gather(src, dim=-2, index=unm_idx.expand(n, t1 - r, c))
+        src = torch.gather(src, dim=-2, index=src_idx.expand(n, r, c))
+        # mean of each destination and the sources merged into it
+        counts = torch.ones(n, dst.shape[1], 1, device=x.device, dtype=x.dtype)
+        counts = counts.scatter_add(-2, dst_idx, torch.ones(n, r, 1, device=x.device, dtype=x.dtype))
+        dst = dst.scatter_add(-2, dst_idx.expand(n, r, c), src) / counts
+        return torch.cat([unm, dst], dim=1)
+
+    def unmerge(x):
+        unm_len = unm_idx.shape[1]
+        unm, dst = x[..., :unm_len, :], x[..., unm_len:, :]
+        c = unm.shape[-1]
+        src = torch.gather(dst, dim=-2, index=dst_idx.expand(B, r, c))
+
+        out = torch.zeros(B, N, c, device=x.device, dtype=x.dtype)
+        out.scatter_(dim=-2, index=b_idx.expand(B, num_dst, c), src=dst)
+        out.scatter_(dim=-2, index=torch.gather(a_idx.expand(B, a_idx.shape[1], 1), dim=1, index=unm_idx).expand(B, unm_len, c), src=unm)
+        out.scatter_(dim=-2, index=torch.gather(a_idx.expand(B, a_idx.shape[1], 1), dim=1, index=src_idx).expand(B, r, c), src=src)
+        return out
+
+    return merge, unmerge
+
+
+def _set_merging(module, ratio, merge_ff):
+    from ldm.modules.attention import BasicTransformerBlock
+    for block in module.modules():
+        if isinstance(block, BasicTransformerBlock):
+            block.merge_ratio = ratio
+            block.merge_ff = merge_ff
+
+
+def apply_token_merging(model, ratios, merge_ff=False):
+    """
+    Enable token merging in every UNet found in model (which may be split into an encoder and a decoder half).
+    :param ratios: fraction of tokens to merge per resolution level; ratios[0] applies to the full latent resolution,
+                   ratios[1] to half of it and so on. Missing levels are not merged, and at most 0.75 can be merged.
+    :param merge_ff: also merge tokens before the feed forward layer.
+    """
+    def ratio(level):
+        return ratios[level] if level < len(ratios) else 0.
+
+    for unet in model.modules():
+        level = 0
+        if hasattr(unet, 'input_blocks'):
+            for block in unet.input_blocks:
+                if any(type(layer).__name__ == 'Downsample' for layer in block):
+                    level += 1
+                else:
+                    _set_merging(block, ratio(level), merge_ff)
+        if hasattr(unet, 'middle_block'):
+            # the middle block runs at the lowest resolution
+            _set_merging(unet.middle_block, ratio(level), merge_ff)
+        if hasattr(unet, 'output_blocks'):
+            level = sum(type(layer).__name__ == 'Upsample' for block in unet.output_blocks for layer in block)
+            for block in unet.output_blocks:
+                _set_merging(block, ratio(level), merge_ff)
+                if any(type(layer).__name__ == 'Upsample' for layer in block):
+                    level -= 1
+
+
+def remove_token_merging(model):
+    _set_merging(model, 0., False)
@@ -336,6 +336,7 @@ class UNet(DDPM):
                  scale_factor=1.0,
                  unet_bs = 1,
                  scale_by_std=False,
+                 device=None,
                  *args, **kwargs):
         self.num_timesteps_cond = default(num_timesteps_cond, 1)
         self.scale_by_std = scale_by_std
@@ -350,7 +351,7 @@ class UNet(DDPM):
         self.cond_stage_trainable = cond_stage_trainable
         self.cond_stage_key = cond_stage_key
         self.num_downs = 0
-        self.cdevice = "cuda"
+        self.cdevice = device or ("cuda" if torch.cuda.is_available() else "cpu")
         self.unetConfigEncode = unetConfigEncode
         self.unetConfigDecode = unetConfigDecode
         if not scale_by_std:
@@ -395,39 +396,65 @@ class UNet(DDPM):
 
 
     def apply_model(self, x_noisy, t, cond, return_ids=False):
-          
-        if(not self.turbo):
-            self.model1.to(self.cdevice)
-
+        """
+        Run the split UNet in micro-batches of unet_bs. When model1 and model2 can stay on the device together
+        (turbo, or running on the CPU) every micro-batch streams through both halves before the next one starts,
+        so only one micro-batch of skip connections is alive at a time. Otherwise all micro-batches go through
+        model1 first, with their skip connections written into buffers preallocated for the whole batch, before
+        model1 is swapped out for model2.
+        """
         step = self.unet_bs
-        h,emb,hs = self.model1(x_noisy[0:step], t[:step], cond[:step])
         bs = cond.shape[0]
-        
-        assert bs%2 == 0
-        lenhs = len(hs)
-
-        for i in range(step,bs,step):
-            h_temp,emb_temp,hs_temp = self.model1(x_noisy[i:i+step], t[i:i+step], cond[i:i+step])
-            h = torch.cat((h,h_temp))
-            emb = torch.cat((emb,emb_temp))
-            for j in range(lenhs):
-                hs[j] = torch.cat((hs[j], hs_temp[j]))
-        
+        stream = self.turbo or torch.device(self.cdevice).type == "cpu"
 
         if(not self.turbo):
+            self.model1.to(self.cdevice)
+            if stream:
+                self.model2.to(self.cdevice)
+
+        x_recon = None
+        if stream:
+            for i in range(0,bs,step):
+                h,emb,hs = self.model1(x_noisy[i:i+step], t[i:i+step], cond[i:i+step])
+                out = self.model2(h,emb,x_noisy.dtype,hs,cond[i:i+step])
+                if bs <= step:
+                    x_recon = out
+                    break
+                if x_recon is None:
+                    x_recon = out.new_empty((bs,) + out.shape[1:])
+                x_recon[i:i+step] = out
+        else:
+            h = emb = hs = None
+            for i in range(0,bs,step):
+                h_temp,emb_temp,hs_temp = self.model1(x_noisy[i:i+step], t[i:i+step], cond[i:i+step])
+                if bs <= step:
+                    h,emb,hs = h_temp,emb_temp,hs_temp
+                    break
+                if h is None:
+                    h = h_temp.new_empty((bs,) + h_temp.shape[1:])
+                    emb = emb_temp.new_empty((bs,) + emb_temp.shape[1:])
+                    hs = [hs_j.new_empty((bs,) + hs_j.shape[1:]) for hs_j in hs_temp]
+                h[i:i+step] = h_temp
+                emb[i:i+step] = emb_temp
+                for hs_j, hs_temp_j in zip(hs, hs_temp):
+                    hs_j[i:i+step] = hs_temp_j
+                del h_temp,emb_temp,hs_temp
+
             self.model1.to("cpu")
             self.model2.to(self.cdevice)
-        
-        hs_temp = [hs[j][:step] for j in range(lenhs)]
-        x_recon = self.model2(h[:step],emb[:step],x_noisy.dtype,hs_temp,cond[:step])
 
-        for i in range(step,bs,step):
-
-            hs_temp = [hs[j][i:i+step] for j in range(lenhs)]
-            x_recon1 = self.model2(h[i:i+step],emb[i:i+step],x_noisy.dtype,hs_temp,cond[i:i+step])
-            x_recon = torch.cat((x_recon, x_recon1))
+            for i in range(0,bs,step):
+                # model2 pops from its list of skip connections, so each micro-batch gets a list of views
+                out = self.model2(h[i:i+step],emb[i:i+step],x_noisy.dtype,[hs_j[i:i+step] for hs_j in hs],cond[i:i+step])
+                if bs <= step:
+                    x_recon = out
+                    break
+                if x_recon is None:
+                    x_recon = out.new_empty((bs,) + out.shape[1:])
+                x_recon[i:i+step] = out
 
         if(not self.turbo):
+            self.model1.to("cpu")
             self.model2.to("cpu")
 
         if isinstance(x_recon, tuple) and not return_ids:
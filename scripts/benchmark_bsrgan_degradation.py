@@ -0,0 +1,97 @@
+"""Throughput and output statistics of the NumPy BSRGAN degradation compared to the batched torch version.
+
+    python scripts/benchmark_bsrgan_degradation.py --images path/to/images --count 256 --size 256
+    python scripts/benchmark_bsrgan_degradation.py --light --device cpu --batch 16
+"""
+import argparse
+import glob
+import os
+import random
+import time
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+from ldm.modules.image_degradation import degradation_bsrgan_batch, degradation_fn_bsr, degradation_fn_bsr_light
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("--images", type=str, default=None, help="directory of images to center crop (default: synthetic images)")
+parser.add_argument("--count", type=int, default=128, help="images to degrade with each implementation")
+parser.add_argument("--size", type=int, default=256, help="side of the high resolution crops")
+parser.add_argument("--sf", type=int, default=4, help="scale factor")
+parser.add_argument("--batch", type=int, default=32, help="batch size of the torch version")
+parser.add_argument("--light", action='store_true', help="compare bsrgan_light instead of bsrgan")
+parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+parser.add_argument("--seed", type=int, default=42)
+opt = parser.parse_args()
+
+
+def load_images():
+    rng = np.random.default_rng(opt.seed)
+    if opt.images is None:
+        images = []
+        for _ in range(opt.count):
+            y, x = np.mgrid[0:opt.size, 0:opt.size] / opt.size
+            smooth = np.stack([x, y, (x + y) / 2], axis=-1)[..., rng.permutation(3)] * 255.
+            edges = (np.sin(x * rng.uniform(10, 60)) > 0)[..., None] * rng.uniform(0, 80)
+            images.append(np.clip(smooth + edges + rng.normal(0, 8, smooth.shape), 0, 255).astype(np.uint8))
+        return images
+    paths = sorted(glob.glob(os.path.join(opt.images, "*")))[:opt.count]
+    images = []
+    for path in paths:
+        image = np.asarray(Image.open(path).convert("RGB"))
+        h, w = image.shape[:2]
+        crop = min(h, w)
+        image = image[(h - crop) // 2:(h + crop) // 2, (w - crop) // 2:(w + crop) // 2]
+        images.append(cv2.resize(image, (opt.size, opt.size), interpolation=cv2.INTER_AREA))
+    return images
+
+
+def statistics(lr, hr):
+    """[mean, std, mean abs Laplacian (detail), PSNR against the area downscaled original]"""
+    lr = lr.astype(np.float64)
+    reference = cv2.resize(hr, (lr.shape[1], lr.shape[0]), interpolation=cv2.INTER_AREA).astype(np.float64)
+    mse = np.mean((lr - reference) ** 2)
+    laplacian = np.abs(cv2.Laplacian(lr.mean(axis=2), cv2.CV_64F)).mean()
+    return [lr.mean(), lr.std(), laplacian, 10 * np.log10(255. ** 2 / max(mse, 1e-10))]
+
+
+def main():
+    images = load_images()
+    print(f"{len(images)} images of {opt.size}x{opt.size}, sf {opt.sf}, {'bsrgan_light' if opt.light else 'bsrgan'}")
+
+    random.seed(opt.seed)
+    np.random.seed(opt.seed)
+    degrade = degradation_fn_bsr_light if opt.light else degradation_fn_bsr
+    tic = time.perf_counter()
+    numpy_out = [degrade(image, sf=opt.sf)["image"] for image in images]
+    numpy_time = time.perf_counter() - tic
+
+    device = torch.device(opt.device)
+    generator = torch.Generator(device).manual_seed(opt.seed)
+    batch = torch.from_numpy(np.stack(images)).permute(0, 3, 1, 2)
+    # warm up kernels and allocator before timing
+    degradation_bsrgan_batch(batch[:opt.batch].to(device), sf=opt.sf, light=opt.light, generator=generator)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    tic = time.perf_counter()
+    torch_out = []
+    for i in range(0, len(images), opt.batch):
+        lr = degradation_bsrgan_batch(batch[i:i + opt.batch].to(device), sf=opt.sf, light=opt.light, generator=generator)
+        torch_out.extend(lr.permute(0, 2, 3, 1).cpu().numpy())
+    torch_time = time.perf_counter() - tic
+
+    names = ["mean", "std", "detail", "PSNR dB"]
+    numpy_stats = np.array([statistics(lr, hr) for lr, hr in zip(numpy_out, images)])
+    torch_stats = np.array([statistics(lr, hr) for lr, hr in zip(torch_out, images)])
+    print(f"{'':>10} {'images/s':>9} " + " ".join(f"{name:>15}" for name in names))
+    for label, seconds, stats in [("numpy", numpy_time, numpy_stats), (f"torch {device.type}", torch_time, torch_stats)]:
+        print(f"{label:>10} {len(images) / seconds:>9.1f} " +
+              " ".join(f"{m:>8.2f} ±{s:>5.2f}" for m, s in zip(stats.mean(0), stats.std(0))))
+    print(f"speedup: {numpy_time / torch_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Encode time and file size of the sample/grid encoding profiles.
+
+    python scripts/benchmark_image_encoding.py --image outputs/txt2img-samples/grid-00000.png
+    python scripts/benchmark_image_encoding.py --grid 4x4 --profiles png png-fast jpg:95 webp:90 webp-lossless
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+from frontend.image_encoding import parse_profile
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("--image", type=str, default=None, help="image to encode (default: a synthetic 512x512 image with smooth areas and detail)")
+parser.add_argument("--grid", type=str, default="1x1", help="ROWSxCOLS tiling of the image, to measure grid sized images")
+parser.add_argument("--profiles", type=str, nargs='+', default=["png", "png-fast", "jpg:100", "jpg:95", "webp:90", "webp-lossless"])
+parser.add_argument("--metadata", action='store_true', help="embed sample metadata like the webui does")
+parser.add_argument("--repeats", type=int, default=3, help="encodes per profile; the fastest is reported")
+opt = parser.parse_args()
+
+
+def synthetic_image(size=512, seed=42):
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size] / size
+    smooth = np.stack([x, y, (x + y) / 2], axis=-1) * 255.
+    noise = rng.normal(0, 24, (size, size, 3))
+    image = Image.fromarray(np.clip(smooth + noise, 0, 255).astype(np.uint8))
+    return image.filter(ImageFilter.GaussianBlur(1))
+
+
+def tile(image, grid):
+    rows, cols = (int(v) for v in grid.lower().split('x'))
+    out = Image.new('RGB', (image.width * cols, image.height * rows))
+    for i in range(rows * cols):
+        out.paste(image, box=(i % cols * image.width, i // cols * image.height))
+    return out
+
+
+def main():
+    image = Image.open(opt.image).convert('RGB') if opt.image else synthetic_image()
+    image = tile(image, opt.grid)
+    metadata = {"SD:prompt": "a photograph of an astronaut riding a horse", "SD:seed": "42", "SD:steps": "50"} if opt.metadata else None
+    raw_bytes = image.width * image.height * 3
+
+    print(f"{image.width}x{image.height}, {raw_bytes / 2**20:.1f} MiB raw")
+    print(f"{'profile':>16} {'ms':>9} {'KiB':>9} {'bits/px':>8} {'MiB/s':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for spec in opt.profiles:
+            profile = parse_profile(spec)
+            best = float('inf')
+            for _ in range(opt.repeats):
+                tic = time.perf_counter()
+                filename = profile.save(image, os.path.join(tmp, 'image'), metadata)
+                best = min(best, time.perf_counter() - tic)
+            size = os.path.getsize(filename)
+            os.remove(filename)
+            print(f"{spec:>16} {best * 1000:>9.1f} {size / 1024:>9.0f} {size * 8 / (image.width * image.height):>8.2f} {raw_bytes / 2**20 / best:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
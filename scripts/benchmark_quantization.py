@@ -0,0 +1,101 @@
+"""Accuracy and throughput of --quantize compared to fp32, on CPU.
+
+    python scripts/benchmark_quantization.py --size 512 --steps 20 [--conv]
+"""
+import argparse
+import time
+
+import k_diffusion as K
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+from ldm.modules.quantize import load_quantized_model
+from ldm.util import instantiate_from_config
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("--ckpt", type=str, default="models/ldm/stable-diffusion-v1/model.ckpt", help="path to checkpoint of model")
+parser.add_argument("--config", type=str, default="configs/stable-diffusion/v1-inference.yaml", help="path to config which constructs model")
+parser.add_argument("--prompt", type=str, default="a photograph of an astronaut riding a horse")
+parser.add_argument("--conv", action='store_true', help="also store conv weights as int8, like --quantize-conv")
+parser.add_argument("--size", type=int, default=512, help="square image size")
+parser.add_argument("--steps", type=int, default=20)
+parser.add_argument("--scale", type=float, default=7.5)
+parser.add_argument("--seed", type=int, default=42)
+parser.add_argument("--threads", type=int, default=None, help="torch CPU threads (default: torch's choice)")
+opt = parser.parse_args()
+
+
+def load_fp32_model():
+    config = OmegaConf.load(opt.config)
+    model = instantiate_from_config(config.model)
+    model.load_state_dict(torch.load(opt.ckpt, map_location="cpu")["state_dict"], strict=False)
+    return model.eval()
+
+
+def model_bytes(model):
+    total = sum(t.numel() * t.element_size() for t in model.state_dict().values() if isinstance(t, torch.Tensor))
+    # dynamically quantized linear layers keep their weights in packed params
+    for module in model.modules():
+        if isinstance(module, torch.nn.quantized.dynamic.Linear):
+            weight, bias = module._weight_bias()
+            total += weight.numel() + (bias.numel() * bias.element_size() if bias is not None else 0)
+    return total
+
+
+def run(model):
+    """returns (conditioning, decoded uint8 image, seconds for the text encoder, seconds for sampling)"""
+    model.cond_stage_model.device = "cpu"
+    model_wrap = K.external.CompVisDenoiser(model)
+
+    def denoiser(x, sigma, uncond, cond):
+        uncond, cond = model_wrap(torch.cat([x] * 2), torch.cat([sigma] * 2), cond=torch.cat([uncond, cond])).chunk(2)
+        return uncond + (cond - uncond) * opt.scale
+
+    with torch.no_grad():
+        tic = time.perf_counter()
+        c = model.get_learned_conditioning([opt.prompt])
+        uc = model.get_learned_conditioning([""])
+        text_time = time.perf_counter() - tic
+
+        torch.manual_seed(opt.seed)
+        sigmas = model_wrap.get_sigmas(opt.steps)
+        x = torch.randn([1, 4, opt.size // 8, opt.size // 8]) * sigmas[0]
+        tic = time.perf_counter()
+        samples = K.sampling.sample_euler(denoiser, x, sigmas, extra_args={'cond': c, 'uncond': uc}, disable=True)
+        sample_time = time.perf_counter() - tic
+
+        image = torch.clamp((model.decode_first_stage(samples) + 1.0) / 2.0, min=0.0, max=1.0)[0]
+    image = (255. * image.permute(1, 2, 0).numpy()).astype(np.uint8)
+    return c, image, text_time, sample_time
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    return float('inf') if mse == 0 else 10 * np.log10(255. ** 2 / mse)
+
+
+def main():
+    if opt.threads:
+        torch.set_num_threads(opt.threads)
+
+    model = load_fp32_model()
+    fp32_bytes = model_bytes(model)
+    c_ref, image_ref, text_ref, sample_ref = run(model)
+    del model
+
+    model = load_quantized_model(OmegaConf.load(opt.config), opt.ckpt, opt.conv)
+    int8_bytes = model_bytes(model)
+    c, image, text_time, sample_time = run(model)
+
+    cosine = torch.nn.functional.cosine_similarity(c.flatten(1), c_ref.flatten(1)).item()
+    diff = np.abs(image.astype(np.int16) - image_ref.astype(np.int16)).mean()
+    print(f"{'':>10} {'weights MiB':>12} {'text enc s':>11} {'sampling s':>11} {'s/step':>8}")
+    print(f"{'fp32':>10} {fp32_bytes / 2**20:>12.0f} {text_ref:>11.3f} {sample_ref:>11.2f} {sample_ref / opt.steps:>8.2f}")
+    print(f"{'int8':>10} {int8_bytes / 2**20:>12.0f} {text_time:>11.3f} {sample_time:>11.2f} {sample_time / opt.steps:>8.2f}")
+    print(f"speedup: text encoder {text_ref / text_time:.2f}x, sampling {sample_ref / sample_time:.2f}x")
+    print(f"accuracy: conditioning cosine similarity {cosine:.5f}, image mean abs diff {diff:.2f}, PSNR {psnr(image, image_ref):.2f} dB")
+
+
+if __name__ == "__main__":
+    main()
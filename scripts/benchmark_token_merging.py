@@ -0,0 +1,88 @@
+"""Benchmark token merging: sampling time and difference of the decoded images against unmerged sampling.
+
+    python scripts/benchmark_token_merging.py --ratios 0.5 --ratios 0.5,0.25 --sizes 512 768
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+from contextlib import nullcontext
+from omegaconf import OmegaConf
+from torch import autocast
+
+from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.modules.token_merging import apply_token_merging, remove_token_merging
+from ldm.util import instantiate_from_config
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("--ckpt", type=str, default="models/ldm/stable-diffusion-v1/model.ckpt", help="path to checkpoint of model")
+parser.add_argument("--config", type=str, default="configs/stable-diffusion/v1-inference.yaml", help="path to config which constructs model")
+parser.add_argument("--prompt", type=str, default="a photograph of an astronaut riding a horse")
+parser.add_argument("--ratios", type=str, action='append', help="token merging ratios per resolution level to compare, comma separated; may be given several times")
+parser.add_argument("--merge-ff", action='store_true', help="also merge tokens before the feed forward layers")
+parser.add_argument("--sizes", type=int, nargs='+', default=[512, 768], help="square image sizes to benchmark")
+parser.add_argument("--steps", type=int, default=20)
+parser.add_argument("--scale", type=float, default=7.5)
+parser.add_argument("--seed", type=int, default=42)
+parser.add_argument("--repeats", type=int, default=2, help="timed runs per setting; the fastest is reported")
+parser.add_argument("--precision", type=str, choices=["full", "autocast"], default="autocast")
+opt = parser.parse_args()
+
+
+def load_model():
+    config = OmegaConf.load(opt.config)
+    sd = torch.load(opt.ckpt, map_location="cpu")["state_dict"]
+    model = instantiate_from_config(config.model)
+    model.load_state_dict(sd, strict=False)
+    model = model.half() if opt.precision == "autocast" else model
+    return model.cuda().eval()
+
+
+def sample(model, sampler, size):
+    """returns the decoded image as uint8 [h, w, c] and the fastest sampling time"""
+    precision_scope = autocast if opt.precision == "autocast" else nullcontext
+    best = float('inf')
+    with torch.no_grad(), precision_scope("cuda"), model.ema_scope():
+        c = model.get_learned_conditioning([opt.prompt])
+        uc = model.get_learned_conditioning([""])
+        shape = [4, size // 8, size // 8]
+        for _ in range(opt.repeats):
+            torch.manual_seed(opt.seed)
+            x_T = torch.randn([1] + shape, device="cuda")
+            torch.cuda.synchronize()
+            tic = time.perf_counter()
+            samples, _ = sampler.sample(S=opt.steps, conditioning=c, batch_size=1, shape=shape, verbose=False,
+                                        unconditional_guidance_scale=opt.scale, unconditional_conditioning=uc,
+                                        eta=0.0, x_T=x_T)
+            torch.cuda.synchronize()
+            best = min(best, time.perf_counter() - tic)
+        x = model.decode_first_stage(samples)
+    x = torch.clamp((x + 1.0) / 2.0, min=0.0, max=1.0)[0]
+    return (255. * x.permute(1, 2, 0).float().cpu().numpy()).astype(np.uint8), best
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    return float('inf') if mse == 0 else 10 * np.log10(255. ** 2 / mse)
+
+
+def main():
+    model = load_model()
+    sampler = DDIMSampler(model)
+    ratio_sets = opt.ratios or ["0.5"]
+
+    print(f"{'size':>5} {'ratios':>12} {'seconds':>8} {'speedup':>8} {'mean abs diff':>14} {'PSNR dB':>8}")
+    for size in opt.sizes:
+        remove_token_merging(model)
+        reference, base_time = sample(model, sampler, size)
+        print(f"{size:>5} {'none':>12} {base_time:>8.2f} {1.0:>8.2f} {0.0:>14.2f} {'-':>8}")
+        for ratios in ratio_sets:
+            apply_token_merging(model, [float(r) for r in ratios.split(',')], opt.merge_ff)
+            image, merged_time = sample(model, sampler, size)
+            diff = np.abs(image.astype(np.int16) - reference.astype(np.int16)).mean()
+            print(f"{size:>5} {ratios:>12} {merged_time:>8.2f} {base_time / merged_time:>8.2f} {diff:>14.2f} {psnr(image, reference):>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Compare the vectorized imresize / imresize_np with the reference loop implementations, bit for bit.
+
+    python scripts/check_imresize.py
+    python scripts/check_imresize.py --sizes 37x53 64x64 --scales 2 0.5 0.25
+"""
+import argparse
+import sys
+
+import torch
+
+from ldm.modules.image_degradation import utils_image as util
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("--sizes", type=str, nargs="+", default=["64x64", "37x53", "53x37", "17x5"], help="HxW of the inputs")
+parser.add_argument("--scales", type=float, nargs="+", default=[4, 3, 2, 1.5, 0.75, 0.5, 1 / 3, 0.25])
+parser.add_argument("--channels", type=int, nargs="+", default=[3, 1], help="channels of the CHW / HWC inputs, besides HW")
+parser.add_argument("--seed", type=int, default=42)
+opt = parser.parse_args()
+
+
+def compare(name, new, old):
+    """max abs difference of new from old (0 if bit-equal), printed unless they are bit-equal"""
+    new, old = torch.as_tensor(new), torch.as_tensor(old)
+    if new.shape != old.shape:
+        print(f"MISMATCH {name}: shapes {tuple(new.shape)} / {tuple(old.shape)}")
+        return float("inf")
+    if torch.equal(new, old):
+        return 0.
+    difference = (new - old).abs().max().item()
+    print(f"MISMATCH {name}: max abs difference {difference:.3g}")
+    return difference
+
+
+def main():
+    generator = torch.Generator().manual_seed(opt.seed)
+    differences, skipped = [], 0
+    for size in opt.sizes:
+        h, w = map(int, size.split("x"))
+        for scale in opt.scales:
+            # antialiasing only changes downscaling
+            for antialiasing in ([True, False] if scale < 1 else [True]):
+                cases = [("HW", torch.rand(h, w, generator=generator))]
+                cases += [(f"{c} channels", torch.rand(c, h, w, generator=generator)) for c in opt.channels]
+                for layout, img in cases:
+                    name = f"{size} x{scale:.4g} antialiasing={antialiasing} {layout}"
+                    img_np = (img if img.dim() == 2 else img.permute(1, 2, 0)).contiguous().numpy()
+                    for label, new, loop, arg in [("imresize", util.imresize, util.imresize_loop, img),
+                                                  ("imresize_np", util.imresize_np, util.imresize_np_loop, img_np)]:
+                        try:
+                            # the loop versions unsqueeze their input in place
+                            old = loop(arg.copy() if label == "imresize_np" else arg.clone(), scale, antialiasing)
+                        except RuntimeError as e:
+                            # the loop versions fail when a border needs no symmetric copies, or more than the input has
+                            print(f"SKIPPED {label} {name}: the loop version fails ({str(e).splitlines()[0]})")
+                            skipped += 1
+                            continue
+                        differences.append(compare(f"{label} {name}", new(arg, scale, antialiasing), old))
+    equal = sum(d == 0 for d in differences)
+    print(f"{equal}/{len(differences)} bit-equal, largest difference {max(differences, default=0.):.3g}, "
+          f"{skipped} skipped")
+    return 0 if equal == len(differences) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,55 @@
+"""Preprocess an image dataset once into memory-mapped shards, for the shards parameter of the ldm datasets.
+
+    python scripts/preprocess_dataset.py --txt_file data/lsun/church_outdoor_train.txt --data_root data/lsun/churches --size 256 --out data/lsun/churches-train-256
+    python scripts/preprocess_dataset.py --imagenet-sr train --size 512 --out data/imagenet-sr-train-512
+
+then in the data config, e.g. for LSUNChurchesTrain:
+
+    params:
+      size: 256
+      shards: data/lsun/churches-train-256
+"""
+import argparse
+import os
+import pickle
+
+from ldm.data.shards import INTERPOLATIONS, write_shards
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("--txt_file", type=str, default=None, help="list of image paths relative to --data_root, as for LSUNBase")
+parser.add_argument("--data_root", type=str, default=None)
+parser.add_argument("--imagenet-sr", type=str, choices=["train", "validation"], default=None, help="preprocess the images of ImageNetSRTrain / ImageNetSRValidation instead of --txt_file")
+parser.add_argument("--imagenet-root", type=str, default=None, help="data_root of the ImageNet datasets (default: their cache directory)")
+parser.add_argument("--size", type=int, required=True, help="side of the stored center crops; for ImageNetSR at least size / min_crop_f of the training config")
+parser.add_argument("--interpolation", type=str, choices=list(INTERPOLATIONS), default="bicubic", help="resampling of the crops; LSUN datasets use their interpolation parameter, ImageNetSR resizes with cv2's area interpolation")
+parser.add_argument("--out", type=str, required=True, help="output directory")
+parser.add_argument("--shard-size", type=int, default=4096, help="images per shard")
+parser.add_argument("--workers", type=int, default=os.cpu_count(), help="decoding processes")
+opt = parser.parse_args()
+
+
+def imagenet_sr_images(split):
+    # the images of ImageNetSRTrain.get_base / ImageNetSRValidation.get_base, in the same order
+    from ldm.data.imagenet import ImageNetTrain, ImageNetValidation
+    dataset = {"train": ImageNetTrain, "validation": ImageNetValidation}[split]
+    dset = dataset(process_images=False, data_root=opt.imagenet_root)
+    with open(f"data/imagenet_{'train' if split == 'train' else 'val'}_hr_indices.p", "rb") as f:
+        indices = pickle.load(f)
+    return dset.datadir, [dset.relpaths[i] for i in indices]
+
+
+def main():
+    if opt.imagenet_sr:
+        data_root, relpaths = imagenet_sr_images(opt.imagenet_sr)
+    else:
+        if opt.txt_file is None or opt.data_root is None:
+            parser.error("--txt_file and --data_root are required without --imagenet-sr")
+        data_root = opt.data_root
+        with open(opt.txt_file, "r") as f:
+            relpaths = f.read().splitlines()
+    write_shards(opt.out, data_root, relpaths, opt.size, interpolation=opt.interpolation,
+                 shard_size=opt.shard_size, workers=opt.workers)
+
+
+if __name__ == "__main__":
+    main()
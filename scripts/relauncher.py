@@ -1,4 +1,6 @@
-import os, time
+import json, shlex, subprocess, sys, time
+from collections import deque
+from urllib.request import urlopen
 
 # USER CHANGABLE ARGUMENTS
 
@@ -19,6 +21,14 @@ optimized_turbo = False
 # Creates a public xxxxx.gradio.app share link to allow others to use your interface (requires properly forwarded ports to work correctly)
 share = False
 
+# Keep a second server loaded in the background, which takes over within seconds when the running one crashes or hangs.
+# Its model waits in CPU memory, so it needs little VRAM (GFPGAN and RealESRGAN are loaded on the GPU though)
+standby = True
+
+# Share the model weights of the running and the standby server through a memory-mapped file next to the checkpoint,
+# so the standby server costs little extra RAM and loads in seconds (the file takes as much disk space as the weights)
+share_weights = True
+
 
 # Enter other `--arguments` you wish to use - Must be entered as a `--argument ` syntax
 additional_arguments = ""
@@ -39,26 +49,129 @@ if optimized == True:
     common_arguments += "--optimized "
 if share == True:
     common_arguments += "--share "
+if share_weights == True and not (optimized or optimized_turbo):
+    common_arguments += "--mmap-weights "
 
 if open_in_browser == True:
     inbrowser_argument = "--inbrowser "
 else:
     inbrowser_argument = ""
 
-n = 0
-while True:
-    if n == 0:
-        print('Relauncher: Launching...')
-        os.system(f"python scripts/webui.py {common_arguments} {inbrowser_argument} {additional_arguments}")
-        
-    else:
-        print(f'\tRelaunch count: {n}')
-        print('Relauncher: Launching...')
-        os.system(f"python scripts/webui.py {common_arguments} {additional_arguments}")
-    
-    n += 1
-    if n > 100:
-        print ('Too many relaunch attempts. Aborting...')
-        break
-    print('Relauncher: Process is ending. Relaunching in 1s...')
-    time.sleep(1)
+# The servers answer GET /health on these ports of 127.0.0.1
+health_ports = (7870, 7871)
+# Seconds between health checks, and failed checks in a row after which a running server counts as hung
+health_interval = 5
+unhealthy_limit = 3
+# Seconds a server may take to start before failed health checks count
+startup_grace = 600
+# Give up after more than crash_budget crashes within crash_window seconds
+crash_budget = 5
+crash_window = 600
+# Relaunches wait 1, 2, 4, ... up to max_backoff seconds, depending on the number of recent crashes
+max_backoff = 60
+
+
+class Server:
+    def __init__(self, arguments, health_port, standby):
+        self.health_port = health_port
+        self.standby = standby
+        command = [sys.executable, 'scripts/webui.py', *arguments, '--health-port', str(health_port)]
+        if standby:
+            command.append('--standby')
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+        self.started = time.time()
+        self.healthy_once = False
+        self.failed_checks = 0
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def health(self):
+        try:
+            with urlopen(f'http://127.0.0.1:{self.health_port}/health', timeout=health_interval) as response:
+                return json.load(response).get('status')
+        except (OSError, ValueError):
+            return None
+
+    def hung(self):
+        if self.health() == 'ok':
+            self.healthy_once = True
+            self.failed_checks = 0
+            return False
+        if not self.healthy_once and time.time() - self.started < startup_grace:
+            return False
+        self.failed_checks += 1
+        return self.failed_checks >= unhealthy_limit
+
+    def activate(self):
+        # the standby server is waiting for a line on its stdin
+        self.process.stdin.write(b'activate\n')
+        self.process.stdin.flush()
+        self.standby = False
+        self.started = time.time()
+
+    def stop(self):
+        if self.alive():
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+
+def main():
+    arguments = shlex.split(f"{common_arguments} {additional_arguments}")
+    crashes = deque()
+    print('Relauncher: Launching...')
+    active = Server(arguments + shlex.split(inbrowser_argument), health_ports[0], standby=False)
+    spare = None
+    next_spare = 0
+    try:
+        while True:
+            time.sleep(health_interval)
+            if standby and spare is None and active.healthy_once and time.time() >= next_spare:
+                print('Relauncher: Loading a standby server...')
+                spare = Server(arguments, health_ports[1] if active.health_port == health_ports[0] else health_ports[0], standby=True)
+            if spare is not None and not spare.alive():
+                print(f'Relauncher: The standby server exited with code {spare.process.returncode}')
+                spare = None
+                next_spare = time.time() + max_backoff
+
+            if active.alive() and not active.hung():
+                continue
+            if active.alive():
+                print('Relauncher: Server is not responding, stopping it...')
+            else:
+                print(f'Relauncher: Server exited with code {active.process.returncode}')
+            active.stop()
+
+            now = time.time()
+            crashes.append(now)
+            while crashes and crashes[0] < now - crash_window:
+                crashes.popleft()
+            if len(crashes) > crash_budget:
+                print(f'Relauncher: {len(crashes)} crashes within {crash_window}s. Aborting...')
+                break
+            backoff = min(max_backoff, 2 ** (len(crashes) - 1))
+            print(f'\tRelaunch count: {len(crashes)} in the last {crash_window}s')
+
+            if spare is not None:
+                print('Relauncher: Switching to the standby server...')
+                spare.activate()
+                active, spare = spare, None
+                next_spare = now + backoff
+            else:
+                print(f'Relauncher: Relaunching in {backoff}s...')
+                time.sleep(backoff)
+                active = Server(arguments, active.health_port, standby=False)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for server in (active, spare):
+            if server is not None:
+                server.stop()
+
+
+if __name__ == '__main__':
+    main()
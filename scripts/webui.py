@@ -5,6 +5,9 @@ import cv2
 from frontend.frontend import draw_gradio_ui
 from frontend.job_manager import JobManager, JobInfo
 from frontend.ui_functions import resize_image
+from frontend.image_encoding import ImageEncoder, parse_profile, remove_stale_placeholders, IMAGE_EXTENSIONS
+from frontend.result_cache import ResultCache, CachedResult
+from frontend.result_store import ResultImages
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument("--ckpt", type=str, default="models/ldm/stable-diffusion-v1/model.ckpt", help="path to checkpoint of model",)
 parser.add_argument("--cli", type=str, help="don't launch web server, take Python function kwargs from this file.", default=None)
@@ -18,7 +21,11 @@ parser.add_argument("--gfpgan-cpu", action='store_true', help="run GFPGAN on cpu
 parser.add_argument("--gfpgan-dir", type=str, help="GFPGAN directory", default=('./src/gfpgan' if os.path.exists('./src/gfpgan') else './GFPGAN')) # i disagree with where you're putting it but since all guidefags are doing it this way, there you go
 parser.add_argument("--gfpgan-gpu", type=int, help="run GFPGAN on specific gpu (overrides --gpu) ", default=0)
 parser.add_argument("--gpu", type=int, help="choose which GPU to use if you have multiple", default=0)
-parser.add_argument("--grid-format", type=str, help="png for lossless png files; jpg:quality for lossy jpeg; webp:quality for lossy webp, or webp:-compression for lossless webp", default="jpg:95")
+parser.add_argument("--grid-format", type=str, help="png for lossless png files; png-fast for faster, larger png files; jpg:quality for lossy jpeg; webp:quality for lossy webp, or webp-lossless (webp:-compression) for lossless webp", default="jpg:95")
+parser.add_argument("--sample-format", type=str, help="format of saved samples, with the same choices as --grid-format; the 'save as jpg' toggle overrides it with jpg:100", default="png")
+parser.add_argument("--encode-threads", type=int, help="threads encoding saved samples and grids in the background", default=4)
+parser.add_argument("--imglab-decode-threads", type=int, help="threads decoding the files of an Image Lab batch ahead of processing", default=4)
+parser.add_argument("--imglab-queue-depth", type=int, help="images an Image Lab batch decodes ahead and has waiting to be saved", default=8)
 parser.add_argument("--inbrowser", action='store_true', help="automatically launch the interface in a new tab on the default browser", default=False)
 parser.add_argument("--ldsr-dir", type=str, help="LDSR directory", default=('./src/latent-diffusion' if os.path.exists('./src/latent-diffusion') else './LDSR'))
 parser.add_argument("--n_rows", type=int, default=-1, help="rows in the grid; use -1 for autodetect and 0 for n_rows to be same as batch_size (default: -1)",)
@@ -42,6 +49,30 @@ parser.add_argument("--skip-grid", action='store_true', help="do not save a grid
 parser.add_argument("--skip-save", action='store_true', help="do not save indiviual samples. For speed measurements.", default=False)
 parser.add_argument('--no-job-manager', action='store_true', help="Don't use the experimental job manager on top of gradio", default=False)
 parser.add_argument("--max-jobs", type=int, help="Maximum number of concurrent 'generate' commands", default=1)
+parser.add_argument("--result-memory-mb", type=int, help="memory budget in MiB for finished job results kept by the job manager before they are spilled to disk", default=1024)
+parser.add_argument("--result-ttl", type=int, help="seconds to keep results of finished jobs that were never shown (e.g. the browser was closed)", default=3600)
+parser.add_argument("--queue-timeout", type=int, help="seconds a queued job keeps its place while its page doesn't ask for its status (pages ask every few seconds, background tabs may only do so once a minute)", default=300)
+parser.add_argument("--result-spill-dir", type=str, help="directory for job result thumbnails and spilled images, in a subdirectory per server process which is removed on exit (or at a later start, once older than --result-ttl); must be inside the working directory to open full size images in the browser", default=os.path.join("outputs", "job-results"))
+parser.add_argument("--result-cache-mb", type=int, help="disk budget in MiB for cached generation results, which answer repeated identical requests without generating again; 0 to disable", default=1024)
+parser.add_argument("--result-cache-dir", type=str, help="directory of the generation result cache", default=os.path.join("outputs", "result-cache"))
+parser.add_argument("--device", type=str, help="device to run the model on; auto picks cuda when available", choices=["auto", "cuda", "cpu"], default="auto")
+parser.add_argument("--bf16", action='store_true', help="autocast to bfloat16 instead of float16 (the only autocast on CPU)", default=False)
+parser.add_argument("--threads", type=int, help="torch intra-op CPU threads (default: the number of usable cores)", default=None)
+parser.add_argument("--interop-threads", type=int, help="torch inter-op CPU threads (default: a quarter of the usable cores)", default=None)
+parser.add_argument("--quantize", action='store_true', help="run the model on CPU with int8 dynamic quantization of the attention, feed forward and CLIP text encoder linear layers; the quantized model is cached next to the checkpoint (not supported with --optimized)", default=False)
+parser.add_argument("--quantize-conv", action='store_true', help="with --quantize, also store conv weights as int8 (saves memory, not time)", default=False)
+parser.add_argument("--token-merging", type=str, help="comma separated fractions of latent tokens to merge before self-attention, one per UNet resolution level starting at full resolution (e.g. 0.5 or 0.5,0.25); at most 0.75", default=None)
+parser.add_argument("--token-merging-ff", action='store_true', help="with --token-merging, also merge tokens before the transformer feed forward layers", default=False)
+parser.add_argument("--step-cache-interval", type=int, help="run the full UNet only every N model evaluations and reuse its deep features in between; 0 or 1 to disable (not supported with --optimized)", default=0)
+parser.add_argument("--step-cache-depth", type=int, help="with --step-cache-interval, number of shallow UNet blocks (each side) recomputed on every evaluation", default=3)
+parser.add_argument("--compile", action='store_true', help="run the UNet and the VAE decoder through torch.jit traced graphs for the sizes in --compile-buckets; other sizes run eagerly (not supported with --optimized or --step-cache-interval)", default=False)
+parser.add_argument("--compile-buckets", type=str, help="with --compile, comma separated BATCHxHEIGHTxWIDTH image sizes to trace, e.g. 1x512x512,4x512x512", default="1x512x512")
+parser.add_argument("--compile-warmup", action='store_true', help="with --compile, trace all buckets at startup instead of on their first use", default=False)
+parser.add_argument("--init-latent-cache-mb", type=int, help="CPU memory budget in MiB for caching encoded img2img init images and masks; 0 to disable", default=256)
+parser.add_argument("--mmap-weights", action='store_true', help="cache the model weights next to the checkpoint in a memory-mapped file, which processes loading the same model share (not supported with --optimized or --quantize)", default=False)
+parser.add_argument("--standby", action='store_true', help="load everything with the model in CPU memory, then wait for a line on stdin before moving it to the GPU and serving; used by scripts/relauncher.py to keep a warm spare server", default=False)
+parser.add_argument("--health-port", type=int, help="serve GET /health on this port of 127.0.0.1, for scripts/relauncher.py", default=None)
+parser.add_argument("--upscale-memory-mb", type=int, help="VRAM budget in MiB for RealESRGAN activations; images are upscaled in batches of overlapping tiles that fit it (default: the free VRAM)", default=None)
 opt = parser.parse_args()
 
 #Should not be needed anymore
@@ -61,28 +92,44 @@ import numpy as np
 import pynvml
 import random
 import threading, asyncio
+import tempfile
 import time
 import torch
 import torch.nn as nn
 import yaml
 import glob
+import hashlib
+import gc
+import json
+import traceback
 from typing import List, Union, Dict
 from pathlib import Path
-from collections import namedtuple
+from collections import namedtuple, OrderedDict, deque
 
-from contextlib import contextmanager, nullcontext
+from contextlib import contextmanager, nullcontext, closing
+from concurrent.futures import ThreadPoolExecutor
 from einops import rearrange, repeat
 from itertools import islice
 from omegaconf import OmegaConf
 from PIL import Image, ImageFont, ImageDraw, ImageFilter, ImageOps
 from PIL.PngImagePlugin import PngInfo
 from io import BytesIO
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import URLError
+from urllib.request import urlopen
 import base64
 import re
 from torch import autocast
 from ldm.models.diffusion.ddim import DDIMSampler
 from ldm.models.diffusion.plms import PLMSSampler
 from ldm.util import instantiate_from_config
+from ldm.modules.diffusionmodules.util import CFGBuffers
+from ldm.modules.token_merging import apply_token_merging
+from ldm.modules.quantize import load_quantized_model
+from ldm.modules.attention import set_query_chunk_size
+from ldm.modules.compiled import BucketedTrace, compile_model, parse_buckets
+from ldm.modules.mapped_weights import load_mapped_weights, save_mapped_weights
+from ldm.modules.tiled_upscale import TiledUpscaler, blend_window, tile_starts
 
 try:
     # this silences the annoying "Some weights of the model checkpoint were not used when initializing..." message at start.
@@ -95,6 +142,7 @@ except:
 # this is a fix for Windows users. Without it, javascript files will be served with text/html content-type and the bowser will not show any UI
 mimetypes.init()
 mimetypes.add_type('application/javascript', '.js')
+mimetypes.add_type('image/webp', '.webp')
 
 # some of those options should not be changed at all because they would break the model, so I removed them from options.
 opt_C = 4
@@ -110,30 +158,47 @@ LDSR_dir = opt.ldsr_dir
 if opt.optimized_turbo:
     opt.optimized = True
 
+if opt.quantize:
+    opt.device = "cpu"
+elif opt.device == "auto":
+    opt.device = "cuda" if torch.cuda.is_available() else "cpu"
+device = torch.device(f"cuda:{opt.gpu}") if opt.device == "cuda" else torch.device("cpu")
+if device.type == "cpu":
+    # half precision is not supported by most CPU kernels, the extra models have to run on CPU as well
+    opt.no_half = True
+    opt.extra_models_cpu = True
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    torch.set_num_threads(opt.threads or cores)
+    torch.set_num_interop_threads(opt.interop_threads or max(1, cores // 4))
+    print(f"Running on CPU with {torch.get_num_threads()} threads and {torch.get_num_interop_threads()} inter-op threads")
+elif opt.threads or opt.interop_threads:
+    if opt.threads:
+        torch.set_num_threads(opt.threads)
+    if opt.interop_threads:
+        torch.set_num_interop_threads(opt.interop_threads)
+
+# a --standby server keeps the model in CPU memory until it is activated
+load_device = torch.device("cpu") if opt.standby else device
+
 if opt.no_job_manager:
     job_manager = None
 else:
-    job_manager = JobManager(opt.max_jobs)
+    job_manager = JobManager(opt.max_jobs, result_memory_budget=opt.result_memory_mb * 1_048_576,
+                             result_ttl=opt.result_ttl, result_spill_dir=opt.result_spill_dir,
+                             waiter_timeout=opt.queue_timeout)
     opt.max_jobs += 1 # Leave a free job open for button clicks
 
 # should probably be moved to a settings menu in the UI at some point
-grid_format = [s.lower() for s in opt.grid_format.split(':')]
-grid_lossless = False
-grid_quality = 100
-if grid_format[0] == 'png':
-    grid_ext = 'png'
-    grid_format = 'png'
-elif grid_format[0] in ['jpg', 'jpeg']:
-    grid_quality = int(grid_format[1]) if len(grid_format) > 1 else 100
-    grid_ext = 'jpg'
-    grid_format = 'jpeg'
-elif grid_format[0] == 'webp':
-    grid_quality = int(grid_format[1]) if len(grid_format) > 1 else 100
-    grid_ext = 'webp'
-    grid_format = 'webp'
-    if grid_quality < 0: # e.g. webp:-100 for lossless mode
-        grid_lossless = True
-        grid_quality = abs(grid_quality)
+grid_profile = parse_profile(opt.grid_format)
+sample_profile = parse_profile(opt.sample_format)
+jpg_sample_profile = parse_profile("jpg:100")
+image_encoder = ImageEncoder(opt.encode_threads)
+for outdir in {opt.outdir_txt2img or opt.outdir or "outputs/txt2img-samples",
+               opt.outdir_img2img or opt.outdir or "outputs/img2img-samples",
+               opt.outdir_imglab or opt.outdir or "outputs/imglab-samples"}:
+    # placeholders of images that were queued when a previous run died
+    remove_stale_placeholders(outdir)
+result_cache = ResultCache(opt.result_cache_dir, opt.result_cache_mb * 1_048_576) if opt.result_cache_mb > 0 else None
 
 
 def chunk(it, size):
@@ -142,6 +207,14 @@ def chunk(it, size):
 
 
 def load_model_from_config(config, ckpt, verbose=False):
+    dtype = torch.float32 if opt.no_half else torch.float16
+    if opt.mmap_weights:
+        model = instantiate_from_config(config.model)
+        if load_mapped_weights(model, ckpt, dtype):
+            model.to(load_device)
+            model.eval()
+            return model
+        del model
     print(f"Loading model from {ckpt}")
     pl_sd = torch.load(ckpt, map_location="cpu")
     if "global_step" in pl_sd:
@@ -155,8 +228,13 @@ def load_model_from_config(config, ckpt, verbose=False):
     if len(u) > 0 and verbose:
         print("unexpected keys:")
         print(u)
+    del pl_sd, sd
 
-    model.cuda()
+    if opt.mmap_weights:
+        save_mapped_weights(model, ckpt, dtype)
+        # share the weights with later processes right away
+        load_mapped_weights(model, ckpt, dtype)
+    model.to(load_device)
     model.eval()
     return model
 
@@ -168,6 +246,16 @@ def load_sd_from_config(ckpt, verbose=False):
     sd = pl_sd["state_dict"]
     return sd
 
+def is_oom_error(e):
+    """whether e is an allocation failure, which leaves the process usable once the failed attempt is freed"""
+    message = str(e)
+    return isinstance(e, OutOfMemory) or 'out of memory' in message or "can't allocate memory" in message
+
+def is_fatal_error(e):
+    """whether e leaves the CUDA context unusable (e.g. a device-side assert), so only a restart helps"""
+    message = str(e)
+    return not is_oom_error(e) and any(s in message for s in ('CUDA error', 'CUBLAS_STATUS', 'CUDNN_STATUS'))
+
 def crash(e, s):
     global model
     global device
@@ -197,6 +285,8 @@ class MemUsageMonitor(threading.Thread):
         self.name = name
 
     def run(self):
+        if device.type != "cuda":
+            return
         try:
             pynvml.nvmlInit()
         except:
@@ -223,18 +313,61 @@ class MemUsageMonitor(threading.Thread):
         self.stop_flag = True
         return self.max_usage, self.total
 
+class GuidanceSchedule:
+    """classifier free guidance scale over the course of sampling. the scale follows `curve` from cfg_scale towards 1
+    and guidance stops once `end` (a fraction of the steps) is reached; steps at scale 1 only evaluate the conditional
+    batch, and the UNet evaluations avoided that way are counted in saved_evals"""
+    curves = {
+        'constant': lambda scale, t: scale,
+        'linear': lambda scale, t: scale + (1. - scale) * t,
+        'cosine': lambda scale, t: 1. + (scale - 1.) * 0.5 * (1. + math.cos(math.pi * t)),
+    }
+
+    def __init__(self, scale, end=1.0, curve='constant'):
+        if curve not in self.curves:
+            raise Exception("Unknown guidance curve: " + curve)
+        self.scale = float(scale)
+        self.end = float(end)
+        self.curve = self.curves[curve]
+        self.curve_name = curve
+        self.evals = 0
+        self.saved_evals = 0
+
+    def __call__(self, progress, batch_size):
+        """returns the guidance scale at `progress` (0 to 1 through the sampling steps) and counts the evaluations"""
+        scale = 1. if progress >= self.end else self.curve(self.scale, progress / self.end)
+        if scale == 1.:
+            self.evals += batch_size
+            self.saved_evals += batch_size
+        else:
+            self.evals += 2 * batch_size
+        return scale
+
+
+def sigma_guidance_scale(cond_scale, sigmas, sigma, batch_size):
+    """resolves a GuidanceSchedule to the scale at the current sigma of a k-diffusion sampler"""
+    if not callable(cond_scale):
+        return cond_scale
+    # sub-step evaluations (dpm_2, heun) count towards the step whose sigma they start from
+    step = int((sigmas >= sigma[0]).sum()) - 1
+    return cond_scale(max(step, 0) / (len(sigmas) - 1), batch_size)
+
+
 class CFGMaskedDenoiser(nn.Module):
-    def __init__(self, model):
+    def __init__(self, model, sigmas=None):
         super().__init__()
         self.inner_model = model
+        self.sigmas = sigmas
+        self.buffers = CFGBuffers()
 
     def forward(self, x, sigma, uncond, cond, cond_scale, mask, x0, xi):
-        x_in = x
-        x_in = torch.cat([x_in] * 2)
-        sigma_in = torch.cat([sigma] * 2)
-        cond_in = torch.cat([uncond, cond])
-        uncond, cond = self.inner_model(x_in, sigma_in, cond=cond_in).chunk(2)
-        denoised = uncond + (cond - uncond) * cond_scale
+        cond_scale = sigma_guidance_scale(cond_scale, self.sigmas, sigma, x.shape[0])
+        if cond_scale == 1.:
+            denoised = self.inner_model(x, sigma, cond=cond)
+        else:
+            x_in, sigma_in, cond_in = self.buffers.inputs(x, sigma, uncond, cond)
+            uncond, cond = self.inner_model(x_in, sigma_in, cond=cond_in).chunk(2)
+            denoised = uncond + (cond - uncond) * cond_scale
 
         if mask is not None:
             assert x0 is not None
@@ -245,35 +378,90 @@ class CFGMaskedDenoiser(nn.Module):
         return denoised
 
 class CFGDenoiser(nn.Module):
-    def __init__(self, model):
+    def __init__(self, model, sigmas=None):
         super().__init__()
         self.inner_model = model
+        self.sigmas = sigmas
+        self.buffers = CFGBuffers()
 
     def forward(self, x, sigma, uncond, cond, cond_scale):
-        x_in = torch.cat([x] * 2)
-        sigma_in = torch.cat([sigma] * 2)
-        cond_in = torch.cat([uncond, cond])
+        cond_scale = sigma_guidance_scale(cond_scale, self.sigmas, sigma, x.shape[0])
+        if cond_scale == 1.:
+            return self.inner_model(x, sigma, cond=cond)
+        x_in, sigma_in, cond_in = self.buffers.inputs(x, sigma, uncond, cond)
         uncond, cond = self.inner_model(x_in, sigma_in, cond=cond_in).chunk(2)
         return uncond + (cond - uncond) * cond_scale
 
 
 class KDiffusionSampler:
-    def __init__(self, m, sampler):
+    def __init__(self, m, sampler, sigma_schedule='default'):
         self.model = m
         self.model_wrap = K.external.CompVisDenoiser(m)
         self.schedule = sampler
+        self.sigma_schedule = sigma_schedule
     def get_sampler_name(self):
         return self.schedule
+    @staticmethod
+    def is_available(sampler, sigma_schedule='default'):
+        """whether the installed k-diffusion ships the sampler and sigma schedule"""
+        return f'sample_{sampler}' in K.sampling.__dict__ and \
+            (sigma_schedule == 'default' or f'get_sigmas_{sigma_schedule}' in K.sampling.__dict__)
+    def get_sigmas(self, steps):
+        """the sigmas of `steps` sampling steps, followed by 0"""
+        if self.sigma_schedule == 'default':
+            return self.model_wrap.get_sigmas(steps)
+        sigma_min, sigma_max = self.model_wrap.sigmas[0].item(), self.model_wrap.sigmas[-1].item()
+        return K.sampling.__dict__[f'get_sigmas_{self.sigma_schedule}'](steps, sigma_min, sigma_max, device=self.model_wrap.sigmas.device)
+    def sample_sigmas(self, model_fn, x, sigmas, extra_args):
+        """samples x from sigmas[0] down the schedule; the DPM solvers choose their own steps between its first and
+        last non-zero sigma, the fast one within a budget of one model evaluation per scheduled step"""
+        if self.schedule == 'dpm_fast':
+            return K.sampling.sample_dpm_fast(model_fn, x, sigmas[-2].item(), sigmas[0].item(), len(sigmas) - 1, extra_args=extra_args, disable=False)
+        if self.schedule == 'dpm_adaptive':
+            return K.sampling.sample_dpm_adaptive(model_fn, x, sigmas[-2].item(), sigmas[0].item(), extra_args=extra_args, disable=False)
+        return K.sampling.__dict__[f'sample_{self.schedule}'](model_fn, x, sigmas, extra_args=extra_args, disable=False)
     def sample(self, S, conditioning, batch_size, shape, verbose, unconditional_guidance_scale, unconditional_conditioning, eta, x_T):
-        sigmas = self.model_wrap.get_sigmas(S)
+        sigmas = self.get_sigmas(S)
         x = x_T * sigmas[0]
-        model_wrap_cfg = CFGDenoiser(self.model_wrap)
+        model_wrap_cfg = CFGDenoiser(self.model_wrap, sigmas)
 
-        samples_ddim = K.sampling.__dict__[f'sample_{self.schedule}'](model_wrap_cfg, x, sigmas, extra_args={'cond': conditioning, 'uncond': unconditional_conditioning, 'cond_scale': unconditional_guidance_scale}, disable=False)
+        samples_ddim = self.sample_sigmas(model_wrap_cfg, x, sigmas, extra_args={'cond': conditioning, 'uncond': unconditional_conditioning, 'cond_scale': unconditional_guidance_scale})
 
         return samples_ddim, None
 
 
+# sampler name -> (k-diffusion sampler, sigma schedule); DDIM and PLMS are handled by get_sampler
+k_samplers = {
+    'k_dpm_2_a': ('dpm_2_ancestral', 'default'),
+    'k_dpm_2': ('dpm_2', 'default'),
+    'k_euler_a': ('euler_ancestral', 'default'),
+    'k_euler': ('euler', 'default'),
+    'k_heun': ('heun', 'default'),
+    'k_lms': ('lms', 'default'),
+    'k_dpm_2_a_karras': ('dpm_2_ancestral', 'karras'),
+    'k_dpm_2_karras': ('dpm_2', 'karras'),
+    'k_euler_a_karras': ('euler_ancestral', 'karras'),
+    'k_euler_karras': ('euler', 'karras'),
+    'k_heun_karras': ('heun', 'karras'),
+    'k_lms_karras': ('lms', 'karras'),
+    'k_euler_exponential': ('euler', 'exponential'),
+    'k_lms_exponential': ('lms', 'exponential'),
+    'k_dpm_fast': ('dpm_fast', 'default'),
+    'k_dpm_adaptive': ('dpm_adaptive', 'default'),
+}
+k_samplers = {name: spec for name, spec in k_samplers.items() if KDiffusionSampler.is_available(*spec)}
+sampler_names = ['DDIM', 'PLMS'] + list(k_samplers)
+
+def get_sampler(sampler_name):
+    if sampler_name == 'PLMS':
+        return PLMSSampler(model)
+    if sampler_name == 'DDIM':
+        return DDIMSampler(model)
+    if sampler_name in k_samplers:
+        return KDiffusionSampler(model, *k_samplers[sampler_name])
+    raise Exception("Unknown sampler: " + sampler_name)
+
+
 def create_random_tensors(shape, seeds):
     xs = []
     for seed in seeds:
@@ -288,8 +476,27 @@ def create_random_tensors(shape, seeds):
     return x
 
 def torch_gc():
-    torch.cuda.empty_cache()
-    torch.cuda.ipc_collect()
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+        torch.cuda.ipc_collect()
+
+def precision_scope():
+    """autocast for the model device; float16 on CUDA unless --bf16, bfloat16 on CPU with --bf16"""
+    if opt.precision != "autocast":
+        return nullcontext()
+    if device.type == "cpu":
+        return autocast("cpu", dtype=torch.bfloat16) if opt.bf16 else nullcontext()
+    return autocast("cuda", dtype=torch.bfloat16 if opt.bf16 else torch.float16)
+
+def offload(module):
+    """moves an --optimized model part back to the CPU and waits until its GPU memory is released"""
+    if device.type != "cuda":
+        return
+    mem = torch.cuda.memory_allocated()/1e6
+    module.to("cpu")
+    while(torch.cuda.memory_allocated()/1e6 >= mem):
+        time.sleep(1)
+
 def load_LDSR(checking=False):
     model_name = 'model'
     yaml_name = 'project'
@@ -348,7 +555,9 @@ def load_RealESRGAN(model_name: str, checking = False):
     else:
         instance = RealESRGANer(scale=2, model_path=model_path, model=RealESRGAN_models[model_name], pre_pad=0, half=not opt.no_half)
     instance.model.name = model_name
-    return instance
+    # RealESRGANer runs the whole image at once; only its loaded network is used
+    return TiledUpscaler(instance.model, getattr(instance.model, 'scale', 4), instance.device, half=instance.half,
+                         memory_mb=opt.upscale_memory_mb)
 
 GFPGAN = None
 if os.path.exists(GFPGAN_dir):
@@ -415,11 +624,11 @@ def load_SD_model():
             sd['model2.' + key[6:]] = sd.pop(key)
 
         config = OmegaConf.load("optimizedSD/v1-inference.yaml")
-        device = torch.device(f"cuda:{opt.gpu}") if torch.cuda.is_available() else torch.device("cpu")
 
+        config.modelUNet.params.device = str(device)
         model = instantiate_from_config(config.modelUNet)
         _, _ = model.load_state_dict(sd, strict=False)
-        model.cuda()
+        model.to(load_device)
         model.eval()
         model.turbo = opt.optimized_turbo
 
@@ -438,13 +647,33 @@ def load_SD_model():
             model = model.half()
             modelCS = modelCS.half()
             modelFS = modelFS.half()
+        if opt.token_merging:
+            apply_token_merging(model, [float(r) for r in opt.token_merging.split(',')], opt.token_merging_ff)
+        if opt.step_cache_interval > 1:
+            print("--step-cache-interval is not supported with --optimized, ignoring it", file=sys.stderr)
+        if opt.quantize:
+            print("--quantize is not supported with --optimized, ignoring it", file=sys.stderr)
+        if opt.compile:
+            print("--compile is not supported with --optimized, ignoring it", file=sys.stderr)
         return model,modelCS,modelFS,device, config
     else:
         config = OmegaConf.load(opt.config)
-        model = load_model_from_config(config, opt.ckpt)
-
-        device = torch.device(f"cuda:{opt.gpu}") if torch.cuda.is_available() else torch.device("cpu")
-        model = (model if opt.no_half else model.half()).to(device)
+        if opt.quantize:
+            # dynamically quantized layers only run on CPU, in fp32
+            model = load_quantized_model(config, opt.ckpt, opt.quantize_conv)
+        else:
+            model = load_model_from_config(config, opt.ckpt)
+            model = (model if opt.no_half else model.half()).to(load_device)
+        model.cond_stage_model.device = device
+        if opt.token_merging:
+            apply_token_merging(model, [float(r) for r in opt.token_merging.split(',')], opt.token_merging_ff)
+        model.model.diffusion_model.set_step_cache(opt.step_cache_depth, opt.step_cache_interval)
+        if opt.compile:
+            if opt.step_cache_interval > 1:
+                print("--compile can't trace the UNet with --step-cache-interval, only the VAE decoder is traced", file=sys.stderr)
+            with torch.no_grad(), precision_scope():
+                # graphs traced on CPU would not run on the GPU, a standby server traces them once activated
+                compile_model(model, parse_buckets(opt.compile_buckets), warmup=opt.compile_warmup and not opt.standby)
     return model, device,config
 
 if opt.optimized:
@@ -453,9 +682,203 @@ else:
     model, device,config = load_SD_model()
 
 
-def load_embeddings(fp):
-    if fp is not None and hasattr(model, "embedding_manager"):
-        model.embedding_manager.load(fp.name)
+class InitLatentCache:
+    """Bounded LRU cache for img2img init data: first stage encoder outputs and downsampled masks.
+    Entries are keyed by a content hash of the source image plus the parameters used to prepare it,
+    and evicted least recently used first once the total tensor size exceeds max_bytes. They are kept
+    in CPU memory, so they don't take VRAM away from sampling, and get() returns a copy on device."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(image, *params):
+        digest = hashlib.sha1(image.tobytes()).hexdigest()
+        return (digest, image.mode, image.size) + params
+
+    @staticmethod
+    def _sizeof(value):
+        if isinstance(value, torch.Tensor):
+            return value.element_size() * value.nelement()
+        return value.parameters.element_size() * value.parameters.nelement()
+
+    @staticmethod
+    def _copy_to(value, target):
+        if isinstance(value, torch.Tensor):
+            return value.to(target, copy=True)
+        # DiagonalGaussianDistribution, rebuilt from its parameters
+        return type(value)(value.parameters.to(target, copy=True), deterministic=value.deterministic)
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                return None
+            self._entries.move_to_end(key)
+        return self._copy_to(value, device)
+
+    def put(self, key, value):
+        value = self._copy_to(value, "cpu")
+        size = self._sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._sizes.pop(key)
+                del self._entries[key]
+            self._entries[key] = value
+            self._sizes[key] = size
+            self._size += size
+            while self._size > self.max_bytes:
+                old_key, _ = self._entries.popitem(last=False)
+                self._size -= self._sizes.pop(old_key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._size = 0
+
+init_latent_cache = InitLatentCache(opt.init_latent_cache_mb * 1_048_576)
+
+def encode_init_image(init_img, resize_mode, width, height, batch_size=1):
+    """resizes and encodes init_img into latent space, reusing the cached encoder output when the same image
+    was encoded before with the same resize mode and dimensions"""
+    first_stage = model if not opt.optimized else modelFS
+    key = InitLatentCache.make_key(init_img, 'latent', resize_mode, width, height)
+    encoder_posterior = init_latent_cache.get(key)
+    if encoder_posterior is None:
+        image = init_img.convert("RGB")
+        image = resize_image(resize_mode, image, width, height)
+        image = np.array(image).astype(np.float32) / 255.0
+        image = image[None].transpose(0, 3, 1, 2)
+        image = torch.from_numpy(image)
+
+        if opt.optimized:
+            modelFS.to(device)
+
+        init_image = 2. * image - 1.
+        init_image = init_image.to(device)
+        encoder_posterior = first_stage.encode_first_stage(init_image)
+
+        if opt.optimized:
+            offload(modelFS)
+
+        init_latent_cache.put(key, encoder_posterior)
+
+    # sampling from the posterior is cheap, so it is still done per call (and per batch item)
+    # to keep results identical to encoding from scratch
+    return torch.cat([first_stage.get_first_stage_encoding(encoder_posterior) for _ in range(batch_size)])  # move to latent space
+
+def get_init_mask(mask_source, image_editor_mode, resize_mode, width, height):
+    """builds the latent space mask for img2img from the alpha (Uncrop) or mask (Mask) image, cached like the init latents"""
+    key = InitLatentCache.make_key(mask_source, 'mask', image_editor_mode, resize_mode, width, height)
+    mask = init_latent_cache.get(key)
+    if mask is not None:
+        return mask
+
+    if image_editor_mode == "Uncrop":
+        alpha = mask_source.convert("RGBA")
+        alpha = resize_image(resize_mode, alpha, width // 8, height // 8)
+        mask_channel = alpha.split()[-1]
+        mask_channel = mask_channel.filter(ImageFilter.GaussianBlur(4))
+        mask_channel = np.array(mask_channel)
+        mask_channel[mask_channel >= 255] = 255
+        mask_channel[mask_channel < 255] = 0
+        mask_channel = Image.fromarray(mask_channel).filter(ImageFilter.GaussianBlur(2))
+    else:
+        alpha = mask_source.convert("RGBA")
+        alpha = resize_image(resize_mode, alpha, width // 8, height // 8)
+        mask_channel = alpha.split()[1]
+
+    mask = np.array(mask_channel).astype(np.float32) / 255.0
+    mask = (1 - mask)
+    mask = np.tile(mask, (4, 1, 1))
+    mask = mask[None].transpose(0, 1, 2, 3)
+    mask = torch.from_numpy(mask).to(device)
+
+    init_latent_cache.put(key, mask)
+    return mask
+
+
+class EmbeddingSets:
+    """Textual inversion embedding files, loaded once per file content and kept in memory (at most max_sets).
+    A request swaps its set into the model's embedding_manager only while its prompts are encoded, so sessions
+    can use different embedding files without reloading them."""
+
+    def __init__(self, max_sets=8, max_digests=64):
+        self.max_sets = max_sets
+        self.max_digests = max_digests
+        # content hash -> (string_to_token_dict, string_to_param_dict), least recently used first
+        self._sets = OrderedDict()
+        # (path, size, mtime) -> content hash, so a file is only read the first time it is seen; least recently used
+        # first, as every upload is a new temporary file
+        self._digests = OrderedDict()
+        # the model's own set, used by requests without an embeddings file
+        self._default = None
+        self._lock = threading.RLock()
+
+    def digest(self, fp):
+        if fp is None:
+            return None
+        st = os.stat(fp.name)
+        key = (fp.name, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            digest = self._digests.get(key)
+            if digest is not None:
+                self._digests.move_to_end(key)
+                return digest
+        with open(fp.name, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        with self._lock:
+            self._digests[key] = digest
+            while len(self._digests) > self.max_digests:
+                self._digests.popitem(last=False)
+        return digest
+
+    def load(self, fp):
+        """returns the embedding set of fp (the model's own for None), loading it if its content is new"""
+        digest = self.digest(fp)
+        manager = model.embedding_manager
+        with self._lock:
+            if self._default is None:
+                self._default = (manager.string_to_token_dict, manager.string_to_param_dict)
+            if digest is None:
+                return self._default
+            if digest in self._sets:
+                self._sets.move_to_end(digest)
+                return self._sets[digest]
+            manager.load(fp.name)
+            embedding_set = self._sets[digest] = (manager.string_to_token_dict, manager.string_to_param_dict)
+            manager.string_to_token_dict, manager.string_to_param_dict = self._default
+            while len(self._sets) > self.max_sets:
+                self._sets.popitem(last=False)
+            return embedding_set
+
+    @contextmanager
+    def active(self, embedding_set):
+        """the model's embedding_manager uses embedding_set inside the block; None leaves it alone"""
+        if embedding_set is None:
+            yield
+            return
+        manager = model.embedding_manager
+        with self._lock:
+            manager.string_to_token_dict, manager.string_to_param_dict = embedding_set
+            try:
+                yield
+            finally:
+                manager.string_to_token_dict, manager.string_to_param_dict = self._default
+
+    def clear(self):
+        with self._lock:
+            self._sets.clear()
+            self._default = None
+
+embedding_sets = EmbeddingSets()
 
 
 def get_font(fontsize):
@@ -577,44 +1000,39 @@ def draw_prompt_matrix(im, width, height, all_prompts):
 def check_prompt_length(prompt, comments):
     """this function tests if prompt is too long, and if so, adds a message to comments"""
 
-    tokenizer = (model if not opt.optimized else modelCS).cond_stage_model.tokenizer
-    max_length = (model if not opt.optimized else modelCS).cond_stage_model.max_length
+    cond_stage_model = (model if not opt.optimized else modelCS).cond_stage_model
 
-    info = (model if not opt.optimized else modelCS).cond_stage_model.tokenizer([prompt], truncation=True, max_length=max_length, return_overflowing_tokens=True, padding="max_length", return_tensors="pt")
-    ovf = info['overflowing_tokens'][0]
-    overflowing_count = ovf.shape[0]
-    if overflowing_count == 0:
+    # the tokens are cached by the embedder, so get_learned_conditioning will not tokenize this prompt again
+    _, overflowing = cond_stage_model.tokenize([prompt])
+    ovf = overflowing[0]
+    if len(ovf) == 0:
         return
 
-    vocab = {v: k for k, v in tokenizer.get_vocab().items()}
-    overflowing_words = [vocab.get(int(x), "") for x in ovf]
-    overflowing_text = tokenizer.convert_tokens_to_string(''.join(overflowing_words))
+    overflowing_text = cond_stage_model.tokens_to_text(ovf)
 
-    comments.append(f"Warning: too many input tokens; some ({len(overflowing_words)}) have been truncated:\n{overflowing_text}\n")
+    comments.append(f"Warning: too many input tokens; some ({len(ovf)}) have been truncated:\n{overflowing_text}\n")
 
 def save_sample(image, sample_path_i, filename, jpg_sample, prompts, seeds, width, height, steps, cfg_scale,
 normalize_prompt_weights, use_GFPGAN, write_info_files, write_sample_info_to_log_file, prompt_matrix, init_img, uses_loopback, uses_random_seed_loopback, skip_save,
 skip_grid, sort_samples, sampler_name, ddim_eta, n_iter, batch_size, i, denoising_strength, resize_mode, skip_metadata=True):
+    """queues the image to be encoded and writes its info files; returns the encoding's Future"""
     filename_i = os.path.join(sample_path_i, filename)
-    if not jpg_sample:
-        if opt.save_metadata and not skip_metadata:
-            metadata = PngInfo()
-            metadata.add_text("SD:prompt", prompts[i])
-            metadata.add_text("SD:seed", str(seeds[i]))
-            metadata.add_text("SD:width", str(width))
-            metadata.add_text("SD:height", str(height))
-            metadata.add_text("SD:sampler_name", str(sampler_name))
-            metadata.add_text("SD:steps", str(steps))
-            metadata.add_text("SD:cfg_scale", str(cfg_scale))
-            metadata.add_text("SD:normalize_prompt_weights", str(normalize_prompt_weights))
-            if init_img is not None:
-                metadata.add_text("SD:denoising_strength", str(denoising_strength))
-            metadata.add_text("SD:GFPGAN", str(use_GFPGAN and GFPGAN is not None))
-            image.save(f"{filename_i}.png", pnginfo=metadata)
-        else:
-            image.save(f"{filename_i}.png")
-    else:
-        image.save(f"{filename_i}.jpg", 'jpeg', quality=100, optimize=True)
+    metadata = None
+    if opt.save_metadata and not skip_metadata:
+        metadata = {
+            "SD:prompt": prompts[i],
+            "SD:seed": str(seeds[i]),
+            "SD:width": str(width),
+            "SD:height": str(height),
+            "SD:sampler_name": str(sampler_name),
+            "SD:steps": str(steps),
+            "SD:cfg_scale": str(cfg_scale),
+            "SD:normalize_prompt_weights": str(normalize_prompt_weights),
+        }
+        if init_img is not None:
+            metadata["SD:denoising_strength"] = str(denoising_strength)
+        metadata["SD:GFPGAN"] = str(use_GFPGAN and GFPGAN is not None)
+    saved = image_encoder.submit(jpg_sample_profile if jpg_sample else sample_profile, image, filename_i, metadata)
     if write_info_files or write_sample_info_to_log_file:
         # toggles differ for txt2img vs. img2img:
         offset = 0 if init_img is None else 2
@@ -677,9 +1095,18 @@ skip_grid, sort_samples, sampler_name, ddim_eta, n_iter, batch_size, i, denoisin
             log_dump = log_dump + " \n" #space at the end for dynamic params to accept the last param
             with open(sample_log_path, "a", encoding="utf8") as log_file:
                 log_file.write(log_dump)
+    return saved
 
 
 
+def append_result(output_images, image, saved=None, jpg_sample=False):
+    """appends image to output_images; job results reuse the sample file it is being saved to, if that is lossless,
+    instead of writing a copy of their own when they are spilled to disk"""
+    if saved is not None and not jpg_sample and sample_profile.lossless and isinstance(output_images, ResultImages):
+        output_images.append(image, file=saved)
+    else:
+        output_images.append(image)
+
 def get_next_sequence_number(path, prefix=''):
     """
     Determines and returns the next sequence number to use when saving an
@@ -693,7 +1120,7 @@ def get_next_sequence_number(path, prefix=''):
     """
     result = -1
     for p in Path(path).iterdir():
-        if p.name.endswith(('.png', '.jpg')) and p.name.startswith(prefix):
+        if p.name.endswith(IMAGE_EXTENSIONS) and p.name.startswith(prefix):
             tmp = p.name[len(prefix):]
             try:
                 result = max(int(tmp.split('-')[0]), result)
@@ -701,6 +1128,19 @@ def get_next_sequence_number(path, prefix=''):
                 pass
     return result + 1
 
+def save_numbered(profile, image, directory, name, number=None, metadata=None):
+    """queues image to be written to directory as name(number), number being the next free sequence number (or the
+    given one, if still free). The file is reserved atomically, so if another job took the name first the directory
+    is scanned again; returns the number used and the encoding's Future"""
+    if number is None:
+        number = get_next_sequence_number(directory)
+    while True:
+        try:
+            return number, image_encoder.submit(profile, image, os.path.join(directory, name(number)), metadata,
+                                                exclusive=True)
+        except FileExistsError:
+            number = max(number + 1, get_next_sequence_number(directory))
+
 
 def oxlamon_matrix(prompt, seed, n_iter, batch_size):
     pattern = re.compile(r'(,\s){2,}')
@@ -777,14 +1217,214 @@ def oxlamon_matrix(prompt, seed, n_iter, batch_size):
 
 
 
+def model_fingerprint():
+    """identifies the loaded weights and the options which change the numerics of generation"""
+    stat = os.stat(opt.ckpt)
+    return (os.path.abspath(opt.ckpt), stat.st_size, int(stat.st_mtime), opt.config, opt.optimized, opt.precision,
+            opt.no_half, opt.bf16, device.type, opt.quantize, opt.quantize_conv, opt.token_merging,
+            opt.token_merging_ff, opt.step_cache_interval, opt.step_cache_depth)
+
+class OutOfMemory(RuntimeError):
+    pass
+
+class MemorySaving:
+    """what process_images gives up to fit into memory after running out of it; next() enables one more measure"""
+
+    def __init__(self):
+        # queries per attention chunk, 0 for unchunked attention
+        self.attention_chunk = 0
+        self.tiled_decode = False
+        self.applied = []
+        # MemUsageMonitor of the running attempt, which a failed attempt leaves running
+        self.monitor = None
+        # progress of the failed attempts, set by process_images: a retry generates the same images as the first
+        # attempt, continuing with the first one not finished instead of generating and saving the others again
+        self.plan = None
+        self.images_done = 0
+        self.output_images = None
+        self.outputs_done = 0
+        self.grid_captions = []
+        self.steps_done = 0
+
+    def next(self, kwargs, in_decode):
+        """enables the next measure, changing process_images' kwargs in place; returns its description, or None
+        once there is nothing left to give up"""
+        batch_size = kwargs.get('batch_size', 1)
+        if in_decode and not self.tiled_decode:
+            self.tiled_decode = True
+            measure = "tiled VAE decoding"
+        elif batch_size > 1:
+            # keep the number of images, and with it the seeds
+            total = batch_size * kwargs['n_iter']
+            batch_size = max(d for d in range(1, batch_size // 2 + 1) if total % d == 0)
+            kwargs['batch_size'], kwargs['n_iter'] = batch_size, total // batch_size
+            measure = f"batch size {batch_size}"
+        elif self.attention_chunk == 0 or self.attention_chunk > 256:
+            self.attention_chunk = 1024 if self.attention_chunk == 0 else 256
+            measure = f"attention in chunks of {self.attention_chunk} queries"
+        elif not self.tiled_decode:
+            self.tiled_decode = True
+            measure = "tiled VAE decoding"
+        else:
+            return None
+        self.applied.append(measure)
+        return measure
+
+def record_oom_recovery(error, measure, kwargs):
+    event = {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'error': error,
+        'recovery': measure,
+        'width': kwargs.get('width'),
+        'height': kwargs.get('height'),
+        'batch_size': kwargs.get('batch_size'),
+        'n_iter': kwargs.get('n_iter'),
+        'steps': kwargs.get('steps'),
+    }
+    print(f"Out of memory, {'retrying with ' + measure if measure else 'giving up'}")
+    try:
+        os.makedirs("log", exist_ok=True)
+        with open(os.path.join("log", "oom-recoveries.jsonl"), "a", encoding="utf8") as f:
+            f.write(json.dumps(event) + "\n")
+    except OSError as e:
+        print(f"Could not record the out of memory recovery: {e}")
+
+@contextmanager
+def attention_chunking(chunk_size):
+    """CrossAttention of the loaded model attends to chunk_size queries at a time inside the block"""
+    if not chunk_size:
+        yield
+        return
+    models = [model] if not opt.optimized else [model, modelCS]
+    # traced graphs have the attention baked in, they are traced again with the chunking
+    traced = [m for m in model.modules() if isinstance(m, BucketedTrace)]
+    for m in models:
+        set_query_chunk_size(m, chunk_size)
+    for m in traced:
+        m.clear()
+    try:
+        yield
+    finally:
+        for m in models:
+            set_query_chunk_size(m, 0)
+        for m in traced:
+            m.clear()
+
+@contextmanager
+def step_cache_run():
+    """releases the features the UNet's step cache kept for this thread once the sampling run is over, also when
+    it fails"""
+    try:
+        yield
+    finally:
+        step_cache = None if opt.optimized else model.model.diffusion_model.step_cache
+        if step_cache is not None:
+            step_cache.reset()
+
+def decode_first_stage_tiled(first_stage, z, tile=64, overlap=16):
+    """decodes latents one sample and one overlapping tile (in latent pixels) at a time, blending the overlaps"""
+    f = 8
+    b, _, h, w = z.shape
+    th, tw = min(tile, h), min(tile, w)
+    window = blend_window(th * f, tw * f, overlap * f, device=z.device)
+    decoded = torch.zeros(b, 3, h * f, w * f, device=z.device)
+    weights = torch.zeros(h * f, w * f, device=z.device)
+    for y in tile_starts(h, th, overlap):
+        for x in tile_starts(w, tw, overlap):
+            for n in range(b):
+                part = first_stage.decode_first_stage(z[n:n + 1, :, y:y + th, x:x + tw]).float()
+                decoded[n, :, y * f:(y + th) * f, x * f:(x + tw) * f] += part[0] * window
+            weights[y * f:(y + th) * f, x * f:(x + tw) * f] += window
+    return decoded / weights
+
+def process_images_with_recovery(**kwargs):
+    """process_images, retried in process with less memory hungry settings (see MemorySaving) when it runs out of
+    memory. Raises OutOfMemory once there is nothing left to give up; other errors are raised as they are"""
+    memory_saving = MemorySaving()
+    job_info = kwargs.get('job_info')
+    memory_saving.steps_done = job_info.completed_steps if job_info else 0
+    while True:
+        try:
+            output_images, seed, info, stats = process_images(memory_saving=memory_saving, **kwargs)
+            if memory_saving.applied:
+                stats += f"\nRecovered from running out of memory with {', '.join(memory_saving.applied)}"
+            return output_images, seed, info, stats
+        except RuntimeError as e:
+            if not is_oom_error(e):
+                raise
+            error = str(e).splitlines()[0]
+            in_decode = any(frame.name == 'decode_first_stage' for frame in traceback.extract_tb(e.__traceback__))
+        if memory_saving.monitor is not None:
+            memory_saving.monitor.stop()
+        # outside of the except block, so the traceback no longer keeps the failed attempt's tensors alive
+        gc.collect()
+        torch_gc()
+        measure = memory_saving.next(kwargs, in_decode)
+        record_oom_recovery(error, measure, kwargs)
+        if measure is None:
+            raise OutOfMemory(f"Out of memory even with {', '.join(memory_saving.applied) or 'all savings'}: {error}")
+        images = memory_saving.output_images
+        if images is not None:
+            # the retry continues after the last finished batch, drop what the failed one produced
+            if hasattr(images, 'truncate'):
+                images.truncate(memory_saving.outputs_done)
+            else:
+                del images[memory_saving.outputs_done:]
+        if kwargs.get('samples') is not None:
+            del kwargs['samples'][memory_saving.images_done:]
+        if job_info:
+            job_info.completed_steps = memory_saving.steps_done
+
+def process_images_cached(use_cache=True, cache_extra=(), **kwargs):
+    """process_images behind the result cache: a request identical to a finished one is answered from the cache, and
+    one identical to a running one waits for it. `cache_extra` holds whatever else the caller's func_init and
+    func_sample depend on. Requests with random variations are never cached. A cache hit still writes the sample,
+    variant and grid files the request asks for, numbered like newly generated ones"""
+    if result_cache is None or not use_cache or kwargs.get('variant_amount', 0.0) > 0.0:
+        return process_images_with_recovery(**kwargs)
+
+    # everything which changes the returned images; the rest only controls what is written to disk, which a cache
+    # hit does according to the new request
+    ignored = ['outpath', 'func_init', 'func_sample', 'skip_save', 'skip_grid', 'do_not_save_grid', 'sort_samples',
+               'write_info_files', 'write_sample_info_to_log_file', 'jpg_sample', 'fp', 'guidance', 'job_info']
+    params = {k: v for k, v in kwargs.items() if k not in ignored}
+    guidance = kwargs.get('guidance')
+    fp = kwargs.get('fp')
+    # the variants only exist if the face restoration and upscaling models the request asks for could be loaded
+    variants = (bool(params.get('use_GFPGAN')) and GFPGAN is not None,
+                bool(params.get('use_RealESRGAN')) and RealESRGAN is not None)
+    key = ResultCache.key(params, cache_extra, embedding_sets.digest(fp), model_fingerprint(),
+                          guidance and (guidance.scale, guidance.end, guidance.curve_name), variants)
+
+    job_info = kwargs.get('job_info')
+    if job_info:
+        job_info.job_status = "Looking up the result cache"
+    cached = result_cache.claim(key)
+    if cached is None:
+        result = None
+        samples = []
+        try:
+            output_images, seed, info, stats = process_images_with_recovery(samples=samples, **kwargs)
+            if not (job_info and job_info.should_stop.is_set()):
+                result = CachedResult(samples, seed, info, stats)
+            return output_images, seed, info, stats
+        finally:
+            result_cache.finish(key, result)
+
+    output_images, _, _, _ = process_images_with_recovery(replay=cached.samples, **kwargs)
+    return output_images, cached.seed, cached.info, cached.stats + "\nReturned from the result cache"
+
 def process_images(
         outpath, func_init, func_sample, prompt, seed, sampler_name, skip_grid, skip_save, batch_size,
         n_iter, steps, cfg_scale, width, height, prompt_matrix, use_GFPGAN, use_RealESRGAN, realesrgan_model_name,
         fp, ddim_eta=0.0, do_not_save_grid=False, normalize_prompt_weights=True, init_img=None, init_mask=None,
         keep_mask=False, mask_blur_strength=3, denoising_strength=0.75, resize_mode=None, uses_loopback=False,
         uses_random_seed_loopback=False, sort_samples=True, write_info_files=True, write_sample_info_to_log_file=False, jpg_sample=False,
-        variant_amount=0.0, variant_seed=None,imgProcessorTask=False, job_info: JobInfo = None):
-    """this is the main loop that both txt2img and img2img use; it calls func_init once inside all the scopes and func_sample once per batch"""
+        variant_amount=0.0, variant_seed=None,imgProcessorTask=False, guidance: GuidanceSchedule = None, job_info: JobInfo = None,
+        memory_saving: MemorySaving = None, replay=None, samples=None):
+    """this is the main loop that both txt2img and img2img use; it calls func_init(batch_size) once inside all the scopes and func_sample once per batch.
+    `samples` receives the images of every generated sample, one {file name suffix: image} dict each (see CachedResult);
+    passing such a list as `replay` writes and returns those images like a run that generated them, without sampling"""
     prompt = prompt or ''
     torch_gc()
     # start time after garbage collection (or before?)
@@ -792,9 +1432,10 @@ def process_images(
 
     mem_mon = MemUsageMonitor('MemMon')
     mem_mon.start()
+    if memory_saving is not None:
+        memory_saving.monitor = mem_mon
 
-    if hasattr(model, "embedding_manager"):
-        load_embeddings(fp)
+    embedding_set = embedding_sets.load(fp) if hasattr(model, "embedding_manager") else None
 
     os.makedirs(outpath, exist_ok=True)
 
@@ -809,6 +1450,7 @@ def process_images(
     prompt_matrix_parts = []
     simple_templating = False
     add_original_image = True
+    frows = None
     if prompt_matrix:
         if prompt.startswith("@"):
             simple_templating = True
@@ -843,17 +1485,39 @@ def process_images(
 
         all_prompts = batch_size * n_iter * [prompt]
         all_seeds = [seed + x for x in range(len(all_prompts))]
+    if memory_saving is not None:
+        if memory_saving.plan is None:
+            memory_saving.plan = list(all_prompts), list(all_seeds), list(prompt_matrix_parts), frows
+        else:
+            # the prompt matrix depends on n_iter, which a smaller batch size changes
+            all_prompts, all_seeds, prompt_matrix_parts, frows = memory_saving.plan
+            all_seeds = list(all_seeds)
+    # index of the first image to generate, after the ones a failed attempt finished
+    start = memory_saving.images_done if memory_saving is not None else 0
     original_seeds = all_seeds.copy()
 
-    precision_scope = autocast if opt.precision == "autocast" else nullcontext
+    # img2img samplers only run the last t_enc of the steps
+    sampled_steps = int(denoising_strength * steps) if init_img is not None else steps
     if job_info:
+        # progress in sampling steps, used by the job manager for queue ETAs
+        job_info.total_steps = job_info.completed_steps + (len(all_prompts) - start) * sampled_steps
+
+    if job_info and not imgProcessorTask:
         output_images = job_info.images
+    elif memory_saving is not None and memory_saving.output_images is not None:
+        output_images = memory_saving.output_images
     else:
+        # image processor tasks return their intermediate images, which don't belong in the job's gallery
         output_images = []
-    grid_captions = []
+    grid_captions = list(memory_saving.grid_captions) if memory_saving is not None else []
+    if memory_saving is not None and memory_saving.output_images is None:
+        memory_saving.output_images = output_images
+        memory_saving.outputs_done = len(output_images)
     stats = []
-    with torch.no_grad(), precision_scope("cuda"), (model.ema_scope() if not opt.optimized else nullcontext()):
-        init_data = func_init()
+    pending_saves = []
+    with torch.no_grad(), precision_scope(), (model.ema_scope() if not opt.optimized else nullcontext()), \
+            attention_chunking(memory_saving.attention_chunk if memory_saving else 0), step_cache_run():
+        init_data = func_init(batch_size) if replay is None else None
         tic = time.time()
 
 
@@ -869,81 +1533,88 @@ def process_images(
             for si in range(len(all_seeds)):
                 all_seeds[si] += target_seed_randomizer
 
-        for n in range(n_iter):
+        for first in range(start, len(all_prompts), batch_size):
             if job_info and job_info.should_stop.is_set():
                 print("Early exit requested")
                 break
 
-            print(f"Iteration: {n+1}/{n_iter}")
-            prompts = all_prompts[n * batch_size:(n + 1) * batch_size]
-            captions = prompt_matrix_parts[n * batch_size:(n + 1) * batch_size]
-            seeds = all_seeds[n * batch_size:(n + 1) * batch_size]
-            current_seeds = original_seeds[n * batch_size:(n + 1) * batch_size]
+            n = first // batch_size
+            iterations = f"{n + 1}/{math.ceil(len(all_prompts) / batch_size)}"
+            print(f"Iteration: {iterations}")
+            prompts = all_prompts[first:first + batch_size]
+            captions = prompt_matrix_parts[first:first + batch_size]
+            seeds = all_seeds[first:first + batch_size]
+            current_seeds = original_seeds[first:first + batch_size]
 
             if job_info:
-                job_info.job_status = f"Processing Iteration {n+1}/{n_iter}. Batch size {batch_size}"
+                job_info.job_status = f"Processing Iteration {iterations}. Batch size {batch_size}"
                 for idx,(p,s) in enumerate(zip(prompts,seeds)):
                     job_info.job_status += f"\nItem {idx}: Seed {s}\nPrompt: {p}"
 
-            if opt.optimized:
-                modelCS.to(device)
-            uc = (model if not opt.optimized else modelCS).get_learned_conditioning(len(prompts) * [""])
-            if isinstance(prompts, tuple):
-                prompts = list(prompts)
-
-            # split the prompt if it has : for weighting
-            # TODO for speed it might help to have this occur when all_prompts filled??
-            weighted_subprompts = split_weighted_subprompts(prompts[0], normalize_prompt_weights)
-
-            # sub-prompt weighting used if more than 1
-            if len(weighted_subprompts) > 1:
-                c = torch.zeros_like(uc) # i dont know if this is correct.. but it works
-                for i in range(0, len(weighted_subprompts)):
-                    # note if alpha negative, it functions same as torch.sub
-                    c = torch.add(c, (model if not opt.optimized else modelCS).get_learned_conditioning(weighted_subprompts[i][0]), alpha=weighted_subprompts[i][1])
-            else: # just behave like usual
-                c = (model if not opt.optimized else modelCS).get_learned_conditioning(prompts)
-
-            shape = [opt_C, height // opt_f, width // opt_f]
+            cur_variant_amount = variant_amount
+            if replay is not None:
+                # a result cache hit: the images are known, only their files are written
+                x_samples_ddim = replay[first:first + len(prompts)]
+            else:
+                if opt.optimized:
+                    modelCS.to(device)
+                with embedding_sets.active(embedding_set):
+                    uc = (model if not opt.optimized else modelCS).get_learned_conditioning(len(prompts) * [""])
+                    if isinstance(prompts, tuple):
+                        prompts = list(prompts)
+
+                    # split the prompt if it has : for weighting
+                    # TODO for speed it might help to have this occur when all_prompts filled??
+                    weighted_subprompts = split_weighted_subprompts(prompts[0], normalize_prompt_weights)
+
+                    # sub-prompt weighting used if more than 1
+                    if len(weighted_subprompts) > 1:
+                        c = torch.zeros_like(uc) # i dont know if this is correct.. but it works
+                        for i in range(0, len(weighted_subprompts)):
+                            # note if alpha negative, it functions same as torch.sub
+                            c = torch.add(c, (model if not opt.optimized else modelCS).get_learned_conditioning(weighted_subprompts[i][0]), alpha=weighted_subprompts[i][1])
+                    else: # just behave like usual
+                        c = (model if not opt.optimized else modelCS).get_learned_conditioning(prompts)
+
+                shape = [opt_C, height // opt_f, width // opt_f]
 
-            if opt.optimized:
-                mem = torch.cuda.memory_allocated()/1e6
-                modelCS.to("cpu")
-                while(torch.cuda.memory_allocated()/1e6 >= mem):
-                    time.sleep(1)
-
-            cur_variant_amount = variant_amount 
-            if variant_amount == 0.0:
-                # we manually generate all input noises because each one should have a specific seed
-                x = create_random_tensors(shape, seeds=seeds)
-            else: # we are making variants
-                # using variant_seed as sneaky toggle,
-                # when not None or '' use the variant_seed
-                # otherwise use seeds
-                if variant_seed != None and variant_seed != '':
-                    specified_variant_seed = seed_to_int(variant_seed)
-                    torch.manual_seed(specified_variant_seed)
-                    target_x = create_random_tensors(shape, seeds=[specified_variant_seed])
-                    # with a variant seed we would end up with the same variant as the basic seed
-                    # does not change. But we can increase the steps to get an interesting result
-                    # that shows more and more deviation of the original image and let us adjust
-                    # how far we will go (using 10 iterations with variation amount set to 0.02 will
-                    # generate an icreasingly variated image which is very interesting for movies)
-                    cur_variant_amount += n*variant_amount
-                else:
-                    target_x = create_random_tensors(shape, seeds=seeds)
-                # finally, slerp base_x noise to target_x noise for creating a variant
-                x = slerp(device, max(0.0, min(1.0, cur_variant_amount)), base_x, target_x)
+                if opt.optimized:
+                    offload(modelCS)
+
+                if variant_amount == 0.0:
+                    # we manually generate all input noises because each one should have a specific seed
+                    x = create_random_tensors(shape, seeds=seeds)
+                else: # we are making variants
+                    # using variant_seed as sneaky toggle,
+                    # when not None or '' use the variant_seed
+                    # otherwise use seeds
+                    if variant_seed != None and variant_seed != '':
+                        specified_variant_seed = seed_to_int(variant_seed)
+                        torch.manual_seed(specified_variant_seed)
+                        target_x = create_random_tensors(shape, seeds=[specified_variant_seed])
+                        # with a variant seed we would end up with the same variant as the basic seed
+                        # does not change. But we can increase the steps to get an interesting result
+                        # that shows more and more deviation of the original image and let us adjust
+                        # how far we will go (using 10 iterations with variation amount set to 0.02 will
+                        # generate an icreasingly variated image which is very interesting for movies)
+                        cur_variant_amount += n*variant_amount
+                    else:
+                        target_x = create_random_tensors(shape, seeds=seeds)
+                    # finally, slerp base_x noise to target_x noise for creating a variant
+                    x = slerp(device, max(0.0, min(1.0, cur_variant_amount)), base_x, target_x)
 
-            samples_ddim = func_sample(init_data=init_data, x=x, conditioning=c, unconditional_conditioning=uc, sampler_name=sampler_name)
+                samples_ddim = func_sample(init_data=init_data, x=x, conditioning=c, unconditional_conditioning=uc, sampler_name=sampler_name)
 
-            if opt.optimized:
-                modelFS.to(device)
+                if opt.optimized:
+                    modelFS.to(device)
 
 
 
-            x_samples_ddim = (model if not opt.optimized else modelFS).decode_first_stage(samples_ddim)
-            x_samples_ddim = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
+                if memory_saving and memory_saving.tiled_decode:
+                    x_samples_ddim = decode_first_stage_tiled(model if not opt.optimized else modelFS, samples_ddim)
+                else:
+                    x_samples_ddim = (model if not opt.optimized else modelFS).decode_first_stage(samples_ddim)
+                x_samples_ddim = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
             for i, x_sample in enumerate(x_samples_ddim):
                 sanitized_prompt = prompts[i].replace(' ', '_').translate({ord(x): '' for x in invalid_filename_chars})
                 if variant_seed != None and variant_seed != '':
@@ -965,73 +1636,77 @@ def process_images(
                     sanitized_prompt = sanitized_prompt
                     filename = f"{base_count:05}-{steps}_{sampler_name}_{seed_used}_{cur_variant_amount:.2f}_{sanitized_prompt}"[:128] #same as before
 
-                x_sample = 255. * rearrange(x_sample.cpu().numpy(), 'c h w -> h w c')
-                x_sample = x_sample.astype(np.uint8)
-                image = Image.fromarray(x_sample)
-                original_sample = x_sample
                 original_filename = filename
-                if use_GFPGAN and GFPGAN is not None and not use_RealESRGAN:
-                    skip_save = True # #287 >_>
-                    torch_gc()
-                    cropped_faces, restored_faces, restored_img = GFPGAN.enhance(original_sample[:,:,::-1], has_aligned=False, only_center_face=False, paste_back=True)
-                    gfpgan_sample = restored_img[:,:,::-1]
-                    gfpgan_image = Image.fromarray(gfpgan_sample)
-                    gfpgan_filename = original_filename + '-gfpgan'
-                    save_sample(gfpgan_image, sample_path_i, gfpgan_filename, jpg_sample, prompts, seeds, width, height, steps, cfg_scale,
-normalize_prompt_weights, use_GFPGAN, write_info_files, write_sample_info_to_log_file, prompt_matrix, init_img, uses_loopback, uses_random_seed_loopback, skip_save,
-skip_grid, sort_samples, sampler_name, ddim_eta, n_iter, batch_size, i, denoising_strength, resize_mode, skip_metadata=True)
-                    output_images.append(gfpgan_image) #287
-                    #if simple_templating:
-                    #    grid_captions.append( captions[i] + "\ngfpgan" )
-
-                if use_RealESRGAN and RealESRGAN is not None and not use_GFPGAN:
-                    skip_save = True # #287 >_>
-                    torch_gc()
-                    output, img_mode = RealESRGAN.enhance(original_sample[:,:,::-1])
-                    esrgan_filename = original_filename + '-esrgan4x'
-                    esrgan_sample = output[:,:,::-1]
-                    esrgan_image = Image.fromarray(esrgan_sample)
-                    save_sample(esrgan_image, sample_path_i, esrgan_filename, jpg_sample, prompts, seeds, width, height, steps, cfg_scale,
-normalize_prompt_weights, use_GFPGAN,write_info_files, write_sample_info_to_log_file, prompt_matrix, init_img, uses_loopback, uses_random_seed_loopback, skip_save,
-skip_grid, sort_samples, sampler_name, ddim_eta, n_iter, batch_size, i, denoising_strength, resize_mode, skip_metadata=True)
-                    output_images.append(esrgan_image) #287
-                    #if simple_templating:
-                    #    grid_captions.append( captions[i] + "\nesrgan" )
+                if replay is None:
+                    x_sample = 255. * rearrange(x_sample.cpu().numpy(), 'c h w -> h w c')
+                    x_sample = x_sample.astype(np.uint8)
+                    image = Image.fromarray(x_sample)
+                    original_sample = x_sample
+                    # the sample and its variants by file name suffix
+                    sample_images = {'': image}
+                    if use_GFPGAN and GFPGAN is not None and not use_RealESRGAN:
+                        torch_gc()
+                        cropped_faces, restored_faces, restored_img = GFPGAN.enhance(original_sample[:,:,::-1], has_aligned=False, only_center_face=False, paste_back=True)
+                        gfpgan_sample = restored_img[:,:,::-1]
+                        sample_images['-gfpgan'] = Image.fromarray(gfpgan_sample)
+
+                    if use_RealESRGAN and RealESRGAN is not None and not use_GFPGAN:
+                        torch_gc()
+                        output, img_mode = RealESRGAN.enhance(original_sample[:,:,::-1])
+                        esrgan_sample = output[:,:,::-1]
+                        sample_images['-esrgan4x'] = Image.fromarray(esrgan_sample)
+
+                    if use_RealESRGAN and RealESRGAN is not None and use_GFPGAN and GFPGAN is not None:
+                        torch_gc()
+                        cropped_faces, restored_faces, restored_img = GFPGAN.enhance(x_sample[:,:,::-1], has_aligned=False, only_center_face=False, paste_back=True)
+                        gfpgan_sample = restored_img[:,:,::-1]
+                        output, img_mode = RealESRGAN.enhance(gfpgan_sample[:,:,::-1])
+                        gfpgan_esrgan_sample = output[:,:,::-1]
+                        sample_images['-gfpgan-esrgan4x'] = Image.fromarray(gfpgan_esrgan_sample)
+                else:
+                    sample_images = x_sample
+                    image = sample_images['']
+                if samples is not None:
+                    samples.append(sample_images)
 
-                if use_RealESRGAN and RealESRGAN is not None and use_GFPGAN and GFPGAN is not None:
+                for suffix, variant_image in sample_images.items():
+                    if not suffix:
+                        continue
                     skip_save = True # #287 >_>
-                    torch_gc()
-                    cropped_faces, restored_faces, restored_img = GFPGAN.enhance(x_sample[:,:,::-1], has_aligned=False, only_center_face=False, paste_back=True)
-                    gfpgan_sample = restored_img[:,:,::-1]
-                    output, img_mode = RealESRGAN.enhance(gfpgan_sample[:,:,::-1])
-                    gfpgan_esrgan_filename = original_filename + '-gfpgan-esrgan4x'
-                    gfpgan_esrgan_sample = output[:,:,::-1]
-                    gfpgan_esrgan_image = Image.fromarray(gfpgan_esrgan_sample)
-                    save_sample(gfpgan_esrgan_image, sample_path_i, gfpgan_esrgan_filename, jpg_sample, prompts, seeds, width, height, steps, cfg_scale,
+                    saved = save_sample(variant_image, sample_path_i, original_filename + suffix, jpg_sample, prompts, seeds, width, height, steps, cfg_scale,
 normalize_prompt_weights, use_GFPGAN, write_info_files, write_sample_info_to_log_file, prompt_matrix, init_img, uses_loopback, uses_random_seed_loopback, skip_save,
 skip_grid, sort_samples, sampler_name, ddim_eta, n_iter, batch_size, i, denoising_strength, resize_mode, skip_metadata=True)
-                    output_images.append(gfpgan_esrgan_image) #287
+                    pending_saves.append(saved)
+                    append_result(output_images, variant_image, saved, jpg_sample) #287
                     #if simple_templating:
-                    #    grid_captions.append( captions[i] + "\ngfpgan_esrgan" )
+                    #    grid_captions.append( captions[i] + "\n" + suffix[1:] )
 
                 # this flag is used for imgProcessorTasks like GoBig, will return the image without saving it
                 if imgProcessorTask == True:
                     output_images.append(image)
 
+                saved = None
                 if not skip_save:
-                    save_sample(image, sample_path_i, filename, jpg_sample, prompts, seeds, width, height, steps, cfg_scale,
+                    saved = save_sample(image, sample_path_i, filename, jpg_sample, prompts, seeds, width, height, steps, cfg_scale,
 normalize_prompt_weights, use_GFPGAN, write_info_files, write_sample_info_to_log_file, prompt_matrix, init_img, uses_loopback, uses_random_seed_loopback, skip_save,
 skip_grid, sort_samples, sampler_name, ddim_eta, n_iter, batch_size, i, denoising_strength, resize_mode, False)
+                    pending_saves.append(saved)
                 if add_original_image or not simple_templating:
-                    output_images.append(image)
+                    append_result(output_images, image, saved, jpg_sample)
                     if simple_templating:
                         grid_captions.append( captions[i] )
 
             if opt.optimized:
-                mem = torch.cuda.memory_allocated()/1e6
-                modelFS.to("cpu")
-                while(torch.cuda.memory_allocated()/1e6 >= mem):
-                    time.sleep(1)
+                offload(modelFS)
+
+            if job_info:
+                job_info.completed_steps += len(prompts) * sampled_steps
+            if memory_saving is not None:
+                # the batch's files are queued; running out of memory later resumes after it
+                memory_saving.images_done = first + len(prompts)
+                memory_saving.outputs_done = len(output_images)
+                memory_saving.grid_captions = list(grid_captions)
+                memory_saving.steps_done = job_info.completed_steps if job_info else 0
 
         if (prompt_matrix or not skip_grid) and not do_not_save_grid:
             grid = None
@@ -1050,9 +1725,12 @@ skip_grid, sort_samples, sampler_name, ddim_eta, n_iter, batch_size, i, denoisin
                 grid = image_grid(output_images, batch_size)
             if grid is not None:
                 grid_count = get_next_sequence_number(outpath, 'grid-')
-                grid_file = f"grid-{grid_count:05}-{seed}_{prompts[i].replace(' ', '_').translate({ord(x): '' for x in invalid_filename_chars})[:128]}.{grid_ext}"
-                grid.save(os.path.join(outpath, grid_file), grid_format, quality=grid_quality, lossless=grid_lossless, optimize=True)
+                grid_file = f"grid-{grid_count:05}-{seed}_{prompts[i].replace(' ', '_').translate({ord(x): '' for x in invalid_filename_chars})[:128]}"
+                pending_saves.append(image_encoder.submit(grid_profile, grid, os.path.join(outpath, grid_file)))
 
+        # the job is done once its files are written
+        for saved in pending_saves:
+            saved.result()
         toc = time.time()
 
     mem_max_used, mem_total = mem_mon.read_and_stop()
@@ -1074,8 +1752,13 @@ skip_grid, sort_samples, sampler_name, ddim_eta, n_iter, batch_size, i, denoisin
 #     info = f"""
 # {prompt} --seed {seed} --W {width} --H {height}  -s {steps} -C {cfg_scale} --sampler {sampler_name}  {', Denoising strength: '+str(denoising_strength) if init_img is not None else ''}{', GFPGAN' if use_GFPGAN and GFPGAN is not None else ''}{', '+realesrgan_model_name if use_RealESRGAN and RealESRGAN is not None else ''}{', Prompt Matrix Mode.' if prompt_matrix else ''}""".strip()
     stats = f'''
-Took { round(time_diff, 2) }s total ({ round(time_diff/(len(all_prompts)),2) }s per image)
+Took { round(time_diff, 2) }s total ({ round(time_diff/(len(all_prompts)),2) }s per image)'''
+    if mem_total > 0:
+        stats += f'''
 Peak memory usage: { -(mem_max_used // -1_048_576) } MiB / { -(mem_total // -1_048_576) } MiB / { round(mem_max_used/mem_total*100, 3) }%'''
+    if guidance is not None and guidance.saved_evals:
+        stats += f'''
+UNet evaluations: { guidance.evals } ({ guidance.saved_evals } saved by the guidance schedule)'''
 
     for comment in comments:
         info['text'] += "\n\n" + comment
@@ -1089,7 +1772,8 @@ Peak memory usage: { -(mem_max_used // -1_048_576) } MiB / { -(mem_total // -1_0
 
 def txt2img(prompt: str, ddim_steps: int, sampler_name: str, toggles: List[int], realesrgan_model_name: str,
             ddim_eta: float, n_iter: int, batch_size: int, cfg_scale: float, seed: Union[int, str, None],
-            height: int, width: int, fp, variant_amount: float = None, variant_seed: int = None, job_info: JobInfo = None):
+            height: int, width: int, fp, variant_amount: float = None, variant_seed: int = None,
+            guidance_end: float = 1.0, guidance_curve: str = 'constant', use_cache: bool = True, job_info: JobInfo = None):
     outpath = opt.outdir_txt2img or opt.outdir or "outputs/txt2img-samples"
     err = False
     seed = seed_to_int(seed)
@@ -1112,34 +1796,20 @@ def txt2img(prompt: str, ddim_steps: int, sampler_name: str, toggles: List[int],
         ModelLoader(['RealESRGAN'],True,False,realesrgan_model_name)
     if use_RealESRGAN and use_GFPGAN:
         ModelLoader(['GFPGAN','RealESRGAN'],True,False,realesrgan_model_name)
-    if sampler_name == 'PLMS':
-        sampler = PLMSSampler(model)
-    elif sampler_name == 'DDIM':
-        sampler = DDIMSampler(model)
-    elif sampler_name == 'k_dpm_2_a':
-        sampler = KDiffusionSampler(model,'dpm_2_ancestral')
-    elif sampler_name == 'k_dpm_2':
-        sampler = KDiffusionSampler(model,'dpm_2')
-    elif sampler_name == 'k_euler_a':
-        sampler = KDiffusionSampler(model,'euler_ancestral')
-    elif sampler_name == 'k_euler':
-        sampler = KDiffusionSampler(model,'euler')
-    elif sampler_name == 'k_heun':
-        sampler = KDiffusionSampler(model,'heun')
-    elif sampler_name == 'k_lms':
-        sampler = KDiffusionSampler(model,'lms')
-    else:
-        raise Exception("Unknown sampler: " + sampler_name)
+    sampler = get_sampler(sampler_name)
+
+    guidance = GuidanceSchedule(cfg_scale, guidance_end, guidance_curve)
 
-    def init():
+    def init(batch_size):
         pass
 
     def sample(init_data, x, conditioning, unconditional_conditioning, sampler_name):
-        samples_ddim, _ = sampler.sample(S=ddim_steps, conditioning=conditioning, batch_size=int(x.shape[0]), shape=x[0].shape, verbose=False, unconditional_guidance_scale=cfg_scale, unconditional_conditioning=unconditional_conditioning, eta=ddim_eta, x_T=x)
+        samples_ddim, _ = sampler.sample(S=ddim_steps, conditioning=conditioning, batch_size=int(x.shape[0]), shape=x[0].shape, verbose=False, unconditional_guidance_scale=guidance, unconditional_conditioning=unconditional_conditioning, eta=ddim_eta, x_T=x)
         return samples_ddim
 
     try:
-        output_images, seed, info, stats = process_images(
+        output_images, seed, info, stats = process_images_cached(
+            use_cache=use_cache,
             outpath=outpath,
             func_init=init,
             func_sample=sample,
@@ -1167,6 +1837,7 @@ def txt2img(prompt: str, ddim_steps: int, sampler_name: str, toggles: List[int],
             jpg_sample=jpg_sample,
             variant_amount=variant_amount,
             variant_seed=variant_seed,
+            guidance=guidance,
             job_info=job_info,
         )
 
@@ -1174,6 +1845,11 @@ def txt2img(prompt: str, ddim_steps: int, sampler_name: str, toggles: List[int],
 
         return output_images, seed, info, stats
     except RuntimeError as e:
+        if not is_fatal_error(e):
+            # out of memory even after the recovery in process_images_with_recovery, or a bad request; the
+            # process is fine, so don't restart it
+            stats = f'FAILED:<br><textarea rows="5" style="color:white;background: black;width: -webkit-fill-available;font-family: monospace;font-size: small;font-weight: bold;">{str(e)}</textarea>'
+            return [], seed, 'err', stats
         err = e
         err_msg = f'CRASHED:<br><textarea rows="5" style="color:white;background: black;width: -webkit-fill-available;font-family: monospace;font-size: small;font-weight: bold;">{str(e)}</textarea><br><br>Please wait while the program restarts.'
         stats = err_msg
@@ -1194,7 +1870,7 @@ class Flagging(gr.FlaggingCallback):
         os.makedirs("log/images", exist_ok=True)
 
         # those must match the "txt2img" function !! + images, seed, comment, stats !! NOTE: changes to UI output must be reflected here too
-        prompt, ddim_steps, sampler_name, toggles, ddim_eta, n_iter, batch_size, cfg_scale, seed, height, width, fp, variant_amount, variant_seed, images, seed, comment, stats = flag_data
+        prompt, ddim_steps, sampler_name, toggles, ddim_eta, n_iter, batch_size, cfg_scale, seed, height, width, fp, variant_amount, variant_seed, guidance_end, guidance_curve, use_cache, images, seed, comment, stats = flag_data
 
         filenames = []
 
@@ -1226,8 +1902,9 @@ class Flagging(gr.FlaggingCallback):
 
 
 def img2img(prompt: str, image_editor_mode: str, mask_mode: str, mask_blur_strength: int, ddim_steps: int, sampler_name: str,
-            toggles: List[int], realesrgan_model_name: str, n_iter: int,  cfg_scale: float, denoising_strength: float,
-            seed: int, height: int, width: int, resize_mode: int, init_info: any = None, init_info_mask: any = None, fp = None, job_info: JobInfo = None):
+            toggles: List[int], realesrgan_model_name: str, n_iter: int, batch_size: int, cfg_scale: float, denoising_strength: float,
+            seed: int, height: int, width: int, resize_mode: int, init_info: any = None, init_info_mask: any = None, fp = None,
+            guidance_end: float = 1.0, guidance_curve: str = 'constant', use_cache: bool = True, job_info: JobInfo = None):
     # print([prompt, image_editor_mode, init_info, init_info_mask, mask_mode,
     #                               mask_blur_strength, ddim_steps, sampler_name, toggles,
     #                               realesrgan_model_name, n_iter, cfg_scale,
@@ -1237,7 +1914,7 @@ def img2img(prompt: str, image_editor_mode: str, mask_mode: str, mask_blur_stren
     err = False
     seed = seed_to_int(seed)
 
-    batch_size = 1
+    batch_size = int(batch_size)
 
     prompt_matrix = 0 in toggles
     normalize_prompt_weights = 1 in toggles
@@ -1260,22 +1937,7 @@ def img2img(prompt: str, image_editor_mode: str, mask_mode: str, mask_blur_stren
         ModelLoader(['RealESRGAN'],True,False,realesrgan_model_name)
     if use_RealESRGAN and use_GFPGAN:
         ModelLoader(['GFPGAN','RealESRGAN'],True,False,realesrgan_model_name)
-    if sampler_name == 'DDIM':
-        sampler = DDIMSampler(model)
-    elif sampler_name == 'k_dpm_2_a':
-        sampler = KDiffusionSampler(model,'dpm_2_ancestral')
-    elif sampler_name == 'k_dpm_2':
-        sampler = KDiffusionSampler(model,'dpm_2')
-    elif sampler_name == 'k_euler_a':
-        sampler = KDiffusionSampler(model,'euler_ancestral')
-    elif sampler_name == 'k_euler':
-        sampler = KDiffusionSampler(model,'euler')
-    elif sampler_name == 'k_heun':
-        sampler = KDiffusionSampler(model,'heun')
-    elif sampler_name == 'k_lms':
-        sampler = KDiffusionSampler(model,'lms')
-    else:
-        raise Exception("Unknown sampler: " + sampler_name)
+    sampler = get_sampler(sampler_name)
 
     if image_editor_mode == 'Mask':
         init_img = init_info_mask["image"]
@@ -1295,50 +1957,17 @@ def img2img(prompt: str, image_editor_mode: str, mask_mode: str, mask_blur_stren
 
     assert 0. <= denoising_strength <= 1., 'can only work with strength in [0.0, 1.0]'
     t_enc = int(denoising_strength * ddim_steps)
+    guidance = GuidanceSchedule(cfg_scale, guidance_end, guidance_curve)
 
-    def init():
-        image = init_img.convert("RGB")
-        image = resize_image(resize_mode, image, width, height)
-        #image = image.convert("RGB")
-        image = np.array(image).astype(np.float32) / 255.0
-        image = image[None].transpose(0, 3, 1, 2)
-        image = torch.from_numpy(image)
-
-        mask_channel = None
+    def init(batch_size):
+        mask = None
         if image_editor_mode == "Uncrop":
-            alpha = init_img.convert("RGBA")
-            alpha = resize_image(resize_mode, alpha, width // 8, height // 8)
-            mask_channel = alpha.split()[-1]
-            mask_channel = mask_channel.filter(ImageFilter.GaussianBlur(4))
-            mask_channel = np.array(mask_channel)
-            mask_channel[mask_channel >= 255] = 255
-            mask_channel[mask_channel < 255] = 0
-            mask_channel = Image.fromarray(mask_channel).filter(ImageFilter.GaussianBlur(2))
+            mask = get_init_mask(init_img, image_editor_mode, resize_mode, width, height)
         elif image_editor_mode == "Mask":
-            alpha = init_mask.convert("RGBA")
-            alpha = resize_image(resize_mode, alpha, width // 8, height // 8)
-            mask_channel = alpha.split()[1]
+            mask = get_init_mask(init_mask, image_editor_mode, resize_mode, width, height)
 
-        mask = None
-        if mask_channel is not None:
-            mask = np.array(mask_channel).astype(np.float32) / 255.0
-            mask = (1 - mask)
-            mask = np.tile(mask, (4, 1, 1))
-            mask = mask[None].transpose(0, 1, 2, 3)
-            mask = torch.from_numpy(mask).to(device)
-        if opt.optimized:
-            modelFS.to(device)
-
-        init_image = 2. * image - 1.
-        init_image = init_image.to(device)
-        init_image = repeat(init_image, '1 ... -> b ...', b=batch_size)
-        init_latent = (model if not opt.optimized else modelFS).get_first_stage_encoding((model if not opt.optimized else modelFS).encode_first_stage(init_image))  # move to latent space
-        
-        if opt.optimized:
-            mem = torch.cuda.memory_allocated()/1e6
-            modelFS.to("cpu")
-            while(torch.cuda.memory_allocated()/1e6 >= mem):
-                time.sleep(1)
+        # the batch size of the attempt, which is 1 for loopback and smaller after running out of memory
+        init_latent = encode_init_image(init_img, resize_mode, width, height, batch_size)
 
         return init_latent, mask,
 
@@ -1351,35 +1980,37 @@ def img2img(prompt: str, image_editor_mode: str, mask_mode: str, mask_blur_stren
 
         if sampler_name != 'DDIM':
             x0, z_mask = init_data
+            # the init latent is encoded for a full batch; a trailing prompt matrix batch may be smaller
+            x0 = x0[:x.shape[0]]
 
-            sigmas = sampler.model_wrap.get_sigmas(ddim_steps)
+            sigmas = sampler.get_sigmas(ddim_steps)
             noise = x * sigmas[ddim_steps - t_enc_steps - 1]
 
             xi = x0 + noise
 
             # Obliterate masked image
             if z_mask is not None and obliterate:
-                random = torch.randn(z_mask.shape, device=xi.device)
                 xi = (z_mask * noise) + ((1-z_mask) * xi)
 
             sigma_sched = sigmas[ddim_steps - t_enc_steps - 1:]
-            model_wrap_cfg = CFGMaskedDenoiser(sampler.model_wrap)
-            samples_ddim = K.sampling.__dict__[f'sample_{sampler.get_sampler_name()}'](model_wrap_cfg, xi, sigma_sched, extra_args={'cond': conditioning, 'uncond': unconditional_conditioning, 'cond_scale': cfg_scale, 'mask': z_mask, 'x0': x0, 'xi': xi}, disable=False)
+            model_wrap_cfg = CFGMaskedDenoiser(sampler.model_wrap, sigma_sched)
+            samples_ddim = sampler.sample_sigmas(model_wrap_cfg, xi, sigma_sched, extra_args={'cond': conditioning, 'uncond': unconditional_conditioning, 'cond_scale': guidance, 'mask': z_mask, 'x0': x0, 'xi': xi})
         else:
 
             x0, z_mask = init_data
+            x0 = x0[:x.shape[0]]
 
             sampler.make_schedule(ddim_num_steps=ddim_steps, ddim_eta=0.0, verbose=False)
-            z_enc = sampler.stochastic_encode(x0, torch.tensor([t_enc_steps]*batch_size).to(device))
+            # use the per-seed noise in x so every batch item gets its own, reproducible variation
+            z_enc = sampler.stochastic_encode(x0, torch.tensor([t_enc_steps]*x.shape[0]).to(device), noise=x)
 
             # Obliterate masked image
             if z_mask is not None and obliterate:
-                random = torch.randn(z_mask.shape, device=z_enc.device)
-                z_enc = (z_mask * random) + ((1-z_mask) * z_enc)
+                z_enc = (z_mask * x) + ((1-z_mask) * z_enc)
 
                                 # decode it
             samples_ddim = sampler.decode(z_enc, conditioning, t_enc_steps,
-                                            unconditional_guidance_scale=cfg_scale,
+                                            unconditional_guidance_scale=guidance,
                                             unconditional_conditioning=unconditional_conditioning,
                                             z_mask=z_mask, x0=x0)
         return samples_ddim
@@ -1402,7 +2033,7 @@ def img2img(prompt: str, image_editor_mode: str, mask_mode: str, mask_blur_stren
             if do_color_correction and i == 0:
                 correction_target = cv2.cvtColor(np.asarray(init_img.copy()), cv2.COLOR_RGB2LAB)
 
-            output_images, seed, info, stats = process_images(
+            output_images, seed, info, stats = process_images_with_recovery(
                 outpath=outpath,
                 func_init=init,
                 func_sample=sample,
@@ -1436,6 +2067,7 @@ def img2img(prompt: str, image_editor_mode: str, mask_mode: str, mask_blur_stren
                 write_info_files=write_info_files,
                 write_sample_info_to_log_file=write_sample_info_to_log_file,
                 jpg_sample=jpg_sample,
+                guidance=guidance,
                 job_info=job_info
             )
 
@@ -1464,15 +2096,17 @@ def img2img(prompt: str, image_editor_mode: str, mask_mode: str, mask_blur_stren
         if not skip_grid:
             grid_count = get_next_sequence_number(outpath, 'grid-')
             grid = image_grid(history, batch_size, force_n_rows=1)
-            grid_file = f"grid-{grid_count:05}-{seed}_{prompt.replace(' ', '_').translate({ord(x): '' for x in invalid_filename_chars})[:128]}.{grid_ext}"
-            grid.save(os.path.join(outpath, grid_file), grid_format, quality=grid_quality, lossless=grid_lossless, optimize=True)
+            grid_file = f"grid-{grid_count:05}-{seed}_{prompt.replace(' ', '_').translate({ord(x): '' for x in invalid_filename_chars})[:128]}"
+            image_encoder.submit(grid_profile, grid, os.path.join(outpath, grid_file)).result()
 
 
         output_images = history
         seed = initial_seed
 
     else:
-        output_images, seed, info, stats = process_images(
+        output_images, seed, info, stats = process_images_cached(
+            use_cache=use_cache,
+            cache_extra=(image_editor_mode,),
             outpath=outpath,
             func_init=init,
             func_sample=sample,
@@ -1504,6 +2138,7 @@ def img2img(prompt: str, image_editor_mode: str, mask_mode: str, mask_blur_stren
             write_info_files=write_info_files,
             write_sample_info_to_log_file=write_sample_info_to_log_file,
             jpg_sample=jpg_sample,
+            guidance=guidance,
             job_info=job_info
         )
 
@@ -1565,11 +2200,17 @@ def slerp(device, t, v0:torch.Tensor, v1:torch.Tensor, DOT_THRESHOLD=0.9995):
 
 
 def imgproc(image,image_batch,imgproc_prompt,imgproc_toggles, imgproc_upscale_toggles,imgproc_realesrgan_model_name,imgproc_sampling,
- imgproc_steps, imgproc_height, imgproc_width, imgproc_cfg, imgproc_denoising, imgproc_seed,imgproc_gfpgan_strength,imgproc_ldsr_steps,imgproc_ldsr_pre_downSample,imgproc_ldsr_post_downSample):
+ imgproc_steps, imgproc_height, imgproc_width, imgproc_cfg, imgproc_denoising, imgproc_seed,imgproc_gfpgan_strength,imgproc_ldsr_steps,imgproc_ldsr_pre_downSample,imgproc_ldsr_post_downSample,
+ job_info: JobInfo = None):
 
     outpath = opt.outdir_imglab or opt.outdir or "outputs/imglab-samples"
     output = []
-    images = []
+    if 'x2' in imgproc_realesrgan_model_name:
+        # the x2 modes run the x4 model and downscale its result
+        modelMode = imgproc_realesrgan_model_name.replace('x2','x4')
+    else:
+        modelMode = imgproc_realesrgan_model_name
+    upscaler = None
     def processGFPGAN(image,strength):
         image = image.convert("RGB")
         cropped_faces, restored_faces, restored_img = GFPGAN.enhance(np.array(image, dtype=np.uint8), has_aligned=False, only_center_face=False, paste_back=True)
@@ -1579,14 +2220,12 @@ def imgproc(image,image_batch,imgproc_prompt,imgproc_toggles, imgproc_upscale_to
 
         return result
     def processRealESRGAN(image):
-        if 'x2' in imgproc_realesrgan_model_name:
-            # downscale to 1/2 size
-            modelMode = imgproc_realesrgan_model_name.replace('x2','x4')
-        else:
-            modelMode = imgproc_realesrgan_model_name
+        nonlocal upscaler
+        if upscaler is None:
+            # loaded once for the whole batch
+            upscaler = RealESRGAN if RealESRGAN is not None and RealESRGAN.model.name == modelMode else load_RealESRGAN(modelMode)
         image = image.convert("RGB")
-        RealESRGAN = load_RealESRGAN(modelMode)
-        result, res = RealESRGAN.enhance(np.array(image, dtype=np.uint8))
+        result, res = upscaler.enhance(np.array(image, dtype=np.uint8))
         result = Image.fromarray(result)
         if 'x2' in imgproc_realesrgan_model_name:
             # downscale to 1/2 size
@@ -1618,62 +2257,27 @@ def imgproc(image,image_batch,imgproc_prompt,imgproc_toggles, imgproc_upscale_to
         sampler_name = imgproc_sampling
 
 
-        if sampler_name == 'DDIM':
-            sampler = DDIMSampler(model)
-        elif sampler_name == 'k_dpm_2_a':
-            sampler = KDiffusionSampler(model,'dpm_2_ancestral')
-        elif sampler_name == 'k_dpm_2':
-            sampler_name = KDiffusionSampler(model,'dpm_2')
-        elif sampler_name == 'k_euler_a':
-            sampler = KDiffusionSampler(model,'euler_ancestral')
-        elif sampler_name == 'k_euler':
-            sampler = KDiffusionSampler(model,'euler')
-        elif sampler_name == 'k_heun':
-            sampler = KDiffusionSampler(model,'heun')
-        elif sampler_name == 'k_lms':
-            sampler = KDiffusionSampler(model,'lms')
-        else:
-            raise Exception("Unknown sampler: " + sampler_name)
-            pass
+        sampler = get_sampler(sampler_name)
         init_img = result
         init_mask = None
         keep_mask = False
         assert 0. <= denoising_strength <= 1., 'can only work with strength in [0.0, 1.0]'
 
-        def init():
-            image = init_img.convert("RGB")
-            image = resize_image(resize_mode, image, width, height)
-            image = np.array(image).astype(np.float32) / 255.0
-            image = image[None].transpose(0, 3, 1, 2)
-            image = torch.from_numpy(image)
-
-            if opt.optimized:
-                modelFS.to(device)
-
-            init_image = 2. * image - 1.
-            init_image = init_image.to(device)
-            init_image = repeat(init_image, '1 ... -> b ...', b=batch_size)
-            init_latent = (model if not opt.optimized else modelFS).get_first_stage_encoding((model if not opt.optimized else modelFS).encode_first_stage(init_image))  # move to latent space
-
-            if opt.optimized:
-                mem = torch.cuda.memory_allocated()/1e6
-                modelFS.to("cpu")
-                while(torch.cuda.memory_allocated()/1e6 >= mem):
-                    time.sleep(1)
-
+        def init(batch_size):
+            init_latent = encode_init_image(init_img, resize_mode, width, height, batch_size)
             return init_latent,
 
         def sample(init_data, x, conditioning, unconditional_conditioning, sampler_name):
             if sampler_name != 'DDIM':
                 x0, = init_data
 
-                sigmas = sampler.model_wrap.get_sigmas(ddim_steps)
+                sigmas = sampler.get_sigmas(ddim_steps)
                 noise = x * sigmas[ddim_steps - t_enc - 1]
 
                 xi = x0 + noise
                 sigma_sched = sigmas[ddim_steps - t_enc - 1:]
-                model_wrap_cfg = CFGDenoiser(sampler.model_wrap)
-                samples_ddim = K.sampling.__dict__[f'sample_{sampler.get_sampler_name()}'](model_wrap_cfg, xi, sigma_sched, extra_args={'cond': conditioning, 'uncond': unconditional_conditioning, 'cond_scale': cfg_scale}, disable=False)
+                model_wrap_cfg = CFGDenoiser(sampler.model_wrap, sigma_sched)
+                samples_ddim = sampler.sample_sigmas(model_wrap_cfg, xi, sigma_sched, extra_args={'cond': conditioning, 'uncond': unconditional_conditioning, 'cond_scale': cfg_scale})
             else:
                 x0, = init_data
                 sampler.make_schedule(ddim_num_steps=ddim_steps, ddim_eta=0.0, verbose=False)
@@ -1757,8 +2361,10 @@ def imgproc(image,image_batch,imgproc_prompt,imgproc_toggles, imgproc_upscale_to
         batch_count = math.ceil(len(work) / batch_size)
         print(f"GoBig upscaling will process a total of {len(work)} images tiled as {len(grid.tiles[0][2])}x{len(grid.tiles)} in a total of {batch_count} batches.")
         for i in range(batch_count):
+            if stopped():
+                return None
             init_img = work[i*batch_size:(i+1)*batch_size][0]
-            output_images, seed, info, stats = process_images(
+            output_images, seed, info, stats = process_images_with_recovery(
                     outpath=outpath,
                     func_init=init,
                     func_sample=sample,
@@ -1790,8 +2396,11 @@ def imgproc(image,image_batch,imgproc_prompt,imgproc_toggles, imgproc_upscale_to
                     write_info_files=True,
                     write_sample_info_to_log_file=False,
                     jpg_sample=False,
-                    imgProcessorTask=True
+                    imgProcessorTask=True,
+                    job_info=job_info
                 )
+            if stopped():
+                return None
             #if initial_seed is None:
             #    initial_seed = seed
             #seed = seed + 1
@@ -1804,10 +2413,9 @@ def imgproc(image,image_batch,imgproc_prompt,imgproc_toggles, imgproc_upscale_to
                 image_index += 1
 
         combined_image = combine_grid(grid)
-        grid_count = len(os.listdir(outpath)) - 1
         del sampler
 
-        torch.cuda.empty_cache()
+        torch_gc()
         return combined_image
     def processLDSR(image):
         result = LDSR.superResolution(image,int(imgproc_ldsr_steps),str(imgproc_ldsr_pre_downSample),str(imgproc_ldsr_post_downSample))
@@ -1817,99 +2425,118 @@ def imgproc(image,image_batch,imgproc_prompt,imgproc_toggles, imgproc_upscale_to
     if image_batch != None:
         if image != None:
             print("Batch detected and single image detected, please only use one of the two. Aborting.")
-            return None
-        #convert file to pillow image
-        for img in image_batch:
-            image = Image.fromarray(np.array(Image.open(img)))
-            images.append(image)
-
+            return (None,) if job_info else None
+        sources = list(image_batch)
     elif image != None:
-        if image_batch != None:
-            print("Batch detected and single image detected, please only use one of the two. Aborting.")
-            return None
-        else:
-            images.append(image)
+        sources = [image]
+    else:
+        sources = []
 
-    if len(images) > 0:
+    def decode(source):
+        if isinstance(source, Image.Image):
+            return source
+        #convert file to pillow image
+        return Image.fromarray(np.array(Image.open(source)))
+
+    # The batch runs as a pipeline: files are decoded on a thread pool ahead of the GPU stage, the GPU stage runs
+    # the models one image at a time with the models loaded once per pass, and results are encoded and written by
+    # image_encoder while the next image is processed. Every stage holds at most queue_depth images.
+    queue_depth = max(1, opt.imglab_queue_depth)
+    use_GFPGAN = 0 in imgproc_toggles
+    upscale_mode = imgproc_upscale_toggles if 1 in imgproc_toggles else None
+    stages = []
+    if use_GFPGAN:
+        stages.append(lambda image: processGFPGAN(image, imgproc_gfpgan_strength))
+    # each pass is (models to unload, models to load, per image stages); GoLatent needs two, as GoBig's and LDSR's
+    # models don't fit in VRAM together
+    if upscale_mode is None:
+        passes = [(['RealESGAN','LDSR'], ['GFPGAN'], stages)] if use_GFPGAN else []
+        outdir = 'GFPGAN'
+    elif upscale_mode == 0:
+        passes = [(['LDSR'], ['GFPGAN'] if use_GFPGAN else [], stages + [processRealESRGAN])]
+        outdir = 'RealESRGAN'
+    elif upscale_mode == 1:
+        passes = [(['LDSR'], (['GFPGAN'] if use_GFPGAN else []) + ['model'], stages + [processGoBig])]
+        outdir = 'GoBig'
+    elif upscale_mode == 2:
+        passes = [(['model','RealESGAN'], (['GFPGAN'] if use_GFPGAN else []) + ['LDSR'], stages + [processLDSR])]
+        outdir = 'LDSR'
+    else:
+        passes = [(['LDSR'], (['GFPGAN'] if use_GFPGAN else []) + ['model'], stages + [processGoBig]),
+                  (['model','GFPGAN','RealESGAN'], ['LDSR'], [processLDSR])]
+        outdir = 'GoLatent'
+    if passes and not use_GFPGAN:
+        passes[0][0].append('GFPGAN')
+    spill_profile = parse_profile('png-fast')
+
+    outpathDir = os.path.join(outpath, outdir)
+    os.makedirs(outpathDir, exist_ok=True)
+    # the directory is scanned once; save_numbered reserves each name atomically and scans again only when another
+    # job took it first
+    batchNumber = get_next_sequence_number(outpathDir)
+    pending_saves = deque()
+    total = len(sources)
+
+    def stopped():
+        return job_info is not None and job_info.should_stop.is_set()
+
+    if total > 0 and passes:
         print("Processing images...")
-        #pre load models not in loop
-        if 0 in imgproc_toggles:
-            ModelLoader(['RealESGAN','LDSR'],False,True) # Unload unused models
-            ModelLoader(['GFPGAN'],True,False) # Load used models
-        if 1 in imgproc_toggles:
-                if imgproc_upscale_toggles == 0:
-                     ModelLoader(['GFPGAN','LDSR'],False,True) # Unload unused models
-                     ModelLoader(['RealESGAN'],True,False,imgproc_realesrgan_model_name) # Load used models 
-                elif imgproc_upscale_toggles == 1:
-                        ModelLoader(['GFPGAN','LDSR'],False,True) # Unload unused models
-                        ModelLoader(['RealESGAN','model'],True,False) # Load used models
-                elif imgproc_upscale_toggles == 2:
-
-                    ModelLoader(['model','GFPGAN','RealESGAN'],False,True) # Unload unused models
-                    ModelLoader(['LDSR'],True,False) # Load used models
-                elif imgproc_upscale_toggles == 3:
-                    ModelLoader(['GFPGAN','LDSR'],False,True) # Unload unused models
-                    ModelLoader(['RealESGAN','model'],True,False,imgproc_realesrgan_model_name) # Load used models
-        for image in images:
-            if 0 in imgproc_toggles:
-                #recheck if GFPGAN is loaded since it's the only model that can be loaded in the loop as well
-                ModelLoader(['GFPGAN'],True,False) # Load used models
-                image = processGFPGAN(image,imgproc_gfpgan_strength)
-                outpathDir = os.path.join(outpath,'GFPGAN')
-                os.makedirs(outpathDir, exist_ok=True)
-                batchNumber = get_next_sequence_number(outpathDir)
-                outFilename = str(batchNumber)+'-'+'result'
-
-                if 1 not in imgproc_toggles:
-                    output.append(image)
-                    save_sample(image, outpathDir, outFilename, False, None, None, None, None, None, None, None, None, None, None, None, None, None, False, None, None, None, None, None, None, None, None, None, True)
-            if 1 in imgproc_toggles:
-                if imgproc_upscale_toggles == 0:
-                    image = processRealESRGAN(image)
-                    outpathDir = os.path.join(outpath,'RealESRGAN')
-                    os.makedirs(outpathDir, exist_ok=True)
-                    batchNumber = get_next_sequence_number(outpathDir)
-                    outFilename = str(batchNumber)+'-'+'result'
-                    output.append(image)
-                    save_sample(image, outpathDir, outFilename, False, None, None, None, None, None, None, None, None, None, None, None, None, None, False, None, None, None, None, None, None, None, None, None, True)
-
-                elif imgproc_upscale_toggles == 1:
-                    image = processGoBig(image)
-                    outpathDir = os.path.join(outpath,'GoBig')
-                    os.makedirs(outpathDir, exist_ok=True)
-                    batchNumber = get_next_sequence_number(outpathDir)
-                    outFilename = str(batchNumber)+'-'+'result'
-                    output.append(image)
-                    save_sample(image, outpathDir, outFilename, False, None, None, None, None, None, None, None, None, None, None, None, None, None, False, None, None, None, None, None, None, None, None, None, True)
-
-                elif imgproc_upscale_toggles == 2:
-                    image = processLDSR(image)
-                    outpathDir = os.path.join(outpath,'LDSR')
-                    os.makedirs(outpathDir, exist_ok=True)
-                    batchNumber = get_next_sequence_number(outpathDir)
-                    outFilename = str(batchNumber)+'-'+'result'
-                    output.append(image)
-                    save_sample(image, outpathDir, outFilename, False, None, None, None, None, None, None, None, None, None, None, None, None, None, False, None, None, None, None, None, None, None, None, None, True)
-
-                elif imgproc_upscale_toggles == 3:
-                    image = processGoBig(image)
-                    ModelLoader(['model','GFPGAN','RealESGAN'],False,True) # Unload unused models
-                    ModelLoader(['LDSR'],True,False) # Load used models
-                    image = processLDSR(image)
-                    outpathDir = os.path.join(outpath,'GoLatent')
-                    os.makedirs(outpathDir, exist_ok=True)
-                    batchNumber = get_next_sequence_number(outpathDir)
-                    outFilename = str(batchNumber)+'-'+'result'
-                    output.append(image)
-
-                    save_sample(image, outpathDir, outFilename, None, None, None, None, None, None, None, None, None, None, None, None, None, None, False, None, None, None, None, None, None, None, None, None, True)
+    with tempfile.TemporaryDirectory() as spill_dir:
+        for pass_index, (unload, load, pass_stages) in enumerate(passes):
+            if stopped():
+                break
+            ModelLoader(unload,False,True) # Unload unused models
+            ModelLoader(load,True,False) # Load used models
+            last_pass = pass_index == len(passes) - 1
+            spilled = []
+            with closing(imap_bounded(decode, sources, opt.imglab_decode_threads, queue_depth)) as decoded:
+                for done, result in enumerate(decoded, 1):
+                    if stopped():
+                        break
+                    for stage in pass_stages:
+                        result = stage(result)
+                    if stopped():
+                        break
+                    if job_info:
+                        job_info.job_status = f"Pass {pass_index + 1}/{len(passes)}: processed {done}/{total} images" \
+                            if len(passes) > 1 else f"Processed {done}/{total} images"
+                    if last_pass:
+                        output.append(result)
+                        if job_info:
+                            job_info.images.append(result)
+                        batchNumber, saved = save_numbered(sample_profile, result, outpathDir, lambda n: f"{n}-result", batchNumber)
+                        batchNumber += 1
+                    else:
+                        # intermediate results wait on disk for the next pass instead of in memory
+                        spill_path = os.path.join(spill_dir, f"{pass_index}-{done}")
+                        saved = image_encoder.submit(spill_profile, result, spill_path)
+                        spilled.append(spill_profile.filename(spill_path))
+                    pending_saves.append(saved)
+                    while len(pending_saves) > queue_depth:
+                        pending_saves.popleft().result()
+            sources = spilled
+            while pending_saves:
+                pending_saves.popleft().result()
 
     #LDSR is always unloaded to avoid memory issues
     #ModelLoader(['LDSR'],False,True)
     #print("Reloading default models...")
     #ModelLoader(['model','RealESGAN','GFPGAN'],True,False) # load back models
     print("Done.")
-    return output
+    # wrapped by the job manager, which expects a tuple of outputs
+    return (output,) if job_info else output
+
+def imap_bounded(func, items, workers=4, depth=8):
+    """yields func(item) for each item in order, computing them on a thread pool at most depth items ahead"""
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='imap') as pool:
+        pending = deque()
+        for item in items:
+            if len(pending) >= depth:
+                yield pending.popleft().result()
+            pending.append(pool.submit(func, item))
+        while pending:
+            yield pending.popleft().result()
 
 def ModelLoader(models,load=False,unload=False,imgproc_realesrgan_model_name='RealESRGAN_x4plus'):
     #get global variables
@@ -1925,6 +2552,8 @@ def ModelLoader(models,load=False,unload=False,imgproc_realesrgan_model_name='Re
                         del global_vars[m+'FS']
                         del global_vars[m+'CS']
                 if m =='model':
+                    init_latent_cache.clear()
+                    embedding_sets.clear()
                     m='Stable Diffusion'
                 print('Unloaded ' + m)
     if load:
@@ -2019,6 +2648,9 @@ txt2img_defaults = {
     'fp': None,
     'variant_amount': 0.0,
     'variant_seed': '',
+    'guidance_end': 1.0,
+    'guidance_curve': 'constant',
+    'use_cache': True,
     'submit_on_enter': 'Yes',
 }
 
@@ -2091,6 +2723,9 @@ img2img_defaults = {
     'height': 512,
     'width': 512,
     'fp': None,
+    'guidance_end': 1.0,
+    'guidance_curve': 'constant',
+    'use_cache': True,
 }
 
 if 'img2img' in user_defaults:
@@ -2162,6 +2797,7 @@ demo = draw_gradio_ui(opt,
                       LDSR=LDSR,
                       run_GFPGAN=run_GFPGAN,
                       run_RealESRGAN=run_RealESRGAN,
+                      sampler_names=sampler_names,
                       job_manager=job_manager
                         )
 
@@ -2193,7 +2829,8 @@ class ServerLauncher(threading.Thread):
                 self.demo.launch(**gradio_params)
             except (OSError) as e:
                 print (f'Error: Port: {opt.port} is not open yet. Please wait, this may take upwards of 60 seconds...')
-                time.sleep(10)
+                # short, a standby server taking over waits here for the failed one to release the port
+                time.sleep(2)
             else:
                 port_status = 0
 
@@ -2210,6 +2847,58 @@ def launch_server():
     except (KeyboardInterrupt, OSError) as e:
         crash(e, 'Shutting down...')
 
+class HealthHandler(BaseHTTPRequestHandler):
+    """GET /health: {"status": "standby" | "starting" | "unresponsive" | "ok", "pid": ...}. ok once gradio answers a
+    request for its page within gradio_timeout seconds, starting while it refuses connections, unresponsive when it
+    accepts them but doesn't answer in time or answers with an error"""
+    gradio_timeout = 3
+
+    def do_GET(self):
+        if self.path != '/health':
+            self.send_error(404)
+            return
+        if server_state == 'standby':
+            status = 'standby'
+        else:
+            try:
+                # a real request, an accepted connection alone says nothing about a blocked event loop
+                with urlopen(f'http://127.0.0.1:{opt.port}/', timeout=self.gradio_timeout) as response:
+                    status = 'ok' if response.status == 200 else 'unresponsive'
+            except URLError as e:
+                refused = isinstance(e.reason, ConnectionRefusedError)
+                status = 'starting' if refused else 'unresponsive'
+            except OSError:
+                status = 'unresponsive'
+        body = json.dumps({'status': status, 'pid': os.getpid()}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_health_server(port):
+    server = ThreadingHTTPServer(('127.0.0.1', port), HealthHandler)
+    threading.Thread(target=server.serve_forever, name='Health Server', daemon=True).start()
+
+server_state = 'standby' if opt.standby else 'starting'
+
+def activate_standby():
+    """--standby: waits for scripts/relauncher.py to hand over, then moves the model to the device. returns False if
+    the relauncher went away instead"""
+    global load_device, server_state
+    print("Standby: loaded, waiting to be activated", flush=True)
+    if not sys.stdin.readline():
+        return False
+    tic = time.time()
+    load_device = device
+    model.to(device)
+    server_state = 'starting'
+    print(f"Standby: activated in {time.time() - tic:.1f}s")
+    return True
+
 def run_headless():
     with open(opt.cli, 'r', encoding='utf8') as f:
         kwargs = yaml.safe_load(f)
@@ -2232,6 +2921,10 @@ def run_headless():
         print()
 
 if __name__ == '__main__':
+    if opt.health_port:
+        start_health_server(opt.health_port)
+    if opt.standby and not activate_standby():
+        sys.exit(0)
     if opt.cli is None:
         launch_server()
     else: